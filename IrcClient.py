@@ -1,38 +1,3254 @@
 
 import sys
+import os
 import socket
+import select
 import time
 import Queue
 import thread
-from threading import Timer
+import gzip
+import shutil
+import collections
+import sqlite3
+import zlib
+import marshal
+import calendar
+import errno
+import struct
+import json
+import re
+import tempfile
+from threading import Timer, Thread, Event, local
 import platform
-import readline
+import string
+import ssl
+import random
+import codecs
+import bisect
+import traceback
+import operator
+
+# readline is only used to redraw the prompt, headless clients do without.
+try:
+    import readline
+except ImportError:
+    readline = None
 
 
 def dqn_to_int(st):
     """
-    http://code.activestate.com/recipes/65219-ip-address-conversion-functions/#c3
-    Convert dotted quad notation to integer
-    "127.0.0.1" => 2130706433
+    http://code.activestate.com/recipes/65219-ip-address-conversion-functions/#c3
+    Convert dotted quad notation to integer
+    "127.0.0.1" => 2130706433
+    """
+    st = st.split(".")
+    ###
+    # That is not so elegant as 'for' cycle and
+    # not extensible at all, but that works faster
+    ###
+    return int("%02x%02x%02x%02x" % (int(st[0]),int(st[1]),int(st[2]),int(st[3])),16)
+
+
+def int_to_dqn(st):
+    """
+    http://code.activestate.com/recipes/65219-ip-address-conversion-functions/#c3
+    Convert integer to dotted quad notation
+    """
+    st = "%08x" % (st)
+    ###
+    # The same issue as for `dqn_to_int()`
+    ###
+    return "%i.%i.%i.%i" % (int(st[0:2],16),int(st[2:4],16),int(st[4:6],16),int(st[6:8],16))
+
+
+def ip_to_int(address):
+    """
+    Convert IPv4 or IPv6 address to address family and integer, IPv4 as
+    `dqn_to_int()` does
+    "127.0.0.1" => (AF_INET, 2130706433), "::1" => (AF_INET6, 1)
+
+    Raises:
+        ValueError: if address is no IPv4 or IPv6 address.
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, address)
+    except (socket.error, TypeError):
+        raise ValueError('invalid ip address %r' % address)
+    if family == socket.AF_INET:
+        return family, struct.unpack('!I', packed)[0]
+    high, low = struct.unpack('!QQ', packed)
+    return family, high << 64 | low
+
+
+def parse_cidr(cidr):
+    """
+    Convert CIDR range to address family and first and last address as
+    integers, an address without prefix length is a range of one
+    "10.0.0.0/8" => (AF_INET, 167772160, 184549375)
+
+    Raises:
+        ValueError: if cidr is no IPv4 or IPv6 range.
+    """
+    address, _, length = cidr.partition('/')
+    family, start = ip_to_int(address)
+    bits = 32 if family == socket.AF_INET else 128
+    length = int(length) if length else bits
+    if not 0 <= length <= bits:
+        raise ValueError('invalid prefix length %r' % cidr)
+    size = 1 << (bits - length)
+    start &= ~(size - 1)
+    return family, start, start + size - 1
+
+
+class Message(object):
+    """ irc message, the result of parse_message.
+
+    Parsed once and shared by every handler. Prefix is only split into
+    nick, user and host, and IRCv3 message tags are only parsed, when one
+    of them is asked for.
+
+    Attributes:
+        raw: the line as retrieved from irc server.
+        prefix: origin of message, nick!user@host or server name, None if missing.
+        command: irc command or three digit numeric reply, upper case.
+        params: list of middle parameters.
+        trailing: trailing parameter without its ':', None if missing.
+    """
+
+    __slots__ = ('raw', 'prefix', 'command', 'params', 'trailing',
+                 '_nick', '_user', '_host', '_tags')
+
+    def __init__(self, raw, prefix, command, params, trailing, tags=None):
+        self.raw = raw
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+        self._nick = None
+        self._tags = tags
+
+    def __split_prefix(self):
+        """ splits prefix into nick, user and host."""
+
+        prefix = self.prefix or ''
+        nick, _, host = prefix.partition('@')
+        nick, _, user = nick.partition('!')
+        self._nick, self._user, self._host = nick, user, host
+
+    @property
+    def nick(self):
+        """ nick name (or server name) of prefix."""
+        if self._nick is None:
+            self.__split_prefix()
+        return self._nick
+
+    @property
+    def user(self):
+        """ username of prefix, '' if missing."""
+        if self._nick is None:
+            self.__split_prefix()
+        return self._user
+
+    @property
+    def host(self):
+        """ host of prefix, '' if missing."""
+        if self._nick is None:
+            self.__split_prefix()
+        return self._host
+
+    @property
+    def args(self):
+        """ list of all parameters, trailing included."""
+        if self.trailing is None:
+            return list(self.params)
+        return self.params + [self.trailing]
+
+    @property
+    def tags(self):
+        """ dict of IRCv3 message tags, key => value, '' for tags without value."""
+        tags = self._tags
+        if tags is None:
+            return {}
+        if not isinstance(tags, dict):
+            tags = self._tags = parse_tags(tags)
+        return tags
+
+    @property
+    def time(self):
+        """ time irc server got message from server-time tag, None if missing."""
+        if self._tags is None:
+            return None
+        stamp = self.tags.get('time')
+        return parse_server_time(stamp) if stamp else None
+
+    def __repr__(self):
+        return 'Message(%r)' % self.raw
+
+
+# escaped characters of IRCv3 message tag values, \: is ';' and \s is ' '.
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def parse_tags(tags):
+    """ parse IRCv3 message tags, the part between '@' and first space.
+
+    Returns:
+        dict of key => unescaped value, '' for tags without value.
+    """
+
+    parsed = {}
+    for tag in tags.split(';'):
+        key, _, value = tag.partition('=')
+        if '\\' in value:
+            chars = []
+            escaped = False
+            for char in value:
+                if escaped:
+                    chars.append(TAG_ESCAPES.get(char, char))
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                else:
+                    chars.append(char)
+            value = ''.join(chars)
+        if key:
+            parsed[key] = value
+    return parsed
+
+
+# seconds since epoch of dates of server-time tags, date => seconds.
+SERVER_DAYS = {}
+
+
+def parse_server_time(stamp):
+    """ seconds since epoch of server-time tag, e.g. 2024-05-01T12:30:00.250Z.
+
+    Start of day is only worked out once for each date.
+
+    Returns:
+        float, None if stamp is not a valid time.
+    """
+
+    try:
+        day = SERVER_DAYS.get(stamp[:10])
+        if day is None:
+            if len(SERVER_DAYS) > 1000:
+                SERVER_DAYS.clear()
+            day = SERVER_DAYS[stamp[:10]] = calendar.timegm(
+                (int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10]), 0, 0, 0))
+        seconds = day + int(stamp[11:13]) * 3600 + int(stamp[14:16]) * 60 + int(stamp[17:19])
+        if stamp[19:20] == '.':
+            seconds += float('0' + stamp[19:].rstrip('Z'))
+    except ValueError:
+        return None
+    return seconds
+
+
+def parse_message(line):
+    """ parse line from irc server into Message.
+
+    Follows the message format of RFC 1459 section 2.3.1,
+        [':' prefix SPACE] command params [SPACE ':' trailing],
+    optionally preceded by IRCv3 message tags, ['@' tags SPACE].
+    The line is walked once, ':' inside prefix or middle parameters
+    (ipv6 hosts, urls) is kept as it is and so are ':' inside trailing.
+    Tags are kept as they are until Message.tags is asked for.
+
+    Args:
+        line: message we want to parse, without '\r\n'.
+
+    Returns:
+        Message, or None if line has no command.
+    """
+
+    tags = None
+    prefix = None
+    start = 0
+
+    # retrieve message tags from message.
+    if line[:1] == '@':
+        start = line.find(' ')
+        if start == -1:
+            return None
+        tags = line[1:start]
+        while line[start:start+1] == ' ':
+            start += 1
+
+    # retrieve prefix from message.
+    if line[start:start+1] == ':':
+        end = line.find(' ', start)
+        if end == -1:
+            return None
+        prefix = line[start+1:end]
+        start = end
+
+    # retrieve trailing from message, it starts at first ' :'.
+    trailing = None
+    end = line.find(' :', start)
+    if end == -1:
+        params = line[start:].split()
+    else:
+        params = line[start:end].split()
+        trailing = line[end+2:]
+
+    # first word is the command.
+    if not params:
+        return None
+    return Message(line, prefix, params[0].upper(), params[1:], trailing, tags)
+
+
+class Batch(object):
+    """ messages of an IRCv3 BATCH, handled together when the batch ends.
+
+    Attributes:
+        reference: reference tag of batch, given by irc server.
+        type: type of batch, e.g. 'netsplit' or 'chathistory'.
+        params: parameters of batch, e.g. servers of netsplit.
+        messages: list of Message, and Batch for nested batches, in order.
+        nested: True if batch is part of another batch.
+    """
+
+    __slots__ = ('reference', 'type', 'params', 'messages', 'nested')
+
+    def __init__(self, reference, type, params, nested=False):
+        self.reference = reference
+        self.type = type
+        self.params = params
+        self.messages = []
+        self.nested = nested
+
+
+class LineBuffer(object):
+    """ splits data received from a socket into lines.
+
+    Data is received with recv_into straight into a preallocated bytearray
+    and scanned for line endings in place, so a line which straddles two
+    reads is never copied more than once. Lines end with '\r\n' or a bare
+    '\n'. Lines longer than max_line are thrown away.
+
+    Attributes:
+        buffer: preallocated receive buffer.
+        view: memoryview of buffer.
+        start: start of first incomplete line in buffer.
+        end: end of received data in buffer.
+        max_line: longest line we accept, without line ending.
+        discarding: True while we throw away rest of too long line.
+        dropped: number of too long lines thrown away.
+        received: number of bytes received.
+    """
+
+    # RFC 1459 allows 512 bytes, IRCv3 message tags add up to 8191 more.
+    MAX_LINE_LENGTH = 8704
+
+    def __init__(self, size=65536, max_line=MAX_LINE_LENGTH):
+        if size <= max_line + 2:
+            raise ValueError('buffer must be larger than max_line')
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.max_line = max_line
+        self.discarding = False
+        self.dropped = 0
+        self.received = 0
+
+    def recv_from(self, sock):
+        """ receive data from socket and split it into lines.
+
+        Args:
+            sock: socket which is readable.
+
+        Returns:
+            List of complete lines without line endings, None if
+            connection is closed.
+        """
+
+        # make room at end of buffer by moving incomplete line to front.
+        if self.end == len(self.buffer):
+            remainder = self.end - self.start
+            self.buffer[:remainder] = self.view[self.start:self.end]
+            self.start, self.end = 0, remainder
+
+        received = sock.recv_into(self.view[self.end:])
+        if not received:
+            return None
+        self.received += received
+
+        return self.__split(received)
+
+    def __split(self, received):
+        """ returns complete lines in buffer after received new bytes.
+
+        All complete lines are copied out of buffer in one piece and split
+        by str.splitlines, which keeps the per line work out of python.
+        """
+
+        buf = self.buffer
+        start = self.start
+        scan = self.end
+        end = self.end = scan + received
+        lines = []
+
+        # end of too long line we have been throwing away.
+        if self.discarding:
+            newline = buf.find('\n', scan, end)
+            if newline != -1:
+                self.discarding = False
+                start = scan = newline + 1
+
+        # copy and split every complete line at once.
+        if not self.discarding:
+            newline = buf.rfind('\n', scan, end)
+            if newline != -1:
+                chunk = self.view[start:newline].tobytes()
+                lines = chunk.splitlines()
+                start = newline + 1
+
+                # chunk can only hold too long line if chunk itself is too long,
+                # lengths are looked at in C before lines are looked at one by one.
+                if len(chunk) > self.max_line and max(map(len, lines)) > self.max_line:
+                    kept = [line for line in lines if len(line) <= self.max_line]
+                    self.dropped += len(lines) - len(kept)
+                    lines = kept
+
+        # incomplete line is too long, throw it away until next line ending.
+        # one byte more is allowed for '\r' of '\r\n'.
+        if end - start > self.max_line + 1:
+            if not self.discarding:
+                self.dropped += 1
+            self.discarding = True
+            start = end
+
+        # buffer is empty, start from front again.
+        if start == end:
+            start = self.end = 0
+        self.start = start
+
+        return lines
+
+
+def parse_log_line(line):
+    """ parse line of irc.log written by LogWriter.
+
+    Lines have the format Date : source (server/client) : message, where
+    messages of PRIVMSG and NOTICE are COMMAND channel nick : text or
+    COMMAND nick : text for private messages, and JOIN, PART and KICK
+    messages start with nick and name the channel, e.g.
+        JOIN nick just joined #channel
+        KICK nick was kicked from #channel by op : reason
+    Logs of older clients have nick!user@host where nick is, only the
+    nick is kept.
+
+    Returns:
+        Tuple of time, source, message, channel and nick, None if line
+        is not in that format.
+    """
+
+    parts = line.rstrip('\r\n').split(' : ', 2)
+    if len(parts) < 3:
+        return None
+    date, source, message = parts
+    try:
+        # dates are written in UTC, time zone is left out.
+        timestamp = calendar.timegm(time.strptime(date.rsplit(' ', 1)[0], '%a %d %b %Y %X'))
+    except ValueError:
+        return None
+
+    # private messages are kept with the nick we talk to.
+    channel = nick = ''
+    command, _, rest = message.partition(' ')
+    if command in ('PRIVMSG', 'NOTICE'):
+        words = rest.split(' : ', 1)[0].split(' ')
+        if len(words) == 2:
+            channel, nick = words
+        else:
+            channel = nick = words[0]
+    elif command in ('JOIN', 'PART', 'KICK'):
+        words = rest.split(' ')
+        nick, channel = words[0], words[4 if command == 'KICK' else -1]
+    nick = nick.partition('!')[0]
+    if channel[:1] not in '#&':
+        channel = channel.partition('!')[0]
+    return timestamp, source, message, channel, nick
+
+
+def parse_search_time(value):
+    """ parse time of /search, a date YYYY-mm-dd or time ago such as 30m, 12h or 7d."""
+
+    units = {'m': 60, 'h': 3600, 'd': 86400}
+    if value[-1:] in units and value[:-1].isdigit():
+        return time.time() - int(value[:-1]) * units[value[-1]]
+    return calendar.timegm(time.strptime(value, '%Y-%m-%d'))
+
+
+class ScrollbackStore(object):
+    """ indexed and compressed store of logged messages, kept in SQLite.
+
+    Messages are appended to the open segment of their day, network and
+    channel. Messages are indexed by time, by network and channel and by
+    nick, and their text by a full text index. When a day has passed its
+    segments are closed, the texts of each closed segment are compressed
+    into one block and the uncompressed copies are removed.
+
+    The store may be used from any thread, each thread gets a connection
+    of its own.
+
+    Attributes:
+        path: path of SQLite database.
+        segment_seconds: length of a segment in seconds.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY, time REAL, network INTEGER, channel INTEGER,
+            nick INTEGER, source INTEGER, segment INTEGER);
+        CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+        CREATE INDEX IF NOT EXISTS messages_channel ON messages (network, channel, time);
+        CREATE INDEX IF NOT EXISTS messages_nick ON messages (nick, time);
+        CREATE TABLE IF NOT EXISTS texts (id INTEGER PRIMARY KEY, text TEXT);
+        CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, data BLOB);
+        CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts4 (content="", text);
+    """
+
+    # number of decompressed segments kept in memory.
+    CACHED_SEGMENTS = 16
+
+    def __init__(self, path='scrollback.db', segment_seconds=86400):
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.__local = local()
+        self.__lock = thread.allocate_lock()
+        self.__names = {}
+        self.__segments = collections.OrderedDict()
+        connection = self.__connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(self.SCHEMA)
+        connection.commit()
+
+    def append(self, records):
+        """ append messages to store.
+
+        Args:
+            records: list of tuples of time, source, message, network,
+                channel and nick.
+        """
+
+        connection = self.__connection()
+        cursor = connection.cursor()
+        name = self.__name_id
+        for timestamp, source, message, network, channel, nick in records:
+            cursor.execute('INSERT INTO messages (time, network, channel, nick, source) VALUES (?, ?, ?, ?, ?)',
+                           (timestamp, name(network), name(irc_lower(channel)), name(irc_lower(nick)), name(source)))
+            id = cursor.lastrowid
+            text = message.decode('utf-8', 'replace').encode('utf-8')
+            cursor.execute('INSERT INTO texts (id, text) VALUES (?, ?)', (id, text))
+            cursor.execute('INSERT INTO search (docid, text) VALUES (?, ?)', (id, text))
+        connection.commit()
+
+    def close_segments(self, before=None):
+        """ closes and compresses segments which ended before time before.
+
+        Args:
+            before: time, defaults to start of current segment.
+        """
+
+        if before is None:
+            before = time.time() // self.segment_seconds * self.segment_seconds
+        connection = self.__connection()
+        rows = connection.execute(
+            'SELECT m.id, m.network, m.channel, CAST(m.time / ? AS INTEGER), t.text '
+            'FROM messages m JOIN texts t ON t.id = m.id '
+            'WHERE m.segment IS NULL AND m.time < ? ORDER BY m.id',
+            (self.segment_seconds, before)).fetchall()
+
+        # group messages into segments by network, channel and day.
+        segments = collections.OrderedDict()
+        for id, network, channel, day, text in rows:
+            segments.setdefault((network, channel, day), []).append((id, text))
+
+        for messages in segments.values():
+            ids = [id for id, text in messages]
+            data = zlib.compress(marshal.dumps((ids, [text for id, text in messages])), 6)
+            segment = connection.execute('INSERT INTO segments (data) VALUES (?)',
+                                         (sqlite3.Binary(data),)).lastrowid
+            connection.executemany('UPDATE messages SET segment = ? WHERE id = ?',
+                                   [(segment, id) for id in ids])
+            connection.executemany('DELETE FROM texts WHERE id = ?', [(id,) for id in ids])
+        connection.commit()
+        return len(segments)
+
+    def search(self, words=None, network=None, channel=None, nick=None,
+               since=None, until=None, limit=100):
+        """ search for messages, newest first.
+
+        Args:
+            words: full text query, e.g. 'release OR deploy', None for any text.
+            network: only messages of network.
+            channel: only messages of channel.
+            nick: only messages from nick.
+            since: only messages at or after this time.
+            until: only messages before this time.
+            limit: most messages returned.
+
+        Returns:
+            List of tuples of time, network, channel, nick, source and text.
+        """
+
+        connection = self.__connection()
+        conditions = []
+        arguments = []
+        for column, value in (('network', network), ('channel', channel), ('nick', nick)):
+            if value is not None:
+                if column != 'network':
+                    value = irc_lower(value)
+                id = self.__name_id(value, create=False)
+                if id is None:
+                    return []
+                conditions.append('m.%s = ?' % column)
+                arguments.append(id)
+        if since is not None:
+            conditions.append('m.time >= ?')
+            arguments.append(since)
+        if until is not None:
+            conditions.append('m.time < ?')
+            arguments.append(until)
+        if words:
+            conditions.append('m.id IN (SELECT docid FROM search WHERE search MATCH ?)')
+            arguments.append(words)
+
+        where = ' AND '.join(conditions) or '1'
+        rows = connection.execute(
+            'SELECT m.id, m.time, n.name, c.name, k.name, s.name, m.segment, t.text '
+            'FROM messages m '
+            'JOIN names n ON n.id = m.network JOIN names c ON c.id = m.channel '
+            'JOIN names k ON k.id = m.nick JOIN names s ON s.id = m.source '
+            'LEFT JOIN texts t ON t.id = m.id '
+            'WHERE %s ORDER BY m.time DESC LIMIT ?' % where, arguments + [limit]).fetchall()
+
+        results = []
+        for id, timestamp, network, channel, nick, source, segment, text in rows:
+            if text is None:
+                text = self.__segment(connection, segment).get(id, '')
+            results.append((timestamp, network, channel, nick, source, text))
+        return results
+
+    def import_log(self, path, network=''):
+        """ imports irc.log written by LogWriter, returns number of messages imported."""
+
+        count = 0
+        batch = []
+        log = open(path, 'rb')
+        try:
+            for line in log:
+                record = parse_log_line(line)
+                if record is None:
+                    continue
+                timestamp, source, message, channel, nick = record
+                batch.append((timestamp, source, message, network, channel, nick))
+                if len(batch) >= 10000:
+                    self.append(batch)
+                    count += len(batch)
+                    batch = []
+        finally:
+            log.close()
+        self.append(batch)
+        return count + len(batch)
+
+    def __connection(self):
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = self.__local.connection = sqlite3.connect(self.path)
+            connection.text_factory = str
+        return connection
+
+    def __name_id(self, name, create=True):
+        """ returns id of network, channel, nick or source name."""
+
+        id = self.__names.get(name)
+        if id is not None:
+            return id
+        connection = self.__connection()
+        row = connection.execute('SELECT id FROM names WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            if not create:
+                return None
+            id = connection.execute('INSERT INTO names (name) VALUES (?)', (name,)).lastrowid
+        else:
+            id = row[0]
+        self.__names[name] = id
+        return id
+
+    def __segment(self, connection, segment):
+        """ returns dict of id => text of closed segment."""
+
+        self.__lock.acquire()
+        try:
+            texts = self.__segments.pop(segment, None)
+        finally:
+            self.__lock.release()
+
+        if texts is None:
+            row = connection.execute('SELECT data FROM segments WHERE id = ?', (segment,)).fetchone()
+            texts = dict(zip(*marshal.loads(zlib.decompress(row[0])))) if row else {}
+
+        self.__lock.acquire()
+        try:
+            self.__segments[segment] = texts
+            while len(self.__segments) > self.CACHED_SEGMENTS:
+                self.__segments.popitem(last=False)
+        finally:
+            self.__lock.release()
+        return texts
+
+
+class LogWriter(object):
+    """ writes log messages to log file from its own thread.
+
+    Log messages are appended to a queue and the writer thread wakes up every
+    flush_interval seconds to format and write them in one batch, so logging
+    never waits on the disk or on the writer thread. Timestamps are
+    formatted once per second. Log file is flushed after every batch, and
+    synced to disk too if fsync is True.
+
+    Log file is rotated when it grows larger than max_bytes or when the day
+    changes, if rotate_daily is True. Rotated log files are renamed to
+    path.YYYYmmdd-HHMMSS and compressed with gzip if compress is True.
+
+    Log messages are also appended to store, a ScrollbackStore, if we have
+    one. Segments of store are closed when the day changes.
+
+    Attributes:
+        path: path of log file, None for no log file.
+        store: ScrollbackStore log messages are appended to, None for none.
+        flush_interval: seconds between flushes of log file.
+        fsync: sync log file to disk on every flush.
+        max_bytes: size at which log file is rotated, None for no limit.
+        rotate_daily: rotate log file when day changes.
+        compress: compress rotated log files.
+        queue: deque of log messages waiting to be written.
+    """
+
+    # format of timestamps in log file.
+    DATE_FORMAT = "%a %d %b %Y %X %z"
+
+    def __init__(self, path='irc.log', flush_interval=1.0, fsync=False,
+                 max_bytes=None, rotate_daily=False, compress=True, store=None):
+        self.path = path
+        self.store = store
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.compress = compress
+        self.queue = collections.deque()
+        self.__closing = Event()
+        self.__file = open(path, 'a', 65536) if path else None
+        self.__day = self.__today()
+        self.__store_day = None
+        self.__second = None
+        self.__date = None
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def write(self, type, message, network='', channel='', nick='', timestamp=None):
+        """ log message, safe to call from any thread.
+
+        Args:
+            type: source of message (server/client).
+            message: message we want to log.
+            network: irc server message is from, for store.
+            channel: channel message is from, for store.
+            nick: nick message is from, for store.
+            timestamp: time of message, defaults to now.
+        """
+
+        self.queue.append((timestamp or time.time(), type, message, network, channel, nick))
+
+    def write_many(self, records):
+        """ log many messages at once, safe to call from any thread.
+
+        Args:
+            records: list of tuples (timestamp, type, message, network,
+                channel, nick).
+        """
+
+        self.queue.extend(records)
+
+    def close(self):
+        """ writes waiting log messages and closes log file."""
+
+        if self.__thread.is_alive():
+            self.__closing.set()
+            self.__thread.join()
+
+    def __today(self):
+        return int(time.time() // 86400)
+
+    def __format(self, record):
+        """ format log message in the format Date : source (server/client) : message."""
+
+        timestamp, type, message = record[:3]
+
+        # only format the date when the second changes.
+        second = int(timestamp)
+        if second != self.__second:
+            self.__second = second
+            self.__date = time.strftime(self.DATE_FORMAT, time.gmtime(second))
+
+        return '%s : %s : %s\n' %(self.__date, type, message)
+
+    def __run(self):
+        """ writes log messages in batches until closed."""
+
+        queue = self.queue
+        running = True
+        while running:
+
+            # sleep until next flush, or until we are closed.
+            self.__closing.wait(self.flush_interval)
+            running = not self.__closing.is_set()
+
+            # take every log message waiting in queue.
+            batch = [queue.popleft() for i in xrange(len(queue))]
+
+            if batch and self.__file is not None:
+                self.__rotate_if_needed()
+                self.__file.write(''.join([self.__format(record) for record in batch]))
+                self.__flush()
+
+            if self.store is not None:
+                self.__store(batch)
+
+        if self.__file is not None:
+            self.__file.close()
+
+    def __store(self, batch):
+        """ appends batch to store, closes its segments when day changes."""
+
+        if batch:
+            self.store.append(batch)
+        today = self.__today()
+        if today != self.__store_day:
+            self.__store_day = today
+            self.store.close_segments()
+
+    def __flush(self):
+        self.__file.flush()
+        if self.fsync:
+            os.fsync(self.__file.fileno())
+
+    def __rotate_if_needed(self):
+        """ rotates log file if it is too large or day has changed."""
+
+        too_large = self.max_bytes is not None and self.__file.tell() >= self.max_bytes
+        new_day = self.rotate_daily and self.__today() != self.__day
+        if not (too_large or new_day):
+            return
+
+        # rename current log file and start a new one.
+        self.__flush()
+        self.__file.close()
+        rotated = '%s.%s' %(self.path, time.strftime('%Y%m%d-%H%M%S', time.gmtime()))
+        number = 0
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            number += 1
+            rotated = '%s.%s.%d' %(self.path, time.strftime('%Y%m%d-%H%M%S', time.gmtime()), number)
+        os.rename(self.path, rotated)
+        self.__file = open(self.path, 'a', 65536)
+        self.__day = self.__today()
+
+        # compress rotated log file.
+        if self.compress:
+            source = open(rotated, 'rb')
+            target = gzip.open(rotated + '.gz', 'wb')
+            shutil.copyfileobj(source, target)
+            target.close()
+            source.close()
+            os.remove(rotated)
+
+
+# size at which text log file of the client is rotated.
+LOG_MAX_BYTES = 16 << 20
+
+
+def default_log_writer(path=None, fsync=False):
+    """ returns log writer of the client, logging to scrollback store scrollback.db.
+
+    Args:
+        path: path of text log file besides the store, None for none. It is
+            rotated every day and at LOG_MAX_BYTES, rotated files are
+            compressed.
+        fsync: sync log file to disk on every flush.
+    """
+
+    return LogWriter(path, fsync=fsync, max_bytes=LOG_MAX_BYTES, rotate_daily=True,
+                     store=ScrollbackStore('scrollback.db'))
+
+
+class Counter(object):
+    """ value of a counter or gauge.
+
+    Attributes:
+        value: current value.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, amount=1):
+        self.value += amount
+
+
+class Histogram(object):
+    """ histogram of durations in seconds.
+
+    Buckets grow in powers of two from one microsecond, so recording a
+    duration is one bit_length and one list increment.
+
+    Attributes:
+        buckets: number of durations per bucket, bucket i holds durations
+            shorter than 2**i microseconds.
+        count: number of durations recorded.
+        sum: sum of durations recorded.
+        max: longest duration recorded.
+    """
+
+    __slots__ = ('buckets', 'count', 'sum', 'max')
+
+    # bit_length of microseconds in 64 bits.
+    BUCKETS = 64
+
+    # 2**26 microseconds is about 67 seconds, longer durations are only
+    # exported in the +Inf bucket.
+    EXPORTED = 27
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """ records a duration."""
+
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def bound(self, bucket):
+        """ upper bound of bucket in seconds."""
+
+        return (1 << bucket) / 1e6
+
+    def percentile(self, p):
+        """ upper bound of bucket holding the p-th percentile, in seconds."""
+
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min(self.bound(bucket), self.max)
+        return self.max
+
+
+class Metrics(object):
+    """ counters, gauges and histograms of the client.
+
+    Every series has a name and labels, a tuple of (label, value) pairs,
+    e.g. ('irc_handler_seconds', (('network', host), ('command', 'PRIVMSG'))).
+    Series are created on first use and callers keep them, so updating a
+    series on a hot path is one attribute or list update.
+
+    Metrics are read with snapshot and exported as JSON or Prometheus text
+    with to_json and to_prometheus.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.__lock = thread.allocate_lock()
+
+    def __series(self, table, factory, name, labels):
+        key = (name, labels)
+        try:
+            return table[key]
+        except KeyError:
+            with self.__lock:
+                return table.setdefault(key, factory())
+
+    def counter(self, name, labels=()):
+        """ returns Counter of series, which only ever grows."""
+
+        return self.__series(self.counters, Counter, name, labels)
+
+    def gauge(self, name, labels=()):
+        """ returns Counter of series, which is set to current value."""
+
+        return self.__series(self.gauges, Counter, name, labels)
+
+    def histogram(self, name, labels=()):
+        """ returns Histogram of series."""
+
+        return self.__series(self.histograms, Histogram, name, labels)
+
+    def snapshot(self):
+        """ returns copy of all series as dictionary.
+
+        Returns:
+            Dictionary with time, uptime and lists of counters, gauges and
+            histograms, every series a dictionary with name and labels.
+        """
+
+        with self.__lock:
+            counters = self.counters.items()
+            gauges = self.gauges.items()
+            histograms = self.histograms.items()
+
+        def series(key, **values):
+            values.update(name=key[0], labels=dict(key[1]))
+            return values
+
+        now = time.time()
+        return {
+            'time': now,
+            'uptime': now - self.started,
+            'counters': [series(key, value=counter.value) for key, counter in sorted(counters)],
+            'gauges': [series(key, value=gauge.value) for key, gauge in sorted(gauges)],
+            'histograms': [series(key, count=histogram.count, sum=histogram.sum,
+                                  max=histogram.max, buckets=list(histogram.buckets))
+                           for key, histogram in sorted(histograms)],
+        }
+
+    def to_json(self):
+        """ returns snapshot as JSON text."""
+
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def to_prometheus(self):
+        """ returns snapshot in Prometheus text exposition format."""
+
+        def labels(series, extra=()):
+            pairs = sorted(series['labels'].items()) + list(extra)
+            if not pairs:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for key, value in pairs)
+
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for kind, table in (('counter', 'counters'), ('gauge', 'gauges')):
+            for series in snapshot[table]:
+                if series['name'] not in typed:
+                    typed.add(series['name'])
+                    lines.append('# TYPE %s %s' % (series['name'], kind))
+                lines.append('%s%s %s' % (series['name'], labels(series), series['value']))
+        for series in snapshot['histograms']:
+            name = series['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            seen = 0
+            for bucket, count in enumerate(series['buckets'][:Histogram.EXPORTED]):
+                seen += count
+                lines.append('%s_bucket%s %d' % (name, labels(series, [('le', '%g' % ((1 << bucket) / 1e6))]), seen))
+            lines.append('%s_bucket%s %d' % (name, labels(series, [('le', '+Inf')]), series['count']))
+            lines.append('%s_sum%s %r' % (name, labels(series), series['sum']))
+            lines.append('%s_count%s %d' % (name, labels(series), series['count']))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class MetricsExporter(object):
+    """ writes metrics to files every interval seconds from its own thread.
+
+    Files are written to a temporary file first and renamed, so readers
+    never see half a file.
+
+    Attributes:
+        metrics: Metrics to export.
+        json_path: path of JSON file, None for none.
+        prometheus_path: path of Prometheus text file, None for none.
+        interval: seconds between exports.
+    """
+
+    def __init__(self, metrics=METRICS, json_path=None, prometheus_path=None, interval=10.0):
+        self.metrics = metrics
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.__closing = Event()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def export(self):
+        """ writes metrics files now."""
+
+        for path, text in ((self.json_path, self.metrics.to_json),
+                           (self.prometheus_path, self.metrics.to_prometheus)):
+            if path:
+                with open(path + '.tmp', 'w') as output:
+                    output.write(text())
+                os.rename(path + '.tmp', path)
+
+    def close(self):
+        """ writes metrics files one last time and stops exporting."""
+
+        if self.__thread.is_alive():
+            self.__closing.set()
+            self.__thread.join()
+
+    def __run(self):
+        while not self.__closing.wait(self.interval):
+            self.export()
+        self.export()
+
+
+class SamplingProfiler(object):
+    """ attributes time of a thread to the handlers it runs by sampling.
+
+    A thread of its own looks at the stack of the profiled thread every
+    interval seconds. A sample is attributed to the handler dispatch has
+    called, otherwise to the step of the engine loop running, or to select
+    when the engine waits. Nothing is sampled while the profiler is stopped.
+
+    Attributes:
+        interval: seconds between samples.
+        handlers: number of samples per handler.
+        functions: number of samples per innermost function.
+        samples: number of samples taken.
+        running: True while profiler samples.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.handlers = collections.Counter()
+        self.functions = collections.Counter()
+        self.samples = 0
+        self.running = False
+        self.started = None
+        self.stopped = None
+
+    def start(self, ident=None):
+        """ starts sampling thread with ident, defaults to calling thread."""
+
+        if self.running:
+            return
+        self.running = True
+        self.started = time.time()
+        self.stopped = None
+        thread.start_new_thread(self.__run, (ident or thread.get_ident(),))
+
+    def stop(self):
+        """ stops sampling, samples are kept for report."""
+
+        self.running = False
+        self.stopped = time.time()
+
+    def clear(self):
+        """ throws away samples taken."""
+
+        self.handlers.clear()
+        self.functions.clear()
+        self.samples = 0
+
+    def __run(self, ident):
+        # handlers are called by __handle, batch handlers by handle_batch,
+        # console commands by __dispatch.
+        callers = (IrcClient._IrcClient__dispatch.__func__.__code__,
+                   IrcClient._IrcClient__handle.__func__.__code__,
+                   IrcClient.handle_batch.__func__.__code__)
+        engine = IrcEngine.run.__func__.__code__
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(ident)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.functions['%s:%d %s' % (os.path.basename(frame.f_code.co_filename),
+                                         frame.f_lineno, frame.f_code.co_name)] += 1
+
+            # walk out to the handler dispatch called or the engine step.
+            handler = 'select' if frame.f_code is engine else 'other'
+            while frame.f_back is not None and handler == 'other':
+                if frame.f_back.f_code in callers or frame.f_back.f_code is engine:
+                    handler = frame.f_code.co_name.replace('_IrcClient__', '__')
+                frame = frame.f_back
+            self.handlers[handler] += 1
+            frame = None
+
+    def report(self, top=10):
+        """ returns lines with share of samples per handler and hottest functions."""
+
+        if not self.samples:
+            return ['no samples']
+        busy = self.samples - self.handlers['select']
+        ended = self.stopped or time.time()
+        lines = ['%d samples in %.1f s, %.1f%% busy' % (
+            self.samples, ended - self.started, 100.0 * busy / self.samples)]
+        for handler, samples in self.handlers.most_common():
+            if handler != 'select':
+                lines.append('  %-40s %6.1f%% of busy' % (handler, 100.0 * samples / max(busy, 1)))
+        lines.append('hottest lines')
+        for function, samples in self.functions.most_common(top):
+            lines.append('  %-40s %6.1f%%' % (function, 100.0 * samples / self.samples))
+        return lines
+
+
+PROFILER = SamplingProfiler()
+
+
+class TokenBucket(object):
+    """ token bucket for rate limiting.
+
+    Holds up to burst tokens and gains rate tokens per second.
+
+    Attributes:
+        rate: tokens gained per second.
+        burst: most tokens bucket can hold.
+        tokens: tokens in bucket, may be below 0 after spend.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def __refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """ returns seconds until bucket has a token, 0 if it has one now."""
+
+        self.__refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """ takes a token if bucket has one, returns True if it did."""
+
+        self.__refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def spend(self, now):
+        """ takes a token even when bucket is empty."""
+
+        self.__refill(now)
+        self.tokens -= 1
+
+    def take_some(self, now, wanted):
+        """ takes up to wanted tokens, returns how many it took."""
+
+        self.__refill(now)
+        taken = min(wanted, int(self.tokens))
+        if taken > 0:
+            self.tokens -= taken
+            return taken
+        return 0
+
+
+class BandwidthScheduler(object):
+    """ shares bandwidth between DCC transfers, safe to use from any thread.
+
+    Every transfer asks for permission before it sends or receives a chunk,
+    so all transfers together stay below rate bytes per second and leave
+    room for the irc server connections.
+
+    Attributes:
+        rate: bytes per second for all transfers together, None for no limit.
+    """
+
+    def __init__(self, rate=None):
+        self.__lock = thread.allocate_lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """ changes bandwidth limit, None for no limit."""
+
+        self.__lock.acquire()
+        try:
+            self.rate = rate
+            # bucket holds a quarter of a second of traffic.
+            self.__bucket = TokenBucket(rate, max(rate / 4, 1)) if rate else None
+        finally:
+            self.__lock.release()
+
+    def grant(self, wanted):
+        """ waits until we may move some bytes, returns how many, at most wanted."""
+
+        while True:
+            self.__lock.acquire()
+            try:
+                bucket = self.__bucket
+                if bucket is None:
+                    return wanted
+                now = time.time()
+                granted = bucket.take_some(now, wanted)
+                if granted:
+                    return granted
+                delay = bucket.delay(now)
+            finally:
+                self.__lock.release()
+            time.sleep(delay)
+
+
+# bandwidth of DCC transfers, shared by every client in process.
+DCC_BANDWIDTH = BandwidthScheduler()
+
+
+class SendQueue(object):
+    """ outbound queue of one irc server connection with flood control.
+
+    Lines of PRIORITY_COMMANDS (PONG, QUIT, registration) are sent as soon
+    as possible. Other lines wait until the token bucket of the connection
+    and the token bucket of their target (nick or channel of PRIVMSG and
+    NOTICE) both have a token. Targets take turns, so a script flooding one
+    channel does not hold back lines to other targets.
+
+    Attributes:
+        rate, burst: token bucket of connection, lines per second and
+            lines sent at once. rate None turns flood control off.
+        target_rate, target_burst: token bucket of each target.
+        depth: number of lines waiting in queue.
+    """
+
+    PRIORITY_COMMANDS = frozenset(['PONG', 'QUIT', 'PASS', 'NICK', 'USER', 'CAP'])
+
+    def __init__(self, rate=2.0, burst=10, target_rate=1.0, target_burst=5):
+        self.rate = rate
+        self.burst = burst
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self.depth = 0
+        self.__urgent = collections.deque()
+        self.__targets = collections.OrderedDict()
+        self.__bucket = TokenBucket(rate, burst) if rate else None
+        self.__target_buckets = {}
+
+    def push(self, line):
+        """ add line to queue, without '\r\n'."""
+
+        command, _, rest = line.partition(' ')
+        command = command.upper()
+        if command in self.PRIORITY_COMMANDS:
+            self.__urgent.append(line)
+        else:
+            target = ''
+            if command == 'PRIVMSG' or command == 'NOTICE':
+                target = rest.partition(' ')[0].lower()
+            lines = self.__targets.get(target)
+            if lines is None:
+                lines = self.__targets[target] = collections.deque()
+            lines.append(line)
+        self.depth += 1
+
+    def pop(self, now=None):
+        """ returns list of lines we may send now, in order of sending."""
+
+        now = now or time.time()
+        bucket = self.__bucket
+
+        # priority lines always go, they only use up tokens of connection.
+        lines = list(self.__urgent)
+        self.__urgent.clear()
+        if bucket is not None:
+            for line in lines:
+                bucket.spend(now)
+
+        # targets take turns, one line each, while connection has tokens.
+        progress = True
+        while self.__targets and progress:
+            progress = False
+            for target in self.__targets.keys():
+                if bucket is not None and bucket.delay(now) > 0:
+                    progress = False
+                    break
+                target_bucket = self.__target_bucket(target)
+                if target_bucket is not None and not target_bucket.take(now):
+                    continue
+                if bucket is not None:
+                    bucket.take(now)
+
+                # move target to end of line.
+                queue = self.__targets.pop(target)
+                lines.append(queue.popleft())
+                if queue:
+                    self.__targets[target] = queue
+                progress = True
+
+        self.depth -= len(lines)
+        return lines
+
+    def refill(self):
+        """ connection is new, irc server has forgotten what we sent before.
+
+        Token buckets are full again, lines waiting in queue are kept.
+        """
+
+        self.__bucket = TokenBucket(self.rate, self.burst) if self.rate else None
+        self.__target_buckets.clear()
+
+    def pop_all(self):
+        """ returns every line in queue, flood control is ignored."""
+
+        lines = list(self.__urgent)
+        self.__urgent.clear()
+        for queue in self.__targets.values():
+            lines.extend(queue)
+        self.__targets.clear()
+        self.depth = 0
+        return lines
+
+    def delay(self, now=None):
+        """ throttling delay, seconds until next line may be sent.
+
+        Returns:
+            0 if a line may be sent now, None if queue is empty.
+        """
+
+        if not self.depth:
+            return None
+        if self.__urgent:
+            return 0.0
+        now = now or time.time()
+        delay = min([self.__target_delay(target, now) for target in self.__targets])
+        if self.__bucket is not None:
+            delay = max(delay, self.__bucket.delay(now))
+        return delay
+
+    def __target_bucket(self, target):
+        """ returns token bucket of target, None if target is not throttled."""
+
+        if not target or not self.target_rate:
+            return None
+        bucket = self.__target_buckets.get(target)
+        if bucket is None:
+            bucket = self.__target_buckets[target] = TokenBucket(self.target_rate, self.target_burst)
+        return bucket
+
+    def __target_delay(self, target, now):
+        bucket = self.__target_bucket(target)
+        return bucket.delay(now) if bucket is not None else 0.0
+
+
+# lines irc server wants handled right away, PING, PONG and ERROR, after
+# optional message tags and prefix.
+CONTROL_LINE = re.compile(r'(?:@\S+ +)?(?::\S+ +)?(?:PING|PONG|ERROR)(?: |$)')
+
+
+def line_command(line):
+    """ returns command and first parameter of raw line from irc server."""
+
+    words = line.split(' ', 4)
+    i = 0
+    if words[i][:1] == '@':
+        i += 1
+    if i < len(words) and words[i][:1] == ':':
+        i += 1
+    command = words[i].upper() if i < len(words) else ''
+    target = words[i + 1] if i + 1 < len(words) else ''
+    return command, target
+
+
+class MessageQueue(object):
+    """ inbound queue of one client, with priority lanes and bounded memory.
+
+    Console input and lines the client queues for itself go into the
+    console lane, which is kept apart from server traffic, only its lines
+    are taken as console commands. PING, PONG and ERROR from irc server go
+    into the control lane, which is handled first of server traffic. The
+    rest of server traffic goes into the bulk lane, which holds at most
+    max_lines lines in memory. When it is full, policy decides:
+
+        drop-oldest: PRIVMSG and NOTICE lines of the oldest part of bulk
+            lane are dropped.
+        coalesce: only the last PRIVMSG or NOTICE to each target of the
+            oldest part of bulk lane is kept.
+        spill: new lines are written to a spill file on disk and read back,
+            in order, when bulk lane has room.
+
+    Other lines, such as JOIN, PART, MODE and NAMES replies, are never
+    dropped, IrcState depends on them. They may take bulk lane past
+    max_lines. Safe to use from any thread.
+
+    Attributes:
+        max_lines: most lines bulk lane holds in memory.
+        policy: one of POLICIES.
+        depth: number of lines waiting, spilled lines included.
+        dropped: number of lines dropped or coalesced away.
+        spilled: number of lines written to spill file.
+    """
+
+    POLICIES = ('drop-oldest', 'coalesce', 'spill')
+    CHAT_COMMANDS = frozenset(['PRIVMSG', 'NOTICE'])
+
+    # bytes read back from spill file at once.
+    SPILL_CHUNK = 1 << 20
+
+    def __init__(self, max_lines=100000, policy='spill'):
+        if policy not in self.POLICIES:
+            raise ValueError('unknown overflow policy %s' % policy)
+        self.max_lines = max_lines
+        self.policy = policy
+        self.depth = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.__console = collections.deque()
+        self.__control = collections.deque()
+        self.__kept = collections.deque()
+        self.__fresh = collections.deque()
+        self.__spill = None
+        self.__spill_lines = 0
+        self.__spill_read = 0
+        self.__lock = thread.allocate_lock()
+
+    def put(self, message):
+        """ add console input or line of client to console lane."""
+
+        with self.__lock:
+            self.__console.append(message)
+            self.depth += 1
+
+    def put_lines(self, lines):
+        """ add lines from irc server, control lines go to control lane."""
+
+        control = filter(CONTROL_LINE.match, lines)
+        if control:
+            lines = [line for line in lines if not CONTROL_LINE.match(line)]
+
+        with self.__lock:
+            self.__control.extend(control)
+            self.depth += len(control) + len(lines)
+
+            # once we spill, everything spills until spill file is read back.
+            if self.__spill_lines or (self.policy == 'spill' and
+                                      len(self.__kept) + len(self.__fresh) + len(lines) > self.max_lines):
+                self.__write_spill(lines)
+                return
+
+            self.__fresh.extend(lines)
+            if len(self.__kept) + len(self.__fresh) > self.max_lines:
+                self.__overflow()
+
+    def pop_console(self, limit):
+        """ returns up to limit lines of console lane."""
+
+        with self.__lock:
+            lines = []
+            while self.__console and len(lines) < limit:
+                lines.append(self.__console.popleft())
+            self.depth -= len(lines)
+            return lines
+
+    def pop(self, limit):
+        """ returns up to limit lines from irc server in the order they
+        should be handled."""
+
+        with self.__lock:
+            lines = []
+            for lane in (self.__control, self.__kept, self.__fresh):
+                while lane and len(lines) < limit:
+                    lines.append(lane.popleft())
+
+            # bulk lane is empty, read spilled lines back.
+            if not self.__kept and not self.__fresh and self.__spill_lines:
+                self.__read_spill()
+                while self.__fresh and len(lines) < limit:
+                    lines.append(self.__fresh.popleft())
+
+            self.depth -= len(lines)
+            return lines
+
+    def __overflow(self):
+        """ drops or coalesces chat lines from oldest end of bulk lane."""
+
+        while self.__fresh and len(self.__kept) + len(self.__fresh) > self.max_lines:
+            # coalesce a quarter of the lane at a time, drop only what is too much.
+            excess = len(self.__kept) + len(self.__fresh) - self.max_lines
+            if self.policy == 'coalesce':
+                excess = max(excess, self.max_lines // 4)
+            oldest = [self.__fresh.popleft() for i in xrange(min(len(self.__fresh), excess))]
+            if self.policy == 'coalesce':
+                kept = self.__coalesce(oldest)
+            else:
+                kept = [line for line in oldest if line_command(line)[0] not in self.CHAT_COMMANDS]
+            self.__kept.extend(kept)
+            self.dropped += len(oldest) - len(kept)
+            self.depth -= len(oldest) - len(kept)
+
+    def __coalesce(self, lines):
+        """ returns lines with only the last chat line to every target."""
+
+        last = {}
+        for i, line in enumerate(lines):
+            command, target = line_command(line)
+            if command in self.CHAT_COMMANDS:
+                last[target.lower()] = i
+        keep = set(last.values())
+        return [line for i, line in enumerate(lines)
+                if i in keep or line_command(line)[0] not in self.CHAT_COMMANDS]
+
+    def __write_spill(self, lines):
+        if not lines:
+            return
+        if self.__spill is None:
+            self.__spill = tempfile.TemporaryFile(prefix='irc-spill-')
+        self.__spill.seek(0, os.SEEK_END)
+        self.__spill.write('\n'.join(lines) + '\n')
+        self.__spill_lines += len(lines)
+        self.spilled += len(lines)
+
+    def __read_spill(self):
+        """ moves next chunk of spill file into bulk lane."""
+
+        self.__spill.seek(self.__spill_read)
+        data = self.__spill.read(self.SPILL_CHUNK)
+        end = data.rfind('\n') + 1
+        if not end:
+            # line longer than chunk, read on to its end.
+            data += self.__spill.readline()
+            end = len(data)
+        lines = data[:end].split('\n')[:-1]
+        self.__fresh.extend(lines)
+        self.__spill_lines -= len(lines)
+        self.__spill_read += end
+
+        # everything is read back, start over with empty spill file.
+        if not self.__spill_lines:
+            self.__spill.seek(0)
+            self.__spill.truncate()
+            self.__spill_read = 0
+
+
+class HandlerPool(object):
+    """ runs slow handlers on worker threads, so they never hold up the engine.
+
+    Every task has a key, e.g. network and channel. Tasks with the same key
+    go to the same worker and run one after another in the order they were
+    submitted, tasks with other keys run in parallel.
+
+    A task which runs longer than timeout is abandoned. Python can not stop
+    a thread, so its worker is retired and ends when the task returns, and a
+    new worker takes over the rest of its queue. Tasks which waited longer
+    than max_wait in queue are skipped, so a backlog behind a slow handler
+    does not grow without end.
+
+    Attributes:
+        workers: number of workers.
+        timeout: seconds a task may run.
+        max_wait: seconds a task may wait in queue.
+        report: function called with text of failed and abandoned tasks,
+            failures with their traceback. Called from worker threads.
+        completed: number of tasks run.
+        failed: number of tasks which raised an exception.
+        timed_out: number of tasks abandoned while running.
+        expired: number of tasks skipped after waiting too long.
+    """
+
+    def __init__(self, workers=4, timeout=10.0, max_wait=60.0, report=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.report = report
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.expired = 0
+        self.__counts = thread.allocate_lock()
+        self.__queues = [Queue.Queue() for i in xrange(workers)]
+        self.__tokens = [None] * workers
+        self.__running = [None] * workers
+        self.__closing = Event()
+        for shard in xrange(workers):
+            self.__start_worker(shard)
+        thread.start_new_thread(self.__watch, ())
+
+    def submit(self, key, function, *args):
+        """ queue function to be called with args after earlier tasks of key."""
+
+        self.__queues[hash(key) % self.workers].put((time.time(), function, args))
+
+    def depth(self):
+        """ number of tasks waiting."""
+
+        return sum(queue.qsize() for queue in self.__queues)
+
+    def close(self):
+        """ stops workers when they have run tasks already queued."""
+
+        self.__closing.set()
+        for queue in self.__queues:
+            queue.put(None)
+
+    def __start_worker(self, shard):
+        token = object()
+        self.__tokens[shard] = token
+        thread.start_new_thread(self.__work, (shard, token))
+
+    def __work(self, shard, token):
+        """ runs tasks of shard until pool closes or worker is retired."""
+
+        queue = self.__queues[shard]
+        while self.__tokens[shard] is token:
+            task = queue.get()
+            if task is None:
+                return
+            submitted, function, args = task
+            started = time.time()
+            if started - submitted > self.max_wait:
+                with self.__counts:
+                    self.expired += 1
+                continue
+
+            self.__running[shard] = (started, function)
+            try:
+                function(*args)
+            except Exception:
+                with self.__counts:
+                    self.failed += 1
+                if self.report is not None:
+                    self.report( 'handler %s failed : %s' %(getattr(function, '__name__', function),
+                                                           traceback.format_exc().rstrip()) )
+            with self.__counts:
+                self.completed += 1
+
+            # watch may have retired us while task ran, new worker has queue now.
+            if self.__tokens[shard] is token:
+                self.__running[shard] = None
+
+    def __watch(self):
+        """ retires workers whose task runs longer than timeout."""
+
+        while not self.__closing.wait(self.timeout / 4):
+            now = time.time()
+            for shard, running in enumerate(self.__running):
+                if running is None or now - running[0] <= self.timeout:
+                    continue
+                self.__running[shard] = None
+                with self.__counts:
+                    self.timed_out += 1
+                self.__start_worker(shard)
+                if self.report is not None:
+                    self.report( 'handler %s timed out after %.1f s' %(
+                        getattr(running[1], '__name__', running[1]), now - running[0]) )
+
+
+class ConsoleRenderer(object):
+    """ writes console output in frames from its own thread.
+
+    Output is appended to a queue and the renderer thread writes everything
+    waiting in one write per frame, at most fps frames per second, and
+    redraws the readline prompt once per frame. When a frame would hold more
+    than max_lines lines, only the last max_lines are written, led by a
+    line telling how many were left out, they are still in the log.
+
+    Attributes:
+        stream: file output is written to.
+        fps: most frames per second.
+        max_lines: most lines in one frame, None for no limit.
+        prompt: redraw '> ' and readline buffer after every frame.
+        show_network: lead every line with network it is from.
+        skipped: number of lines left out.
+        queue: deque of (time, network, text) waiting to be written.
+    """
+
+    def __init__(self, stream=None, fps=30, max_lines=2000, prompt=True):
+        self.stream = stream
+        self.fps = fps
+        self.max_lines = max_lines
+        self.prompt = prompt
+        self.show_network = False
+        self.skipped = 0
+        self.queue = collections.deque()
+        self.__pending = Event()
+        self.__closing = False
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def write(self, network, text):
+        """ queue line of output, safe to call from any thread."""
+
+        self.queue.append((time.time(), network, text))
+        if self.__closing:
+            self.__frame()
+        elif not self.__pending.is_set():
+            self.__pending.set()
+
+    def close(self):
+        """ writes output still waiting and stops renderer thread."""
+
+        if self.__thread.is_alive():
+            self.__closing = True
+            self.__pending.set()
+            self.__thread.join()
+
+    def format(self, record):
+        """ returns text of record as written, without line ending."""
+
+        timestamp, network, text = record
+        if self.show_network:
+            return '[%s] %s' %(network, text)
+        return str(text)
+
+    def render(self, lines):
+        """ writes frame of formatted lines."""
+
+        text = '\n'.join(lines) + '\n'
+        if self.prompt:
+            buffer = readline.get_line_buffer() if readline is not None else ''
+            text = '\r%s\r%s> %s' %(' ' * (len(buffer) + 2), text, buffer)
+        stream = self.stream or sys.stdout
+        stream.write(text)
+        stream.flush()
+
+    def __frame(self):
+        """ writes everything waiting as one frame."""
+
+        records = []
+        queue = self.queue
+        while queue:
+            records.append(queue.popleft())
+        if not records:
+            return
+        lines = []
+        if self.max_lines is not None and len(records) > self.max_lines:
+            skipped = len(records) - self.max_lines
+            self.skipped += skipped
+            records = records[skipped:]
+            lines.append('... %d lines not shown, they are in the log' % skipped)
+        lines.extend(self.format(record) for record in records)
+        self.render(lines)
+
+    def __run(self):
+        """ writes a frame when output is waiting, no more than fps times a second."""
+
+        interval = 1.0 / self.fps
+        while not self.__closing:
+            self.__pending.wait()
+            self.__pending.clear()
+            begin = time.time()
+            self.__frame()
+
+            # output which comes in meanwhile waits for next frame.
+            delay = begin + interval - time.time()
+            if delay > 0 and not self.__closing:
+                time.sleep(delay)
+        self.__frame()
+
+
+class JsonLinesRenderer(ConsoleRenderer):
+    """ writes console output as JSON lines, for running without a terminal.
+
+    Every line is an object with time, network and text. There is no
+    prompt and nothing is left out.
+    """
+
+    def __init__(self, stream=None, fps=10):
+        ConsoleRenderer.__init__(self, stream, fps, None, False)
+
+    def format(self, record):
+        timestamp, network, text = record
+        # only text of messages is recoded, other lines may not be UTF-8.
+        text = str(text).decode('utf-8', 'replace')
+        return json.dumps({'time': timestamp, 'network': network, 'text': text})
+
+
+def split_ctcp(text):
+    """ split arguments of ctcp message, "quoted arguments" may hold spaces.
+
+    Args:
+        text: ctcp message without its '\001'.
+
+    Returns:
+        List of arguments.
+    """
+
+    words = []
+    rest = text.strip()
+    while rest:
+        if rest[0] == '"' and '"' in rest[1:]:
+            word, _, rest = rest[1:].partition('"')
+        else:
+            word, _, rest = rest.partition(' ')
+        words.append(word)
+        rest = rest.lstrip()
+    return words
+
+
+def quote_ctcp(word):
+    """ quotes argument of ctcp message if it holds spaces."""
+
+    if ' ' in word:
+        return '"%s"' % word
+    return word
+
+
+def safe_filename(filename):
+    """ turns filename offered by peer into a name safe to create locally.
+
+    Directories, control characters and leading dots are removed, so peer
+    can not make us write outside of download directory or a hidden file.
+    """
+
+    filename = filename.replace('\\', '/').split('/')[-1]
+    filename = ''.join(c for c in filename if ord(c) >= 32 and c not in '<>:"|?*')
+    filename = filename.strip().lstrip('.')
+    return filename or 'download'
+
+
+class DccReceive(object):
+    """ receives file offered with DCC SEND, runs in a thread of its own.
+
+    Data is received with recv_into into one large buffer and written
+    straight from it, the output file is allocated to its full size
+    before we start. With standard DCC we acknowledge every received chunk
+    with the number of bytes received so far, as a 32 bit network order
+    integer. Senders using turbo DCC (TSEND) do not wait for those.
+
+    Attributes:
+        nick: nick name of sender.
+        filename: name of file as offered by sender.
+        path: where file is written, inside download directory.
+        address: ip address and port of sender.
+        size: size of file, 0 if unknown.
+        turbo: True if sender does not want acknowledgements.
+        offset: bytes of file we had before transfer, when resuming.
+        bandwidth: BandwidthScheduler shared with other transfers.
+        received: bytes of file we have so far.
+        started: time transfer started.
+        ended: time transfer ended.
+        finished: True when transfer has ended.
+        error: reason transfer failed, None if it did not.
+    """
+
+    BUFFER_SIZE = 256 * 1024
+
+    # seconds we wait for sender to take our connection.
+    CONNECT_TIMEOUT = 30
+
+    # seconds we wait for data before we give up on sender.
+    RECEIVE_TIMEOUT = 60
+
+    # seconds between progress reports.
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, nick, filename, ip, port, size, directory='downloads',
+                 turbo=False, report=None, done=None, path=None, offset=0,
+                 bandwidth=DCC_BANDWIDTH):
+        """
+        Args:
+            nick: nick name of sender.
+            filename: name of file as offered by sender.
+            ip: ip address of sender as integer.
+            port: port of sender.
+            size: size of file, 0 if unknown.
+            directory: download directory.
+            turbo: True if sender does not want acknowledgements.
+            report: function called with progress messages.
+            done: function called with transfer when it has ended.
+            path: file to resume, None for a new file in directory.
+            offset: bytes of file we already have when resuming.
+            bandwidth: BandwidthScheduler shared with other transfers.
+        """
+        self.nick = nick
+        self.filename = filename
+        self.path = path or self.__unique_path(directory, safe_filename(filename))
+        self.address = (int_to_dqn(ip), port)
+        self.size = size
+        self.turbo = turbo
+        self.offset = offset
+        self.bandwidth = bandwidth
+        self.received = offset
+        self.started = None
+        self.ended = None
+        self.finished = False
+        self.error = None
+        self.__report = report or (lambda message: None)
+        self.__done = done or (lambda transfer: None)
+
+    def start(self):
+        """ starts transfer in a new thread."""
+
+        thread.start_new_thread(self.run, ())
+
+    def rate(self):
+        """ average throughput so far in bytes per second."""
+
+        if not self.started:
+            return 0.0
+        return (self.received - self.offset) / max((self.ended or time.time()) - self.started, 1e-6)
+
+    def progress(self):
+        """ progress of transfer as readable text."""
+
+        percent = 100.0 * self.received / self.size if self.size else 0.0
+        return '%s from %s : %d/%d bytes (%.1f%%) %.1f kB/s' %(
+            self.filename, self.nick, self.received, self.size, percent, self.rate() / 1024)
+
+    def run(self):
+        """ connects to sender and receives file."""
+
+        try:
+            sock = socket.create_connection(self.address, self.CONNECT_TIMEOUT)
+        except socket.error as e:
+            self.error = 'failed to connect to your host'
+            self.finished = True
+            self.__done(self)
+            return
+
+        # a sender which stops sending does not hold thread for ever.
+        sock.settimeout(self.RECEIVE_TIMEOUT)
+        try:
+            self.__receive(sock)
+        except socket.timeout:
+            self.error = 'nothing received of %s for %d seconds' %(self.filename, self.RECEIVE_TIMEOUT)
+        except (socket.error, IOError) as e:
+            self.error = str(e)
+        finally:
+            sock.close()
+
+        if self.error is None and self.received < self.size:
+            self.error = 'failed to recieve %s' % self.filename
+        self.ended = time.time()
+        self.finished = True
+        self.__done(self)
+
+    def __receive(self, sock):
+        """ receives file until sender is done or closes connection."""
+
+        buf = bytearray(self.BUFFER_SIZE)
+        view = memoryview(buf)
+        size = self.size
+        grant = self.bandwidth.grant
+
+        # resumed file is written from where it ended.
+        if self.offset:
+            new_file = open(self.path, 'r+b')
+            new_file.seek(self.offset)
+        else:
+            new_file = open(self.path, 'wb')
+        try:
+            # allocate file to full size.
+            if size:
+                new_file.truncate(size)
+
+            self.started = last_report = time.time()
+            received = self.offset
+            while not size or received < size:
+                wanted = min(len(buf), size - received) if size else len(buf)
+                count = sock.recv_into(view, grant(wanted))
+                if not count:
+                    break
+                new_file.write(view[:count])
+                received += count
+                self.received = received
+
+                # acknowledge bytes received so far.
+                if not self.turbo:
+                    sock.sendall(struct.pack('!I', received & 0xffffffff))
+
+                now = time.time()
+                if now - last_report >= self.PROGRESS_INTERVAL:
+                    last_report = now
+                    self.__report(self.progress())
+
+            # file was smaller than we were told, cut allocated end away.
+            if received < size:
+                new_file.truncate(received)
+        finally:
+            new_file.close()
+
+    def __unique_path(self, directory, filename):
+        """ returns path for filename in directory which is not taken."""
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, filename)
+        number = 0
+        while os.path.exists(path):
+            number += 1
+            path = os.path.join(directory, '%s.%d' %(filename, number))
+        return path
+
+
+def send_file(sock, source, offset, count, buf):
+    """ sends count bytes of file from offset to socket, returns bytes sent.
+
+    Uses os.sendfile where python has it, so data goes from file to socket
+    without passing through python, otherwise reads file into buf.
+    """
+
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is not None:
+        return sendfile(sock.fileno(), source.fileno(), offset, count)
+    source.seek(offset)
+    read = source.readinto(memoryview(buf)[:count])
+    if read:
+        sock.sendall(memoryview(buf)[:read])
+    return read
+
+
+class DccSend(object):
+    """ offers file with DCC SEND and sends it, runs in a thread of its own.
+
+    Listens on a port of its own until receiver connects, then sends file
+    from offset, which is 0 unless receiver asked to resume with DCC RESUME.
+    Acknowledgements of receiver are read as they come, transfer ends when
+    receiver has acknowledged the whole file or closed the connection.
+
+    Attributes:
+        nick: nick name of receiver.
+        path: file we send.
+        filename: name of file offered to receiver.
+        size: size of file.
+        port: port we listen on.
+        offset: position in file we start sending from.
+        bandwidth: BandwidthScheduler shared with other transfers.
+        sent: position in file we have sent up to.
+        acknowledged: position in file receiver has acknowledged.
+        started: time receiver connected.
+        ended: time transfer ended.
+        finished: True when transfer has ended.
+        error: reason transfer failed, None if it did not.
+    """
+
+    BUFFER_SIZE = 256 * 1024
+
+    # seconds we wait for receiver to connect.
+    ACCEPT_TIMEOUT = 300
+
+    # seconds between progress reports.
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, nick, path, bind_address='', report=None, done=None,
+                 bandwidth=DCC_BANDWIDTH):
+        """
+        Args:
+            nick: nick name of receiver.
+            path: file we send.
+            bind_address: local address we listen on.
+            report: function called with progress messages.
+            done: function called with transfer when it has ended.
+            bandwidth: BandwidthScheduler shared with other transfers.
+        """
+        self.nick = nick
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.offset = 0
+        self.bandwidth = bandwidth
+        self.sent = 0
+        self.acknowledged = 0
+        self.started = None
+        self.ended = None
+        self.finished = False
+        self.error = None
+        self.__acks = ''
+        self.__report = report or (lambda message: None)
+        self.__done = done or (lambda transfer: None)
+        self.__listener = socket.socket()
+        self.__listener.bind((bind_address, 0))
+        self.__listener.listen(1)
+        self.__listener.settimeout(self.ACCEPT_TIMEOUT)
+        self.port = self.__listener.getsockname()[1]
+
+    def offer(self, address):
+        """ returns ctcp message offering file from ip address."""
+
+        return '\001DCC SEND %s %d %d %d\001' %(quote_ctcp(self.filename), dqn_to_int(address), self.port, self.size)
+
+    def resume(self, position):
+        """ receiver asked to resume at position, returns True if we can."""
+
+        if self.started is not None or not 0 <= position <= self.size:
+            return False
+        self.offset = self.sent = self.acknowledged = position
+        return True
+
+    def start(self):
+        """ starts transfer in a new thread."""
+
+        thread.start_new_thread(self.run, ())
+
+    def rate(self):
+        """ average throughput so far in bytes per second."""
+
+        if not self.started:
+            return 0.0
+        return (self.sent - self.offset) / max((self.ended or time.time()) - self.started, 1e-6)
+
+    def progress(self):
+        """ progress of transfer as readable text."""
+
+        percent = 100.0 * self.sent / self.size if self.size else 100.0
+        return '%s to %s : %d/%d bytes (%.1f%%) %.1f kB/s' %(
+            self.filename, self.nick, self.sent, self.size, percent, self.rate() / 1024)
+
+    def run(self):
+        """ waits for receiver and sends file."""
+
+        try:
+            sock = self.__listener.accept()[0]
+        except socket.error as e:
+            self.error = 'nobody connected for %s' % self.filename
+        else:
+            try:
+                self.__send(sock)
+            except (socket.error, IOError, OSError) as e:
+                self.error = str(e)
+            finally:
+                sock.close()
+        self.__listener.close()
+
+        if self.error is None and self.acknowledged < self.size and self.sent < self.size:
+            self.error = 'failed to send %s' % self.filename
+        self.ended = time.time()
+        self.finished = True
+        self.__done(self)
+
+    def __send(self, sock):
+        """ sends file from offset and reads acknowledgements."""
+
+        buf = bytearray(self.BUFFER_SIZE)
+        grant = self.bandwidth.grant
+        source = open(self.path, 'rb')
+        try:
+            self.started = last_report = time.time()
+            sock.settimeout(60)
+            while self.sent < self.size:
+                count = send_file(sock, source, self.sent, grant(min(self.BUFFER_SIZE, self.size - self.sent)), buf)
+                if not count:
+                    break
+                self.sent += count
+                self.__read_acknowledgements(sock, False)
+
+                now = time.time()
+                if now - last_report >= self.PROGRESS_INTERVAL:
+                    last_report = now
+                    self.__report(self.progress())
+
+            # wait until receiver has everything.
+            while self.acknowledged < self.size:
+                if not self.__read_acknowledgements(sock, True):
+                    break
+        finally:
+            source.close()
+
+    def __read_acknowledgements(self, sock, wait):
+        """ reads acknowledgements waiting on socket, returns False if closed."""
+
+        # socket with a timeout waits in recv until it is readable, whatever
+        # flags we give, so without wait we only read when select says so.
+        if not wait and not select.select([sock], [], [], 0)[0]:
+            return True
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            return False
+        if not data:
+            return False
+        self.__acks += data
+        complete = len(self.__acks) // 4 * 4
+        if complete:
+            # acknowledgement is position modulo 2**32, files may be larger.
+            position = struct.unpack('!I', self.__acks[complete-4:complete])[0]
+            self.acknowledged = self.sent - ((self.sent - position) & 0xffffffff)
+            self.__acks = self.__acks[complete:]
+        return True
+
+
+# RFC 1459 section 2.2, {}|^ are lower case of []\~.
+RFC1459_LOWER = string.maketrans(string.ascii_uppercase + '[]\\~',
+                                 string.ascii_lowercase + '{}|^')
+
+
+def irc_lower(name):
+    """ lower case of nick or channel name with RFC 1459 case mapping."""
+
+    return name.translate(RFC1459_LOWER)
+
+
+class Channel(object):
+    """ state of a channel we are in.
+
+    Attributes:
+        name: name of channel as irc server spells it.
+        topic: topic of channel, '' if not set.
+        modes: dict of channel modes, mode => argument or None.
+        members: dict of members, lower case nick => prefix modes
+            such as '@' or '+', '' for none.
+    """
+
+    __slots__ = ('name', 'topic', 'modes', 'members')
+
+    def __init__(self, name):
+        self.name = name
+        self.topic = ''
+        self.modes = {}
+        self.members = {}
+
+
+class User(object):
+    """ state of a user in one of our channels.
+
+    Attributes:
+        nick: nick name as irc server spells it.
+        user: username, '' until we see it.
+        host: host, '' until we see it.
+        channels: set of lower case names of channels user is in.
+        away: away message, None while user is here or we do not know.
+    """
+
+    __slots__ = ('nick', 'user', 'host', 'channels', 'away')
+
+    def __init__(self, nick, user='', host=''):
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.channels = set()
+        self.away = None
+
+
+class IrcState(object):
+    """ channels, their members, modes and topics, and users we share them with.
+
+    Channels and users are indexed both ways by lower case names with RFC
+    1459 case mapping, channel => members and user => channels, so looking
+    up membership and common channels takes constant time. Nicks, usernames
+    and hosts are interned, so every channel a user is in shares one copy.
+
+    Attributes:
+        channels: dict of lower case channel name => Channel.
+        users: dict of lower case nick => User.
+    """
+
+    # prefix of member for each member mode, e.g. +o gives '@'.
+    PREFIXES = {'q': '~', 'a': '&', 'o': '@', 'h': '%', 'v': '+'}
+
+    # channel modes which take an argument when set, and when unset.
+    MODES_WITH_ARGUMENT = 'bkeI', 'bkeIl'
+
+    def __init__(self):
+        self.channels = {}
+        self.users = {}
+
+    def channel(self, name):
+        """ returns Channel of name, None if we are not in it."""
+
+        return self.channels.get(irc_lower(name))
+
+    def user(self, nick):
+        """ returns User of nick, None if we do not share a channel."""
+
+        return self.users.get(irc_lower(nick))
+
+    def is_member(self, channel, nick):
+        """ True if nick is in channel."""
+
+        channel = self.channels.get(irc_lower(channel))
+        return channel is not None and irc_lower(nick) in channel.members
+
+    def common_channels(self, nick, other):
+        """ returns set of lower case names of channels both nicks are in."""
+
+        user = self.users.get(irc_lower(nick))
+        other = self.users.get(irc_lower(other))
+        if user is None or other is None:
+            return set()
+        return user.channels & other.channels
+
+    def join(self, channel, nick, user='', host=''):
+        """ nick joined channel, channel is created when we see it first."""
+
+        key = irc_lower(channel)
+        state = self.channels.get(key)
+        if state is None:
+            state = self.channels[key] = Channel(intern(channel))
+        self.__add_member(state, key, nick, '', user, host)
+
+    def names(self, channel, names):
+        """ adds members of RPL_NAMREPLY, names is its trailing parameter."""
+
+        key = irc_lower(channel)
+        state = self.channels.get(key)
+        if state is None:
+            state = self.channels[key] = Channel(intern(channel))
+        prefixes = '~&@%+'
+        for name in names.split():
+            # multi-prefix may give more than one prefix, e.g. @+nick.
+            nick = name.lstrip(prefixes)
+            prefix = name[:len(name) - len(nick)]
+
+            # userhost-in-names gives nick!user@host.
+            user = host = ''
+            if '!' in nick:
+                nick, _, user = nick.partition('!')
+                user, _, host = user.partition('@')
+            self.__add_member(state, key, nick, prefix, user, host)
+
+    def part(self, channel, nick):
+        """ nick left or was kicked from channel."""
+
+        key = irc_lower(channel)
+        state = self.channels.get(key)
+        if state is None:
+            return
+        lower = irc_lower(nick)
+        state.members.pop(lower, None)
+        self.__forget_channel(lower, key)
+
+    def remove_channel(self, channel):
+        """ we left channel, forget it and users we only shared it with."""
+
+        key = irc_lower(channel)
+        state = self.channels.pop(key, None)
+        if state is None:
+            return
+        for lower in state.members:
+            self.__forget_channel(lower, key)
+
+    def quit(self, nick):
+        """ nick quit irc, returns list of names of channels nick was in."""
+
+        user = self.users.pop(irc_lower(nick), None)
+        if user is None:
+            return []
+        lower = irc_lower(nick)
+        names = []
+        for key in user.channels:
+            channel = self.channels[key]
+            channel.members.pop(lower, None)
+            names.append(channel.name)
+        return names
+
+    def rename(self, nick, new_nick):
+        """ nick is now known as new_nick."""
+
+        lower = irc_lower(nick)
+        new_lower = irc_lower(new_nick)
+        user = self.users.pop(lower, None)
+        if user is None:
+            return
+        user.nick = intern(new_nick)
+        self.users[new_lower] = user
+        for key in user.channels:
+            members = self.channels[key].members
+            members[new_lower] = members.pop(lower, '')
+
+    def set_away(self, nick, message):
+        """ nick is away with message, or back if message is None."""
+
+        user = self.users.get(irc_lower(nick))
+        if user is not None:
+            user.away = message
+
+    def set_topic(self, channel, topic):
+        state = self.channels.get(irc_lower(channel))
+        if state is not None:
+            state.topic = topic
+
+    def mode(self, channel, modes, arguments):
+        """ applies MODE of channel, e.g. modes '+o-v' and arguments [nick, nick]."""
+
+        state = self.channels.get(irc_lower(channel))
+        if state is None:
+            return
+        arguments = list(arguments)
+        adding = True
+        for mode in modes:
+            if mode == '+' or mode == '-':
+                adding = mode == '+'
+
+            # member mode, changes prefix of member.
+            elif mode in self.PREFIXES:
+                if not arguments:
+                    continue
+                lower = irc_lower(arguments.pop(0))
+                prefix = state.members.get(lower)
+                if prefix is None:
+                    continue
+                symbol = self.PREFIXES[mode]
+                if adding and symbol not in prefix:
+                    prefix += symbol
+                elif not adding:
+                    prefix = prefix.replace(symbol, '')
+                state.members[lower] = prefix
+
+            # channel mode, may take argument.
+            else:
+                argument = None
+                if mode in self.MODES_WITH_ARGUMENT[adding] and arguments:
+                    argument = arguments.pop(0)
+                if adding:
+                    state.modes[mode] = argument
+                else:
+                    state.modes.pop(mode, None)
+
+    def __add_member(self, state, key, nick, prefix, user, host):
+        lower = irc_lower(nick)
+        known = self.users.get(lower)
+        if known is None:
+            known = self.users[lower] = User(intern(nick), intern(user), intern(host))
+        elif user and not known.user:
+            known.user, known.host = intern(user), intern(host)
+        known.channels.add(key)
+        state.members[intern(lower)] = prefix
+
+    def __forget_channel(self, lower, key):
+        """ user is no longer in channel, forget user if it was the last one."""
+
+        user = self.users.get(lower)
+        if user is None:
+            return
+        user.channels.discard(key)
+        if not user.channels:
+            del self.users[lower]
+
+
+def normalize_mask(mask):
+    """ returns hostmask nick!user@host of mask, missing parts are '*'.
+
+    'nick' becomes 'nick!*@*', 'user@host' becomes '*!user@host'.
+    """
+
+    if '!' not in mask and '@' not in mask:
+        return irc_lower(mask) + '!*@*'
+    nick, _, rest = mask.rpartition('!') if '!' in mask else ('*', '', mask)
+    user, _, host = rest.partition('@') if '@' in rest else (rest, '', '*')
+    return irc_lower('%s!%s@%s' % (nick or '*', user or '*', host or '*'))
+
+
+def mask_pattern(mask):
+    """ regular expression of hostmask with irc wildcards * and ?."""
+
+    return re.escape(mask).replace('\\*', '.*').replace('\\?', '.')
+
+
+def trie_pattern(words):
+    """ regular expression matching any of words, built as a trie.
+
+    Words sharing a prefix share its branch, so the regular expression
+    engine tries at most one branch per character instead of every word,
+    and matching costs the same for ten words or ten thousand.
     """
-    st = st.split(".")
-    ###
-    # That is not so elegant as 'for' cycle and
-    # not extensible at all, but that works faster
-    ###
-    return int("%02x%02x%02x%02x" % (int(st[0]),int(st[1]),int(st[2]),int(st[3])),16)
 
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
 
-def int_to_dqn(st):
+    def pattern(node):
+        branches = [re.escape(char) + pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:%s)' % '|'.join(branches)
+        if '' in node:
+            body = '(?:%s)?' % body
+        return body
+
+    return pattern(trie)
+
+
+class MessageFilter(object):
+    """ ignore masks and highlight keywords, compiled into matchers.
+
+    Ignore masks are hostmasks with irc wildcards, e.g. 'spammer',
+    '*!*@*.example.org' or 'bot*!*@10.0.0.?'. Masks are indexed by their
+    literal nick, literal host or literal domain after '*.', a message is
+    only matched against masks sharing its nick, host or a domain of its
+    host, each group compiled into one regular expression. Masks without
+    any literal part share one regular expression.
+
+    Highlight keywords, matched as whole words regardless of case, are
+    compiled into one trie shaped regular expression.
+
+    Matchers are built again on first use after rules change, regular
+    expressions of a nick, host or domain when it is first looked up.
+
+    Attributes:
+        ignores: list of ignore masks, as given.
+        highlights: list of highlight keywords.
     """
-    http://code.activestate.com/recipes/65219-ip-address-conversion-functions/#c3
-    Convert integer to dotted quad notation
+
+    def __init__(self, ignores=(), highlights=()):
+        self.ignores = list(ignores)
+        self.highlights = list(highlights)
+        self.__dirty = True
+        self.__by_nick = {}
+        self.__by_host = {}
+        self.__by_domain = {}
+        self.__wild = None
+        self.__highlight = None
+
+    def add_ignore(self, mask):
+        if mask not in self.ignores:
+            self.ignores.append(mask)
+            self.__dirty = True
+
+    def remove_ignore(self, mask):
+        """ removes ignore mask, returns True if we had it."""
+
+        if mask not in self.ignores:
+            return False
+        self.ignores.remove(mask)
+        self.__dirty = True
+        return True
+
+    def add_highlight(self, keyword):
+        if keyword not in self.highlights:
+            self.highlights.append(keyword)
+            self.__dirty = True
+
+    def remove_highlight(self, keyword):
+        """ removes highlight keyword, returns True if we had it."""
+
+        if keyword not in self.highlights:
+            return False
+        self.highlights.remove(keyword)
+        self.__dirty = True
+        return True
+
+    def ignored(self, prefix):
+        """ True if prefix nick!user@host of message matches an ignore mask."""
+
+        if self.__dirty:
+            self.__compile()
+        if not prefix or not self.ignores:
+            return False
+
+        prefix = irc_lower(prefix)
+        nick, _, rest = prefix.partition('!')
+        host = rest.partition('@')[2]
+        if self.__wild is not None and self.__wild(prefix):
+            return True
+        if self.__matches(self.__by_nick, nick, prefix) or self.__matches(self.__by_host, host, prefix):
+            return True
+
+        # host a.b.example.org is in domains .b.example.org, .example.org and .org.
+        dot = host.find('.')
+        while dot >= 0:
+            if self.__matches(self.__by_domain, host[dot:], prefix):
+                return True
+            dot = host.find('.', dot + 1)
+        return False
+
+    @staticmethod
+    def __matches(table, literal, prefix):
+        """ True if prefix matches masks of literal in table."""
+
+        matcher = table.get(literal)
+        if matcher is None:
+            return False
+
+        # patterns are compiled when first needed.
+        if isinstance(matcher, list):
+            matcher = table[literal] = re.compile('(?:%s)\\Z' % '|'.join(matcher)).match
+        return matcher(prefix) is not None
+
+    def highlight(self, text):
+        """ returns highlight keyword found in text, None if none."""
+
+        if self.__dirty:
+            self.__compile()
+        if self.__highlight is None:
+            return None
+        found = self.__highlight(text)
+        return found.group(0) if found else None
+
+    def __compile(self):
+        """ builds matchers from rules."""
+
+        groups = {}
+        for mask in self.ignores:
+            mask = normalize_mask(mask)
+            nick, _, rest = mask.partition('!')
+            host = rest.partition('@')[2]
+            if not any(char in nick for char in '*?'):
+                key = ('nick', nick)
+            elif not any(char in host for char in '*?'):
+                key = ('host', host)
+            elif host.startswith('*.') and not any(char in host[1:] for char in '*?'):
+                key = ('domain', host[1:])
+            else:
+                key = ('wild', None)
+            groups.setdefault(key, []).append(mask_pattern(mask))
+
+        self.__by_nick, self.__by_host, self.__by_domain, self.__wild = {}, {}, {}, None
+        tables = {'nick': self.__by_nick, 'host': self.__by_host, 'domain': self.__by_domain}
+        for (kind, literal), patterns in groups.items():
+            if kind == 'wild':
+                self.__wild = re.compile('(?:%s)\\Z' % '|'.join(patterns)).match
+            else:
+                tables[kind][literal] = patterns
+
+        self.__highlight = None
+        if self.highlights:
+            pattern = trie_pattern(sorted(set(keyword.lower() for keyword in self.highlights)))
+            self.__highlight = re.compile('(?<!\\w)%s(?!\\w)' % pattern, re.I).search
+        self.__dirty = False
+
+
+# bytes of ASCII text, deleting them leaves nothing of ASCII text.
+ASCII = ''.join(chr(i) for i in xrange(128))
+
+
+class Charsets(object):
+    """ charsets of text from a network and its channels.
+
+    Lines from irc server stay bytes through framing, parsing and dispatch.
+    Text is only recoded to UTF-8 where it is shown, filtered or indexed,
+    by recode. ASCII and valid UTF-8, nearly every line, is passed through
+    as it is, without a decoded copy kept; other text is decoded with the
+    charset of its channel, or fallback when that fails.
+
+    Attributes:
+        default: charset of network.
+        fallback: charset of text which is not valid in its charset.
+        channels: dict of lower case channel or nick name => charset.
     """
-    st = "%08x" % (st)
-    ###
-    # The same issue as for `dqn_to_int()`
-    ###
-    return "%i.%i.%i.%i" % (int(st[0:2],16),int(st[2:4],16),int(st[4:6],16),int(st[6:8],16))
+
+    def __init__(self, default='utf-8', fallback='latin-1'):
+        self.default = default
+        self.fallback = fallback
+        self.channels = {}
+
+    def charset(self, target):
+        """ returns charset of channel or nick target."""
+
+        if not self.channels:
+            return self.default
+        return self.channels.get(irc_lower(target), self.default)
+
+    def set_charset(self, target, charset):
+        """ sets charset of channel or nick target, None for network.
+
+        Raises:
+            LookupError: if python does not know charset.
+        """
+
+        charset = codecs.lookup(charset).name
+        if target is None:
+            self.default = charset
+        else:
+            self.channels[irc_lower(target)] = charset
+
+    def recode(self, target, data):
+        """ returns text of channel or nick target as UTF-8 bytes."""
+
+        if data is None or not data.translate(None, ASCII):
+            return data
+        charset = self.charset(target)
+        if charset == 'utf-8':
+            try:
+                data.decode('utf-8')
+                return data
+            except UnicodeDecodeError:
+                charset = self.fallback
+        try:
+            return data.decode(charset).encode('utf-8')
+        except UnicodeDecodeError:
+            return data.decode(self.fallback, 'replace').encode('utf-8')
+
+
+class CidrIndex(object):
+    """ CIDR ranges of IPv4 and IPv6 addresses, each allowed or denied.
+
+    Ranges are kept as a sorted index of intervals which do not overlap,
+    one per address family, so looking up an address is a binary search,
+    as quick for thousands of ranges as for ten. Where ranges overlap the
+    narrower one decides, e.g. 10.1.0.0/16 denied within 10.0.0.0/8
+    allowed; of equal ranges the last one added.
+
+    The index is built again on first lookup after rules change.
+
+    Attributes:
+        rules: list of (cidr, allow) as given.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = []
+        self.__cidrs = set()
+        self.__index = None
+        for cidr, allow in rules:
+            self.add(cidr, allow)
+
+    def add(self, cidr, allow=True):
+        """ allows or denies addresses of cidr.
+
+        Raises:
+            ValueError: if cidr is no IPv4 or IPv6 range.
+        """
+
+        parse_cidr(cidr)
+        self.remove(cidr)
+        self.rules.append((cidr, allow))
+        self.__cidrs.add(cidr)
+        self.__index = None
+
+    def remove(self, cidr):
+        """ removes rule of cidr, returns True if we had it."""
+
+        if cidr not in self.__cidrs:
+            return False
+        self.rules = [rule for rule in self.rules if rule[0] != cidr]
+        self.__cidrs.discard(cidr)
+        self.__index = None
+        return True
+
+    def lookup(self, address):
+        """ returns True if address is allowed, False if denied, None if in no range.
+
+        Args:
+            address: IPv4 or IPv6 address, or IPv4 address as integer as in
+                DCC offers.
+        """
+
+        if self.__index is None:
+            self.__build()
+        if isinstance(address, (int, long)):
+            family = socket.AF_INET
+        else:
+            try:
+                family, address = ip_to_int(address)
+            except ValueError:
+                return None
+        starts, ends, allows = self.__index.get(family, ((), (), ()))
+        i = bisect.bisect_right(starts, address) - 1
+        if i >= 0 and address <= ends[i]:
+            return allows[i]
+        return None
+
+    def __build(self):
+        """ builds intervals which do not overlap from rules."""
+
+        ranges = {}
+        for position, (cidr, allow) in enumerate(self.rules):
+            family, start, end = parse_cidr(cidr)
+            ranges.setdefault(family, []).append((start, -end, position, allow))
+
+        self.__index = {}
+        for family, family_ranges in ranges.items():
+            starts, ends, allows = [], [], []
+
+            def add(start, end, allow):
+                if start > end:
+                    return
+                # neighbours with the same verdict become one interval.
+                if allows and allows[-1] == allow and ends[-1] + 1 == start:
+                    ends[-1] = end
+                else:
+                    starts.append(start)
+                    ends.append(end)
+                    allows.append(allow)
+
+            # CIDR ranges are nested or apart, outer ranges sort first and
+            # wait on a stack while ranges inside them are added.
+            stack = []
+            position = 0
+            for start, end, _, allow in sorted(family_ranges):
+                end = -end
+                while stack and stack[-1][0] < start:
+                    outer_end, outer_allow = stack.pop()
+                    add(position, outer_end, outer_allow)
+                    position = outer_end + 1
+                if stack:
+                    add(position, start - 1, stack[-1][1])
+                stack.append((end, allow))
+                position = start
+            while stack:
+                outer_end, outer_allow = stack.pop()
+                add(position, outer_end, outer_allow)
+                position = outer_end + 1
+            self.__index[family] = (starts, ends, allows)
+
+
+class RateLimiter(object):
+    """ token bucket of every source, e.g. a host.
+
+    Buckets are kept in order of use, when max_sources are kept the least
+    recently used one is forgotten for a new source. Every take costs the
+    same however many sources a flood comes from.
+
+    Attributes:
+        rate: tokens a source gains per second.
+        burst: tokens a source may spend at once.
+        max_sources: most sources we keep buckets of.
+    """
+
+    def __init__(self, rate, burst, max_sources=4096):
+        self.rate = rate
+        self.burst = burst
+        self.max_sources = max_sources
+        self.__buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__buckets)
+
+    def take(self, source, now=None):
+        """ takes a token of source, returns False if source has none now."""
+
+        now = now or time.time()
+        buckets = self.__buckets
+        bucket = buckets.pop(source, None)
+        if bucket is None:
+            if len(buckets) >= self.max_sources:
+                buckets.popitem(last=False)
+            bucket = TokenBucket(self.rate, self.burst)
+        buckets[source] = bucket
+        return bucket.take(now)
+
+
+class CtcpPolicy(object):
+    """ which CTCP requests client answers and which DCC offers it accepts.
+
+    Every source, a host or a nick without one, may send burst CTCP
+    requests at once and rate more per second, more are dropped without
+    answer. DCC offers are limited the same way, by buckets of their own,
+    so VERSION requests of a source do not use up its offers. A DCC offer is rejected when its sender matches a denied
+    mask, or its address or the address of its sender is in a denied
+    CIDR range. It is accepted when its address or the address of its
+    sender is in an allowed range or its sender matches an allowed mask,
+    offers matching no rule are accepted if accept_unlisted is set.
+
+    Attributes:
+        cidrs: CidrIndex of addresses allowed or denied to offer files.
+        allowed: MessageFilter with masks of users whose offers we accept.
+        denied: MessageFilter with masks of users whose offers we reject.
+        accept_unlisted: accept offers matching no rule.
+        max_transfers: most DCC transfers a client runs at once.
+        replies: RateLimiter of CTCP requests we answer of a source, rate
+            per second and burst at once.
+        offers: RateLimiter of DCC offers we consider of a source,
+            offer_rate per second and offer_burst at once.
+    """
+
+    def __init__(self, accept_unlisted=True, max_transfers=8, rate=0.5, burst=3,
+                 offer_rate=0.5, offer_burst=5):
+        self.cidrs = CidrIndex()
+        self.allowed = MessageFilter()
+        self.denied = MessageFilter()
+        self.accept_unlisted = accept_unlisted
+        self.max_transfers = max_transfers
+        self.replies = RateLimiter(rate, burst)
+        self.offers = RateLimiter(offer_rate, offer_burst)
+
+    def add_rule(self, rule, allow):
+        """ allows or denies offers of rule, a CIDR range or a hostmask."""
+
+        self.remove_rule(rule)
+        try:
+            self.cidrs.add(rule, allow)
+        except ValueError:
+            (self.allowed if allow else self.denied).add_ignore(rule)
+
+    def remove_rule(self, rule):
+        """ removes CIDR range or hostmask rule, returns True if we had it."""
+
+        removed = self.cidrs.remove(rule)
+        removed = self.allowed.remove_ignore(rule) or removed
+        return self.denied.remove_ignore(rule) or removed
+
+    def answer(self, source, now=None):
+        """ takes a token of source, returns False if we answer no more of it now."""
+
+        return self.replies.take(irc_lower(source or ''), now)
+
+    def consider(self, source, now=None):
+        """ takes an offer token of source, returns False if we drop its DCC offer."""
+
+        return self.offers.take(irc_lower(source or ''), now)
+
+    def accept(self, prefix, host, ip):
+        """ True if we accept DCC offer.
+
+        Args:
+            prefix: nick!user@host of sender.
+            host: host of sender, checked when it is an ip address.
+            ip: address offered, IPv4 address as integer.
+        """
+
+        if self.denied.ignored(prefix):
+            return False
+        verdicts = (self.cidrs.lookup(ip), self.cidrs.lookup(host) if host else None)
+        if False in verdicts:
+            return False
+        if True in verdicts or self.allowed.ignored(prefix):
+            return True
+        return self.accept_unlisted
+
+
+def would_block(error):
+    """ True if socket error only means a non blocking socket is not ready."""
+
+    if isinstance(error, (ssl.SSLWantReadError, ssl.SSLWantWriteError)):
+        return True
+    return error.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class TcpTransport(object):
+    """ plain tcp connection to irc server.
+
+    Transports make the connections of a client, the first one and every
+    one after a drop. The connection is made blocking, with timeout, and
+    handed to the client non blocking.
+
+    Attributes:
+        timeout: seconds connecting may take.
+    """
+
+    DEFAULT_PORT = 6667
+
+    def __init__(self, timeout=30.0):
+        self.timeout = timeout
+
+    def connect(self, host, port):
+        """ returns non blocking socket connected to irc server."""
+
+        sock = socket.create_connection((host, port), self.timeout)
+        sock.setblocking(0)
+        return sock
+
+    def pending(self, sock):
+        """ bytes received on sock that select does not see."""
+
+        return 0
+
+
+class TlsTransport(TcpTransport):
+    """ TLS connection to irc server.
+
+    Certificate of irc server is checked against the system certificate
+    authorities, or cafile, unless verify is False. One SSLContext is used
+    for every connection, so certificates are loaded once and not again on
+    every reconnect.
+
+    Attributes:
+        context: ssl.SSLContext connections are made with.
+    """
+
+    DEFAULT_PORT = 6697
+
+    def __init__(self, verify=True, cafile=None, certfile=None, keyfile=None, timeout=30.0):
+        """ Initialize class with default values.
+
+        Args:
+            verify: check certificate and host name of irc server.
+            cafile: certificate authorities to trust instead of the
+                system ones.
+            certfile, keyfile: client certificate, for networks which
+                identify us by it.
+            timeout: seconds connecting and handshake may take.
+        """
+
+        TcpTransport.__init__(self, timeout)
+        self.context = ssl.create_default_context(cafile=cafile)
+        if not verify:
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+        if certfile:
+            self.context.load_cert_chain(certfile, keyfile)
+
+    def connect(self, host, port):
+        """ returns non blocking TLS socket connected to irc server."""
+
+        sock = socket.create_connection((host, port), self.timeout)
+        try:
+            sock = self.context.wrap_socket(sock, server_hostname=host)
+        except Exception:
+            sock.close()
+            raise
+        sock.setblocking(0)
+        return sock
+
+    def pending(self, sock):
+        """ bytes decrypted already, select only sees those not yet read."""
+
+        return sock.pending()
+
+
+class Backoff(object):
+    """ delays between reconnects, growing exponentially with full jitter.
+
+    Delay of attempt n is a random time between 0 and base * 2**n seconds,
+    at most cap, so clients dropped together by an irc server do not all
+    come back at the same moment.
+
+    Attributes:
+        base: seconds the first delay is at most.
+        cap: seconds no delay is longer than.
+        attempts: reconnects tried since last reset.
+    """
+
+    def __init__(self, base=0.5, cap=60.0):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+
+    def delay(self):
+        """ returns seconds to wait before next reconnect."""
+
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** min(self.attempts, 16)))
+        self.attempts += 1
+        return delay
+
+    def reset(self):
+        """ connection is up again, start over from base."""
+
+        self.attempts = 0
+
+
+def join_lines(channels, limit=510):
+    """ returns JOIN lines for channels, as few as fit in limit bytes each."""
+
+    lines = []
+    line = ''
+    for channel in channels:
+        if line and len(line) + 1 + len(channel) > limit:
+            lines.append(line)
+            line = ''
+        line = line + ',' + channel if line else 'JOIN ' + channel
+    if line:
+        lines.append(line)
+    return lines
+
+
+# numeric replies of RFC 1459 section 6, code => name.
+REPLY_NAMES = {
+    '001': 'RPL_WELCOME', '002': 'RPL_YOURHOST', '003': 'RPL_CREATED',
+    '004': 'RPL_MYINFO', '005': 'RPL_ISUPPORT', '042': 'RPL_YOURID',
+    '200': 'RPL_TRACELINK', '201': 'RPL_TRACECONNECTING', '202': 'RPL_TRACEHANDSHAKE',
+    '203': 'RPL_TRACEUNKNOWN', '204': 'RPL_TRACEOPERATOR', '205': 'RPL_TRACEUSER',
+    '206': 'RPL_TRACESERVER', '208': 'RPL_TRACENEWTYPE', '211': 'RPL_STATSLINKINFO',
+    '212': 'RPL_STATSCOMMANDS', '213': 'RPL_STATSCLINE', '214': 'RPL_STATSNLINE',
+    '215': 'RPL_STATSILINE', '216': 'RPL_STATSKLINE', '217': 'RPL_STATSQLINE',
+    '218': 'RPL_STATSYLINE', '219': 'RPL_ENDOFSTATS', '221': 'RPL_UMODEIS',
+    '231': 'RPL_SERVICEINFO', '232': 'RPL_ENDOFSERVICES', '233': 'RPL_SERVICE',
+    '241': 'RPL_STATSLLINE', '242': 'RPL_STATSUPTIME', '243': 'RPL_STATSOLINE',
+    '244': 'RPL_STATSHLINE', '251': 'RPL_LUSERCLIENT', '252': 'RPL_LUSEROP',
+    '253': 'RPL_LUSERUNKNOWN', '254': 'RPL_LUSERCHANNELS', '255': 'RPL_LUSERME',
+    '256': 'RPL_ADMINME', '257': 'RPL_ADMINLOC1', '258': 'RPL_ADMINLOC2',
+    '259': 'RPL_ADMINEMAIL', '261': 'RPL_TRACELOG', '262': 'RPL_TRACEEND',
+    '265': 'RPL_LOCALUSERS', '266': 'RPL_GLOBALUSERS', '300': 'RPL_NONE',
+    '301': 'RPL_AWAY', '302': 'RPL_USERHOST', '303': 'RPL_ISON',
+    '305': 'RPL_UNAWAY', '306': 'RPL_NOWAWAY', '311': 'RPL_WHOISUSER',
+    '312': 'RPL_WHOISSERVER', '313': 'RPL_WHOISOPERATOR', '314': 'RPL_WHOWASUSER',
+    '315': 'RPL_ENDOFWHO', '316': 'RPL_WHOISCHANOP', '317': 'RPL_WHOISIDLE',
+    '318': 'RPL_ENDOFWHOIS', '319': 'RPL_WHOISCHANNELS', '321': 'RPL_LISTSTART',
+    '322': 'RPL_LIST', '323': 'RPL_LISTEND', '324': 'RPL_CHANNELMODEIS',
+    '331': 'RPL_NOTOPIC', '332': 'RPL_TOPIC', '341': 'RPL_INVITING',
+    '342': 'RPL_SUMMONING', '351': 'RPL_VERSION', '352': 'RPL_WHOREPLY',
+    '353': 'RPL_NAMREPLY', '361': 'RPL_KILLDONE', '362': 'RPL_CLOSING',
+    '363': 'RPL_CLOSEEND', '364': 'RPL_LINKS', '365': 'RPL_ENDOFLINKS',
+    '366': 'RPL_ENDOFNAMES', '367': 'RPL_BANLIST', '368': 'RPL_ENDOFBANLIST',
+    '369': 'RPL_ENDOFWHOWAS', '371': 'RPL_INFO', '372': 'RPL_MOTD',
+    '373': 'RPL_INFOSTART', '374': 'RPL_ENDOFINFO', '375': 'RPL_MOTDSTART',
+    '376': 'RPL_ENDOFMOTD', '381': 'RPL_YOUREOPER', '382': 'RPL_REHASHING',
+    '384': 'RPL_MYPORTIS', '391': 'RPL_TIME', '392': 'RPL_USERSSTART',
+    '393': 'RPL_USERS', '394': 'RPL_ENDOFUSERS', '395': 'RPL_NOUSERS',
+    '401': 'ERR_NOSUCHNICK', '402': 'ERR_NOSUCHSERVER', '403': 'ERR_NOSUCHCHANNEL',
+    '404': 'ERR_CANNOTSENDTOCHAN', '405': 'ERR_TOOMANYCHANNELS', '406': 'ERR_WASNOSUCHNICK',
+    '407': 'ERR_TOOMANYTARGETS', '409': 'ERR_NOORIGIN', '411': 'ERR_NORECIPIENT',
+    '412': 'ERR_NOTEXTTOSEND', '413': 'ERR_NOTOPLEVEL', '414': 'ERR_WILDTOPLEVEL',
+    '421': 'ERR_UNKNOWNCOMMAND', '422': 'ERR_NOMOTD', '423': 'ERR_NOADMININFO',
+    '424': 'ERR_FILEERROR', '431': 'ERR_NONICKNAMEGIVEN', '432': 'ERR_ERRONEUSNICKNAME',
+    '433': 'ERR_NICKNAMEINUSE', '436': 'ERR_NICKCOLLISION', '441': 'ERR_USERNOTINCHANNEL',
+    '442': 'ERR_NOTONCHANNEL', '443': 'ERR_USERONCHANNEL', '444': 'ERR_NOLOGIN',
+    '445': 'ERR_SUMMONDISABLED', '446': 'ERR_USERSDISABLED', '461': 'ERR_NEEDMOREPARAMS',
+    '462': 'ERR_ALREADYREGISTERED', '463': 'ERR_NOPERMFORHOST', '464': 'ERR_PASSWDMISMATCH',
+    '465': 'ERR_YOUREBANNEDCREEP', '466': 'ERR_YOUWILLBEBANNED', '467': 'ERR_KEYSET',
+    '471': 'ERR_CHANNELISFULL', '472': 'ERR_UNKNOWNMODE', '473': 'ERR_INVITEONLYCHAN',
+    '474': 'ERR_BANNEDFROMCHAN', '475': 'ERR_BADCHANNELKEY', '481': 'ERR_NOPRIVILEGES',
+    '482': 'ERR_CHANOPRIVSNEEDED', '483': 'ERR_CANTKILLSERVER', '491': 'ERR_NOOPERHOST',
+    '492': 'ERR_NOSERVICEHOST', '502': 'ERR_USERSDONTMATCH',
+}
+
+# names of numeric replies, name => code.
+REPLY_CODES = dict((name, code) for code, name in REPLY_NAMES.items())
+
+# handlers for messages from irc server, command => handler.
+# handler is called with client and Message, see register_handler.
+SERVER_HANDLERS = {}
+
+
+def register_handler(command, handler):
+    """ register handler for messages from irc server.
+
+    Replaces any handler registered for command before, so it can be used
+    to override the handlers of the client.
+
+    Args:
+        command: irc command, numeric reply or name of numeric reply,
+            e.g. 'PRIVMSG', '433' or 'ERR_NICKNAMEINUSE'.
+        handler: function called with client and Message.
+    """
+
+    command = command.upper()
+    SERVER_HANDLERS[REPLY_CODES.get(command, command)] = handler
+
+
+# handlers for IRCv3 batches, type => handler. batches of other types
+# have their messages handled one by one.
+BATCH_HANDLERS = {}
+
+
+def register_batch_handler(type, handler):
+    """ register handler for batches of type.
+
+    Replaces any handler registered for type before. The handler gets the
+    whole batch when it ends, messages of batch are not handled one by one.
+
+    Args:
+        type: type of IRCv3 batch, e.g. 'netsplit'.
+        handler: function called with client and Batch when batch ends.
+    """
+
+    BATCH_HANDLERS[type.lower()] = handler
+
+
+BACKGROUND_HANDLERS = {}
+
+
+def register_background_handler(command, handler):
+    """ register handler which runs on handler pool of client.
+
+    Background handlers run after the handler of command in SERVER_HANDLERS,
+    on a worker thread of the HandlerPool of the client, so a slow handler,
+    e.g. a user script, never holds up the engine. Messages to the same
+    channel or nick reach background handlers in order. Handlers must not
+    touch IrcState, it belongs to the engine thread, and should talk to
+    irc server with client.post.
+
+    Args:
+        command: irc command, numeric reply or name of numeric reply.
+        handler: function called with client and Message.
+    """
+
+    command = command.upper()
+    BACKGROUND_HANDLERS.setdefault(REPLY_CODES.get(command, command), []).append(handler)
+
 
 class IrcClient(object):
     """ Internet Relay Char Client.
@@ -47,103 +3263,421 @@ class IrcClient(object):
        username = defaultUsername.
        server = defaultServer.
        realname = default real name.
-       log_file = opens file at relative url from root of program irc.log.
+       log_writer = LogWriter for scrollback store at relative url from root of program scrollback.db.
        running = True.
 
-    To start client we need to call function run.
+    Each client is one connection to one irc server. Clients are run by an
+    IrcEngine, which can run clients for many irc servers in one process.
+    To start client alone we need to call function start.
     To end client we need to call function quit.
 
-    client closes log_file and irc_server on deletion
+    Messages from irc server are handled by the handler registered for
+    their command in SERVER_HANDLERS, see register_handler, on the engine
+    thread. Slow handlers run after them on handler_pool, see
+    register_background_handler.
+
+    client closes log_writer and irc_server on deletion
 
     Attributes:
         host: url of irc server.
-        irc_server: tcp connection to irc server.
+        port: port of irc server.
+        irc_server: connection to irc server, made by transport.
+        transport: TcpTransport or TlsTransport the connection to irc
+            server is made with, again after it drops.
+        backoff: Backoff of reconnecting after connection drops, None to
+            stop instead.
         nickname: nick name of user.
         username: username of user.
         server: url or irc client.
         realname: real name of user.
-        buffer: buffer for keeping response from irc server.
-        message_queue: queue for all messages, either from console or irc server.
-        log_file: file for logging messages, retrieved or sent.
+        channels: lower case names of channels we are in, joined again
+            after we are welcomed.
+        state: IrcState of channels we are in and their members.
+        lines: LineBuffer splitting responses from irc server into messages.
+        send_queue: SendQueue of messages waiting to be sent to irc server.
+        download_directory: directory files received with DCC are saved in.
+        dcc_address: ip address we offer files from, defaults to local
+            address of irc server connection.
+        dcc_resume: ask sender to resume when we have part of offered file.
+        transfers: list of DCC transfers, running and finished.
+        message_queue: MessageQueue for all messages, either from console or
+            irc server.
+        log_writer: LogWriter for logging messages, retrieved or sent.
             in the format Date : source (server/client) : message.
         running: boolean value for if client should be running.
+        connected: True while connection to irc server is up. When it
+            drops the client reconnects, or without backoff keeps running
+            until it has handled messages left in queue.
+        engine: IrcEngine running the client, None until added to one.
+        metrics: Metrics the client counts messages, bytes and handler
+            times in, labelled with network.
+        handler_pool: HandlerPool background handlers run on, made when
+            first needed if not given.
+        capabilities: set of IRCv3 capabilities irc server has enabled.
+        message_filter: MessageFilter with ignore masks and highlight
+            keywords for messages and notices.
     """
 
-    def __init__(self):
-        """ Initialize class with default values."""
-        self.host = sys.argv[1]
-        self.irc_sever = socket.socket()
-        self.irc_sever.connect((self.host, 6667))
-        self.nickname = 'defaultNick'
+    # how many queued messages we handle before we let other clients run
+    # and read from irc server again.
+    MAX_BATCH = 256
+
+    # how many responses we read from irc server at once.
+    MAX_READS = 16
+
+    # seconds we wait for irc server to close connection after we quit.
+    QUIT_LINGER = 3.0
+
+    # seconds we wait for DCC ACCEPT after we sent DCC RESUME.
+    RESUME_TIMEOUT = 60.0
+
+    # IRCv3 capabilities we ask for when irc server offers them.
+    CAPABILITIES = ('multi-prefix', 'extended-join', 'away-notify', 'server-time',
+                    'batch', 'message-tags', 'chathistory', 'draft/chathistory')
+
+    def __init__(self, host=None, port=6667, log_writer=None,
+                 nickname='defaultNick', channels=(), send_queue=None, metrics=METRICS,
+                 message_queue=None, handler_pool=None, message_filter=None,
+                 transport=None, reconnect=True, charsets=None, ctcp_policy=None):
+        """ Initialize class with default values.
+
+        Args:
+            host: url of irc server, defaults to first command line argument.
+            port: port of irc server.
+            log_writer: LogWriter to log to, defaults to default_log_writer().
+            nickname: nick name of user.
+            channels: channels to join when irc server welcomes us.
+            send_queue: SendQueue with flood control, defaults to SendQueue().
+            metrics: Metrics to count in, defaults to METRICS.
+            message_queue: MessageQueue with overflow policy, defaults to
+                MessageQueue().
+            handler_pool: HandlerPool for background handlers, may be
+                shared by clients.
+            message_filter: MessageFilter for ignores and highlights, may
+                be shared by clients, defaults to MessageFilter().
+            transport: TcpTransport or TlsTransport to connect with,
+                defaults to TcpTransport().
+            reconnect: reconnect with Backoff() when connection drops.
+            charsets: Charsets text of network and its channels is in,
+                defaults to Charsets().
+            ctcp_policy: CtcpPolicy for CTCP requests and DCC offers, may
+                be shared by clients, defaults to CtcpPolicy().
+        """
+        self.host = host or sys.argv[1]
+        self.port = port
+        self.transport = transport or TcpTransport()
+        self.irc_sever = self.transport.connect(self.host, self.port)
+        self.backoff = Backoff() if reconnect else None
+        self.nickname = nickname
         self.username = 'defaultUsername'
         self.server = 'defaultServer'
         self.realname = 'default real name'
-        self.buffer = ''
-        self.message_queue = Queue.Queue()
-        self.log_file =  open('irc.log', 'a')
+        self.channels = set(irc_lower(channel) for channel in channels)
+        self.state = IrcState()
+        self.lines = LineBuffer()
+        self.send_queue = send_queue or SendQueue()
+        self.download_directory = 'downloads'
+        self.dcc_address = None
+        self.dcc_resume = True
+        self.transfers = []
+        self.__resumes = {}
+        self.__outgoing = ''
+        self.message_queue = message_queue or MessageQueue()
+        self.log_writer = log_writer or default_log_writer()
+        self.__owns_log_writer = log_writer is None
         self.running = True
+        self.connected = True
+        self.engine = None
+        self.handler_pool = handler_pool
+        self.message_filter = message_filter or MessageFilter()
+        self.charsets = charsets or Charsets()
+        self.ctcp_policy = ctcp_policy or CtcpPolicy()
+        self.__quit_deadline = None
+        self.__welcomed = False
+
+        # IRCv3 capability negotiation and batches waiting for their end.
+        self.capabilities = set()
+        self.__offered = set()
+        self.__negotiating = False
+        self.__batches = {}
+
+        # connection made by reconnect thread, taken over by engine thread.
+        self.__reconnecting = False
+        self.__new_server = None
+        self.__dropped = None
+
+        # series of metrics, kept so counting is cheap.
+        self.metrics = metrics
+        self.__labels = (('network', self.host),)
+        self.__handler_times = {}
+        self.__bytes_received = metrics.counter('irc_received_bytes_total', self.__labels)
+        self.__bytes_sent = metrics.counter('irc_sent_bytes_total', self.__labels)
+        self.__lines_dropped = metrics.counter('irc_dropped_lines_total', self.__labels)
+        self.__queue_depth = metrics.gauge('irc_message_queue_depth', self.__labels)
+        self.__queue_dropped = metrics.counter('irc_message_queue_dropped_total', self.__labels)
+        self.__queue_spilled = metrics.counter('irc_message_queue_spilled_total', self.__labels)
+        self.__send_depth = metrics.gauge('irc_send_queue_depth', self.__labels)
+        self.__ignored = metrics.counter('irc_ignored_total', self.__labels)
+        self.__highlights = metrics.counter('irc_highlights_total', self.__labels)
+        self.__reconnects = metrics.counter('irc_reconnects_total', self.__labels)
+        self.__handler_errors = metrics.counter('irc_handler_errors_total', self.__labels)
+        self.__ctcp_dropped = metrics.counter('irc_ctcp_dropped_total', self.__labels)
+        self.__dcc_rejected = metrics.counter('irc_dcc_rejected_total', self.__labels)
+        self.__last_stats = (metrics.started, 0, 0)
     def __del__(self):
         """ closes all streams in class deletion."""
-        self.log_file.close()
+        # connecting failed, nothing was opened.
+        if not hasattr(self, 'irc_sever'):
+            return
+        if self.__owns_log_writer:
+            self.log_writer.close()
         self.irc_sever.close()
 
-    def start(self):
-        """ Starts the irc client."""
+    def start(self):
+        """ Starts the irc client in an engine of its own."""
+
+        IrcEngine([self]).start()
+    def run(self):
+        """ runs the irc client in an engine of its own, without console."""
+
+        IrcEngine([self]).run()
+    def register(self):
+        """ registers nick and user to irc server.
+
+        CAP LS goes first, irc servers which know IRCv3 hold registration
+        until we end capability negotiation, others ignore it.
+        """
+
+        self.capabilities = set()
+        self.__offered = set()
+        self.__negotiating = True
+        self.__batches = {}
+        self.__send('CAP LS 302')
+        self.__send('NICK '+self.nickname)
+        self.__send_user(self.username, self.host, self.server, self.realname)
+    def fileno(self):
+        """ file descriptor of irc server connection, lets select wait on client."""
+
+        return self.irc_sever.fileno()
+    def buffered(self):
+        """ True if connection holds received data select does not see,
+        e.g. decrypted TLS records."""
+
+        return self.connected and self.transport.pending(self.irc_sever) > 0
+    def post(self, message):
+        """ add message to message queue and wake up engine.
+
+        Safe to call from any thread.
+        """
+
+        self.message_queue.put(message)
+        if self.engine is not None:
+            self.engine.wake()
+    def report(self, text):
+        """ prints and logs text, safe to call from any thread."""
+
+        self.printConsole( text )
+        self.__log_message('client', text)
+    def report_error(self, what):
+        """ prints and logs what failed with traceback of exception being handled."""
+
+        self.report('%s : %s' %(what, traceback.format_exc().rstrip()))
+    def drop(self):
+        """ drops connection to irc server after an error, as if it went down.
+
+        Client reconnects unless reconnect is off, then it stops. A client
+        which is not connected stops.
+        """
+
+        if self.connected:
+            self.__disconnected()
+        else:
+            self.__stop()
+    def receive(self):
+        """ called by engine when irc server connection is readable."""
+
+        if self.connected:
+            self.__recv_server()
+    def wants_write(self):
+        """ True if we have sent part of a message and wait to send the rest."""
+
+        return bool(self.__outgoing) and self.running and self.connected
+    def send_delay(self):
+        """ seconds until send queue may send next message, None if empty.
+
+        After quit, no more than until we stop waiting for irc server.
+        """
+
+        delay = self.send_queue.delay() if self.connected else None
+        if self.__quit_deadline is not None:
+            linger = max(self.__quit_deadline - time.time(), 0.0)
+            delay = linger if delay is None else min(delay, linger)
+        return delay
+    def flush(self):
+        """ send messages flood control lets us send now to irc server.
+
+        Messages are joined and sent with one send, what the connection does
+        not take now is kept and sent when the engine finds it writable.
+        """
+
+        # lines wait in send queue while connection is down.
+        if not self.running or not self.connected:
+            return
+        lines = self.send_queue.pop() if self.send_queue.depth else None
+        if lines:
+            self.__outgoing += '\r\n'.join(lines) + '\r\n'
+        self.__send_depth.value = self.send_queue.depth
+        if not self.__outgoing:
+            return
+        try:
+            sent = self.irc_sever.send(self.__outgoing)
+        except socket.error as e:
+            if would_block(e):
+                return
+            self.__disconnected()
+            return
+        self.__outgoing = self.__outgoing[sent:]
+        self.__bytes_sent.add(sent)
+    def process_messages(self):
+        """ handle messages in queue, up to MAX_BATCH.
+
+        Returns:
+            True if messages are left in queue.
+        """
+
+        # reconnect thread has connected to irc server again.
+        if self.__new_server is not None:
+            self.__reconnected()
+
+        # console input first, only it may hold console commands.
+        self.__queue_depth.value = self.message_queue.depth
+        commands = self.message_queue.pop_console(self.MAX_BATCH)
+        for message in commands:
+            if not self.running:
+                return False
+            self.__dispatch(message, True)
+        for message in self.message_queue.pop(self.MAX_BATCH - len(commands)):
+            if not self.running:
+                return False
+            self.__dispatch(message)
+
+        # connection is gone for good and everything it sent is handled, or
+        # we have waited long enough for irc server to close it after we quit.
+        if not self.connected and not self.message_queue.depth and (
+                not self.__reconnecting or self.__quit_deadline is not None):
+            self.__stop()
+        elif self.__quit_deadline is not None and time.time() >= self.__quit_deadline:
+            self.__stop()
+        return self.message_queue.depth > 0
+    def __dispatch(self, message, console=False):
+        """ sends message to the right handler.
 
-        # open new threads for receiving input from console and irc server.
-        thread.start_new_thread(self.__recv_server, ())
-        thread.start_new_thread(self.__recv_console, ())
+        Lines starting with / are console commands, unless they come from
+        irc server, which must not run commands of ours.
+        """
 
-        # registers nick and user to irc server.
-        self.__send('NICK '+client.nickname)
-        self.__send_user(client.username, client.host, client.server, client.realname)
+        # handle empty string ( enter )
+        if not message:
+            return
 
-        # runs while client should be running.
-        while self.running:
+        # this is command from console.
+        if console and message[0] == '/':
 
-            # we have a message in queue
-            if not self.message_queue.empty():
+            # this is ctcp command from console
+            begin = time.time()
+            if message.startswith('/ctcp '):
+                self.__process_ctcp_console_command(message)
+                command = 'console ctcp'
 
-                # we retrieve message.
-                message = self.message_queue.get()
+            # this is irc command from console
+            else:
+                self.__process_irc_console_command(message)
+                command = 'console'
+            self.__handler_time(command).observe(time.time() - begin)
+            return
 
-                # handle empty string ( enter )
-                if not message:
-                    pass
+        # this is message from server, parse it once for every handler.
+        parsed = parse_message(message)
+        if parsed is None:
+            self.printConsole( message )
+            return
 
-                # this is ctcp command from console
-                elif message.split(' ')[0] == '/ctcp':
-                    self.__process_ctcp_console_command(message)
+        self.__handle(parsed)
+    def __handle(self, parsed):
+        """ sends parsed message from irc server to its handlers."""
 
-                # this is irc command from console
-                elif message[0] == '/':
-                    self.__process_irc_console_command(message)
+        # messages of a batch wait until batch ends.
+        if self.__batches and parsed.command != 'BATCH':
+            batch = self.__batches.get(parsed.tags.get('batch'))
+            if batch is not None:
+                batch.messages.append(parsed)
+                return
 
-                # this might be short command from server.
-                elif len(message.split(' ')) < 3:
-                    self.__process_irc_short_server_command(message)
+        # look up handler of command, unknown commands are only printed.
+        command = parsed.command
+        handler = SERVER_HANDLERS.get(command)
+        if handler is None:
+            handler, command = IrcClient.on_unknown, 'unknown'
+        histogram = self.__handler_times.get(command) or self.__handler_time(command)
+        begin = time.time()
+        try:
+            handler(self, parsed)
+        except Exception:
+            # a broken handler or line loses this message, not the client.
+            self.__handler_errors.add()
+            self.report_error('handler of %s failed on %r' %(command, parsed.raw))
+        histogram.observe(time.time() - begin)
 
-                #this might be long command from server.
-                else:
-                    self.__process_irc_long_server_command(message)
+        # slow handlers run on handler pool, in order for each channel or nick.
+        background = BACKGROUND_HANDLERS.get(parsed.command)
+        if background:
+            self.__submit(background, parsed)
+    def __submit(self, handlers, message):
+        """ queue background handlers of message on handler pool."""
 
-            # rest
-            time.sleep(0.05)
-    def quit(self):
-        """ terminates irc client."""
+        if self.handler_pool is None:
+            self.handler_pool = HandlerPool(report=self.report)
 
-        # tell client to stop running.
-        self.running = False
+        # messages to us are ordered by sender, others by channel.
+        args = message.args
+        target = args[0] if args else ''
+        if irc_lower(target) == irc_lower(self.nickname):
+            target = message.nick or ''
+        key = (self.host, irc_lower(target))
+        for handler in handlers:
+            self.handler_pool.submit(key, handler, self, message)
+    def __handler_time(self, command):
+        """ returns Histogram of handler times of command."""
 
-        # wait few seconds to pick up last messages from server.
-        time.sleep(3)
+        histogram = self.metrics.histogram('irc_handler_seconds', self.__labels + (('command', command),))
+        self.__handler_times[command] = histogram
+        return histogram
+    def quit(self):
+        """ terminates irc client, engine stops when no clients are left.
 
-        # close server and log file connections.
-        self.irc_sever.close()
-        self.log_file.close()
+        Does not wait, the engine keeps handling the last messages from irc
+        server, and other clients, until irc server closes connection or
+        QUIT_LINGER seconds have passed.
+        """
+
+        # send everything left in send queue, quit message included.
+        lines = self.send_queue.pop_all()
+        if lines:
+            self.__outgoing += '\r\n'.join(lines) + '\r\n'
+        self.__quit_deadline = time.time() + self.QUIT_LINGER
+        self.flush()
+    def __stop(self):
+        """ stops client, closes server and log file connections."""
 
-        # terminate program
-        exit(0)
+        self.running = False
+        if self.connected:
+            self.connected = False
+            self.irc_sever.close()
+        if self.__new_server is not None:
+            self.__new_server.close()
+            self.__new_server = None
+        if self.__owns_log_writer:
+            self.log_writer.close()
 
     def __send_user(self, username='', host='', server='', realname=''):
         """ send user message to irc server."""
@@ -153,396 +3687,1310 @@ class IrcClient(object):
     def __send(self, message):
         """ send messages to irc server."""
 
-        # print, log and send message.
+        # messages we send to a channel or nick are kept with that channel or nick.
+        channel = ''
+        if message.startswith('PRIVMSG ') or message.startswith('NOTICE '):
+            channel = message.split(' ', 2)[1]
+
+        # print, log and queue message, engine sends it when flood control lets it.
         self.printConsole( message )
-        self.__log_message('client', message)
-        self.irc_sever.send(message+'\r\n')
+        self.__log_message('client', message, channel, self.nickname)
+        self.send_queue.push(message)
 
     def __process_irc_console_command(self, message):
 
         commands_without_trailer = 'NICK', 'JOIN', 'PART', 'NAMES', 'TRACE',\
                                    'MODE', 'LIST', 'INVITE', 'KICK',\
-                                   'VERSION', 'STATS', 'LINKS', 'TIME', 'ADMIN',\
+                                   'VERSION', 'LINKS', 'TIME', 'ADMIN',\
                                    'INFO', 'WHO', 'WHOIS', 'WHOWAS', 'ISON'
 
         commands_with_trailer = 'PRIVMSG', 'NOTICE', 'TOPIC'
 
         # retrieve irc command from message and make case insensitive.
         # remove '/' .
-        command = message.split(' ',1)[0][1:].upper()
+        command, _, rest = message.partition(' ')
+        command = command[1:].upper()
 
         if command in commands_without_trailer:
 
-            parameter = ''
-
-            # has parameter
-            if len(message.split(' ')) > 1:
-                parameter =  message.split(' ',1)[1]
-
-            self.__send(command+' '+parameter)
+            # rest of message is the parameter.
+            self.__send(command+' '+rest)
 
         elif command in commands_with_trailer:
 
-            parameter = ''
-            trailer = ''
-
-            # has parameter
-            if len(message.split(' ')) > 1:
-                parameter = message.split(' ')[1]
+            # first word is the parameter, the rest is the trailer.
+            parameter, _, trailer = rest.partition(' ')
 
             # has trailer
-            if len(message.split(' ')) > 2:
-                trailer = ' :'+message.split(' ',2)[2]
+            if trailer:
+                trailer = ' :'+trailer
 
             self.__send(command+' '+parameter+trailer)
 
+        elif command == 'DCC':
+            self.__process_dcc_console_command(rest)
+
+        elif command == 'SEARCH':
+            self.__search(rest)
+
+        elif command == 'STATS':
+
+            # STATS with a query letter goes to irc server.
+            if rest.split(' ')[0] in ('', 'profile'):
+                self.__stats(rest)
+            else:
+                self.__send(command+' '+rest)
+
+        elif command == 'SENDQ':
+
+            # show depth and throttling delay of send queue.
+            delay = self.send_queue.delay() or 0.0
+            self.printConsole( 'send queue: %d messages, throttled for %.2f s' %(self.send_queue.depth, delay) )
+
+        elif command == 'QUEUE':
+
+            # /queue [drop-oldest|coalesce|spill] [max lines] sets overflow
+            # policy of message queue, then shows it.
+            queue = self.message_queue
+            for word in rest.split():
+                if word in queue.POLICIES:
+                    queue.policy = word
+                elif word.isdigit():
+                    queue.max_lines = int(word)
+            self.printConsole( 'message queue: %d messages, at most %d in memory, %s, %d dropped, %d spilled' %(
+                queue.depth, queue.max_lines, queue.policy, queue.dropped, queue.spilled) )
+
+        elif command == 'HISTORY':
+
+            # /history #channel [count] asks irc server to play back messages.
+            words = rest.split()
+            if not self.capabilities & set(['chathistory', 'draft/chathistory']):
+                self.printConsole( 'irc server does not play back history' )
+            elif words:
+                count = words[1] if len(words) > 1 and words[1].isdigit() else '50'
+                self.__send('CHATHISTORY LATEST %s * %s' %(words[0], count))
+
+        elif command in ('IGNORE', 'UNIGNORE', 'HIGHLIGHT', 'UNHIGHLIGHT'):
+            self.__filter_command(command, rest.strip())
+
+        elif command == 'CHARSET':
+
+            # /charset [#channel] [charset] sets charset of network or
+            # channel, then shows charsets.
+            words = rest.split()
+            target = words.pop(0) if words and words[0][0] in '#&' else None
+            charsets = self.charsets
+            if words:
+                try:
+                    charsets.set_charset(target, words[0])
+                except LookupError:
+                    self.printConsole( 'unknown charset %s' % words[0] )
+            self.printConsole( 'charset: %s, fallback %s' %(charsets.default, charsets.fallback) )
+            for channel, charset in sorted(charsets.channels.items()):
+                self.printConsole( '%s: %s' %(channel, charset) )
+
         elif command == 'QUIT' or command == 'AWAY':
 
             trailer = ''
 
             # has trailer
-            if len(message.split(' ')) > 1:
-                trailer = ' :'+message.split(' ', 1)[1]
+            if rest:
+                trailer = ' :'+rest
 
             self.__send(command+trailer)
 
+            # irc server closes connection after QUIT, we do not reconnect.
+            if command == 'QUIT':
+                self.quit()
+
         # we do not recognize the command and just print it to console.
         else:
             self.printConsole( message )
-    def __process_irc_short_server_command(self, message):
-        # retrieve command from message.
-        command = message.split(' ', 1)[0]
+    def on_ping(self, message):
+        """ answers ping from irc server."""
 
-        # check what kind of command and respond.
-        if command == 'PING':
-            # split message into command and server message.
-            words = message.split(' ',1)
+        # retrieve server from message.
+        args = message.args
+        server = args[-1] if args else ''
 
-            # print, log and send pong response.
-            self.printConsole( message )
-            self.__log_message('server', message)
-            self.__send('PONG '+words[1])
+        # print, log and send pong response.
+        self.printConsole( message.raw )
+        self.__log_message('server', message.raw)
+        self.__send('PONG :'+server)
+    def on_quit(self, message):
+        """ irc server closes our connection, someone else quitting is only printed."""
 
-        elif command == 'QUIT':
-            # print, log and terminate program.
-            self.printConsole( message )
-            self.__log_message('server', message)
-            self.quit()
+        if message.prefix is not None:
+            self.state.quit(message.nick)
+            self.on_unknown(message)
+            return
+
+        # print, log and terminate program.
+        self.printConsole( message.raw )
+        self.__log_message('server', message.raw)
+        self.quit()
+    def on_reply(self, message):
+        """ prints and logs numeric reply, MODE and TOPIC."""
+
+        # retrieve message, print and log it.
+        text = ' '.join(message.args[1:])
+        self.printConsole( text )
+        self.__log_message('server', REPLY_NAMES.get(message.command, message.command)+' '+text)
+    def on_welcome(self, message):
+        """ irc server has welcomed us, join our channels."""
 
-        # we have command which we do not recognize and only print it out to console
+        self.__welcomed = True
+        self.__negotiating = False
+        if self.backoff is not None:
+            self.backoff.reset()
+        self.on_reply(message)
+
+        # all channels in as few JOINs as possible, sent together.
+        for line in join_lines(sorted(self.channels)):
+            self.__send(line)
+    def on_nick_in_use(self, message):
+        """ ERR_NICKNAMEINUSE, while registering try nick with '_' added.
+
+        After a reconnect irc server may not have noticed yet that our old
+        connection is gone, and still gives our nick to it.
+        """
+
+        self.on_reply(message)
+        if not self.__welcomed:
+            self.nickname += '_'
+            self.__send('NICK '+self.nickname)
+    def on_names(self, message):
+        """ RPL_NAMREPLY, adds members of channel to state."""
+
+        if len(message.params) > 2 and message.trailing is not None:
+            self.state.names(message.params[-1], message.trailing)
+        self.on_reply(message)
+    def on_topic(self, message):
+        """ TOPIC and RPL_TOPIC, keeps topic of channel."""
+
+        args = message.args
+        if message.command == 'TOPIC' and len(args) > 1:
+            channel, topic = args[0], args[1]
+        elif len(args) > 2:
+            channel, topic = args[1], args[2]
         else:
-            self.printConsole( message )
-    def __process_irc_long_server_command(self, message):
-
-        irc_command = ['001', 'RPL_WELCOME'], ['002', 'RPL_YOURHOST'], ['003', 'RPL_CREATED'],\
-                      ['004', 'RPL_MYINFO'], ['005', 'RPL_ISUPPORT'], ['042', 'RPL_YOURID'],\
-                      ['200', 'RPL_TRACELINK'], ['201', 'RPL_TRACECONNECTING'], ['202', 'RPL_TRACEHANDSHAKE'],\
-                      ['203', 'RPL_TRACEUNKNOWN'], ['204', 'RPL_TRACEOPERATOR'], ['205', 'RPL_TRACEUSER'],\
-                      ['206', 'RPL_TRACESERVER'], ['208', 'RPL_TRACENEWTYPE'], ['211', 'RPL_STATSLINKINFO'],\
-                      ['212', 'RPL_STATSCOMMANDS'], ['213', 'RPL_STATSCLINE'], ['214', 'RPL_STATSNLINE'],\
-                      ['215', 'RPL_STATSILINE'], ['216', 'RPL_STATSKLINE'], ['217', 'RPL_STATSQLINE'],\
-                      ['218', 'RPL_STATSYLINE'], ['219', 'RPL_ENDOFSTATS'], ['221', 'RPL_UMODEIS'],\
-                      ['231', 'RPL_SERVICEINFO'], ['232', 'RPL_ENDOFSERVICES'], ['233', 'RPL_SERVICE'],\
-                      ['241', 'RPL_STATSLLINE'], ['242', 'RPL_STATSUPTIME'], ['243', 'RPL_STATSOLINE'],\
-                      ['244', 'RPL_STATSHLINE'], ['244', 'RPL_STATSHLINE'], ['251', 'RPL_LUSERCLIENT'],\
-                      ['252', 'RPL_LUSEROP'], ['253', 'RPL_LUSERUNKNOWN'], ['254', 'RPL_LUSERCHANNELS'],\
-                      ['255', 'RPL_LUSERME'], ['256', 'RPL_ADMINME'], ['257', 'RPL_ADMINLOC1'],\
-                      ['258', 'RPL_ADMINLOC2'], ['259', 'RPL_ADMINEMAIL'], ['261', 'RPL_TRACELOG'],\
-                      ['262', 'RPL_TRACEEND'], ['265', 'RPL_LOCALUSERS'], ['266', 'RPL_GLOBALUSERS'],\
-                      ['300', 'RPL_NONE'], ['301', 'RPL_AWAY'], ['302', 'RPL_USERHOST'], ['303', 'RPL_ISON'],\
-                      ['305', 'RPL_UNAWAY'], ['306', 'RPL_NOWAWAY'], ['311', 'RPL_WHOISUSER'],\
-                      ['312', 'RPL_WHOISSERVER'], ['313', 'RPL_WHOISOPERATOR'], ['314', 'RPL_WHOWASUSER'],\
-                      ['315', 'RPL_ENDOFWHO'], ['316', 'RPL_WHOISCHANOP'], ['317', 'RPL_WHOISIDLE'],\
-                      ['318', 'RPL_ENDOFWHOIS'], ['319', 'RPL_WHOISCHANNELS'], ['321', 'RPL_LISTSTART'],\
-                      ['322', 'RPL_LIST'], ['323', 'RPL_LISTEND'], ['324', 'RPL_CHANNELMODEIS'],\
-                      ['331', 'RPL_NOTOPIC'], ['332', 'RPL_TOPIC'], ['341', 'RPL_INVITING'], \
-                      ['342', 'RPL_SUMMONING'], ['351', 'RPL_VERSION'], ['352', 'RPL_WHOREPLY'],\
-                      ['353', 'RPL_NAMREPLY'], ['361', 'RPL_KILLDONE'], ['362', 'RPL_CLOSING'],\
-                      ['363', 'RPL_CLOSEEND'], ['364', 'RPL_LINKS'], ['365', 'RPL_ENDOFLINKS'],\
-                      ['366', 'RPL_ENDOFNAMES'], ['367', 'RPL_BANLIST'], ['368', 'RPL_ENDOFBANLIST'],\
-                      ['369', 'RPL_ENDOFWHOWAS'], ['371', 'RPL_INFO'], ['372', 'RPL_MOTD'],\
-                      ['373', 'RPL_INFOSTART'], ['374', 'RPL_ENDOFINFO'], ['375', 'RPL_MOTDSTART'],\
-                      ['376', 'RPL_ENDOFMOTD'], ['381', 'RPL_YOUREOPER'], ['382', 'RPL_REHASHING'],\
-                      ['384', 'RPL_MYPORTIS'], ['391', 'RPL_TIME'], ['392', 'RPL_USERSSTART'],\
-                      ['393', 'RPL_USERS'], ['394', 'RPL_ENDOFUSERS'], ['395', 'RPL_NOUSERS'],\
-                      ['401', 'ERR_NOSUCHNICK'], ['402', 'ERR_NOSUCHSERVER'], ['403', 'ERR_NOSUCHCHANNEL'],\
-                      ['404', 'ERR_CANNOTSENDTOCHAN'], ['405', 'ERR_TOOMANYCHANNELS'], ['406', 'ERR_WASNOSUCHNICK'],\
-                      ['407', 'ERR_TOOMANYTARGETS'], ['409', 'ERR_NOORIGIN'], ['411', 'ERR_NORECIPIENT'],\
-                      ['412', 'ERR_NOTEXTTOSEND'], ['413', 'ERR_NOTOPLEVEL'], ['414', 'ERR_WILDTOPLEVEL'],\
-                      ['421', 'ERR_UNKNOWNCOMMAND'], ['422', 'ERR_NOMOTD'], ['423', 'ERR_NOADMININFO'],\
-                      ['424', 'ERR_FILEERROR'], ['431', 'ERR_NONICKNAMEGIVEN'], ['432', 'ERR_ERRONEUSNICKNAME'],\
-                      ['433', 'ERR_NICKNAMEINUSE'], ['436', 'ERR_NICKCOLLISION'], ['441', 'ERR_USERNOTINCHANNEL'],\
-                      ['442', 'ERR_NOTONCHANNEL'], ['443', 'ERR_USERONCHANNEL'], ['444', 'ERR_NOLOGIN'],\
-                      ['445', 'ERR_SUMMONDISABLED'], ['446', 'ERR_USERSDISABLED'], ['461', 'ERR_NEEDMOREPARAMS'],\
-                      ['462', 'ERR_ALREADYREGISTERED'], ['463', 'ERR_NOPERMFORHOST'], ['464', 'ERR_PASSWDMISMATCH'],\
-                      ['465', 'ERR_YOUREBANNEDCREEP'], ['466', 'ERR_YOUWILLBEBANNED'], ['466', 'ERR_KEYSET'],\
-                      ['471', 'ERR_CHANNELISFULL'], ['472', 'ERR_UNKNOWNMODE'], ['473', 'ERR_INVITEONLYCHAN'],\
-                      ['474', 'ERR_BANNEDFROMCHAN'], ['475', 'ERR_BADCHANNELKEY'], ['481', 'ERR_NOPRIVILEGES'],\
-                      ['482', 'ERR_CHANOPRIVSNEEDED'], ['483', 'ERR_CANTKILLSERVER'], ['491', 'ERR_NOOPERHOST'],\
-                      ['492', 'ERR_NOSERVICEHOST'], ['502', 'ERR_USERSDONTMATCH'], ['502', 'ERR_USERSDONTMATCH'],\
-                      ['MODE', 'MODE'], ['TOPIC', 'TOPIC'],
-
-
-        # parse message into command and parameter list.
-        message = self.__parse_message(message)
-
-       # retrieve command from message.
-        command = message[1][0]
-
-        # check what kind of command and respond.
-        for c in irc_command:
-            if command == c[0] or command == c[1]:
-                # retrieve message, print and log it.
-                message = ' '.join(message[1][2:])
-                self.printConsole( message )
-                self.__log_message('server', c[1]+' '+message)
-                return
+            self.on_reply(message)
+            return
+        topic = self.charsets.recode(channel, topic)
+        self.state.set_topic(channel, topic)
 
-        # check what kind of command and respond.
-        if command == 'NICK':
-            self.nickname = message[1][1]
+        # print and log it like on_reply, with topic in UTF-8.
+        text = ' '.join(args[1:-1] + [topic])
+        self.printConsole( text )
+        self.__log_message('server', REPLY_NAMES.get(message.command, message.command)+' '+text)
+    def on_mode(self, message):
+        """ MODE, keeps modes of channel and its members."""
 
-            # retrieve nick name, print and log it.
-            message = '%s is now known as %s' %(message[0], message[1][1])
-            self.printConsole( message )
-            self.__log_message('server','NICK '+message)
+        args = message.args
+        if len(args) > 1:
+            self.state.mode(args[0], args[1], args[2:])
+        self.on_reply(message)
+    def on_nick(self, message):
+        if irc_lower(message.nick) == irc_lower(self.nickname):
+            self.nickname = message.args[0]
+        self.state.rename(message.nick, message.args[0])
 
-        elif command == 'JOIN':
-            # retrieve nick name, print and log it.
-            message = '%s just joined %s' %(message[0], message[1][1])
-            self.printConsole( message )
-            self.__log_message('server','JOIN '+message)
+        # retrieve nick name, print and log it.
+        text = '%s is now known as %s' %(message.nick, message.args[0])
+        self.printConsole( text )
+        self.__log_message('server','NICK '+text, nick=message.nick)
+    def on_join(self, message):
+        channel = message.args[0]
+        if irc_lower(message.nick) == irc_lower(self.nickname):
+            self.channels.add(irc_lower(channel))
+        self.state.join(channel, message.nick, message.user, message.host)
 
-        elif command == 'PART':
-            # retrieve nick name, print and log it.
-            message = '%s just left %s' %(message[0], message[1][1])
-            self.printConsole( message )
-            self.__log_message('server','PART '+message)
+        # retrieve nick name, print and log it.
+        text = '%s just joined %s' %(message.nick, channel)
+        self.printConsole( text )
+        self.__log_message('server','JOIN '+text, channel, message.nick)
+    def on_part(self, message):
+        # channel may come as trailing, PART :#channel.
+        channel = message.args[0]
+        if irc_lower(message.nick) == irc_lower(self.nickname):
+            self.channels.discard(irc_lower(channel))
+            self.state.remove_channel(channel)
+        else:
+            self.state.part(channel, message.nick)
 
-        elif command == 'NOTICE':
-            # retrieve nick name, print and log it.
-            nick_or_channel = ""
-            if self.nickname == message[1][1]:
-                nick_or_channel = message[0]
-            else:
-                nick_or_channel = "%s %s" %(message[1][1], message[0])
-            message = '%s : %s' %(nick_or_channel, message[1][2])
-            self.printConsole( message )
-            self.__log_message('server','NOTICE '+message)
+        # retrieve nick name, print and log it.
+        text = '%s just left %s' %(message.nick, channel)
+        self.printConsole( text )
+        self.__log_message('server','PART '+text, channel, message.nick)
+    def on_kick(self, message):
+        channel, nick = message.params[0], message.params[1]
+        if irc_lower(nick) == irc_lower(self.nickname):
+            self.channels.discard(irc_lower(channel))
+            self.state.remove_channel(channel)
+        else:
+            self.state.part(channel, nick)
+
+        # retrieve nick names, print and log it.
+        text = '%s was kicked from %s by %s : %s' %(nick, channel, message.nick, message.trailing or '')
+        self.printConsole( text )
+        self.__log_message('server','KICK '+text, channel, message.nick)
+    def on_notice(self, message):
+        # drop notices of ignored users, irc server notices have no nick.
+        if message.nick and self.message_filter.ignored(message.prefix):
+            self.__ignored.add()
+            return
+
+        # text may be last middle parameter when it is one word.
+        args = message.args
+        if len(args) < 2:
+            self.on_unknown(message)
+            return
+
+        # retrieve nick name, print and log it.
+        target = args[0]
+        nick_or_channel = ""
+        if irc_lower(self.nickname) == irc_lower(target):
+            nick_or_channel = channel = message.nick
+        else:
+            nick_or_channel = "%s %s" %(target, message.nick)
+            channel = target
+        trailing = self.charsets.recode(channel, args[1])
+        text = '%s : %s' %(nick_or_channel, trailing)
+        self.printConsole( self.__highlight(text, trailing) )
+        self.__log_message('server','NOTICE '+text, channel, message.nick, message.time)
+    def on_privmsg(self, message):
+        # drop messages of ignored users, their ctcp and dcc offers too.
+        if self.message_filter.ignored(message.prefix):
+            self.__ignored.add()
+            return
+
+        # text may be last middle parameter when it is one word.
+        args = message.args
+        if len(args) < 2:
+            self.on_unknown(message)
+            return
+
+        #check if this is ctcp message
+        if args[1][:1] == '\001':
+            self.__process_ctcp_server_command(message, args[1])
+            return
+
+        # retrieve nick name, print and log it.
+        target = args[0]
+        nick_or_channel = ""
+        if irc_lower(self.nickname) == irc_lower(target):
+            nick_or_channel = channel = message.nick
+        else:
+            nick_or_channel = "%s %s" %(target, message.nick)
+            channel = target
+        trailing = self.charsets.recode(channel, args[1])
+        text = '%s : %s' %(nick_or_channel, trailing)
+        self.printConsole( self.__highlight(text, trailing) )
+        self.__log_message('server','PRIVMSG '+text, channel, message.nick, message.time)
+    def on_cap(self, message):
+        """ CAP, IRCv3 capability negotiation.
+
+        We ask for CAPABILITIES irc server lists in CAP LS, and end
+        negotiation when it acknowledges or refuses them. Capabilities irc
+        server adds later, with CAP NEW, are asked for too.
+        """
+
+        args = message.args
+        if len(args) < 3:
+            return
+        subcommand = args[1].upper()
+        names = args[-1].split()
 
-        elif command == 'PRIVMSG':
-            #check if this is ctcp message
-            if message[1][2][0] == '\001':
-                self.__process_ctcp_server_command(message)
+        # CAP LS may come in more than one line, all but the last with '*'.
+        if subcommand in ('LS', 'NEW'):
+            offered = set(name.partition('=')[0] for name in names)
+            self.__offered |= offered
+            if subcommand == 'LS' and len(args) > 3 and args[2] == '*':
+                return
+            if subcommand == 'NEW':
+                offered -= self.capabilities
             else:
-                # retrieve nick name, print and log it.
-                nick_or_channel = ""
-                if self.nickname == message[1][1]:
-                    nick_or_channel = message[0]
+                offered = self.__offered
+            wanted = [name for name in self.CAPABILITIES if name in offered]
+            if wanted:
+                self.__send('CAP REQ :'+' '.join(wanted))
+            elif self.__negotiating:
+                self.__end_negotiation()
+
+        elif subcommand == 'ACK':
+            for name in names:
+                if name[:1] == '-':
+                    self.capabilities.discard(name[1:])
                 else:
-                    nick_or_channel = "%s %s" %(message[1][1], message[0])
-                message = '%s : %s' %(nick_or_channel, message[1][2])
-                self.printConsole( message )
-                self.__log_message('server','PRIVMSG '+message)
+                    self.capabilities.add(name)
+            self.printConsole( 'capabilities: %s' %(' '.join(sorted(self.capabilities))) )
+            if self.__negotiating:
+                self.__end_negotiation()
 
-        # we have command which we do not recognize and only print it out to console
-        else:
-            self.printConsole( '%s : %s' %(message[0], message[1]) )
+        elif subcommand == 'NAK':
+            if self.__negotiating:
+                self.__end_negotiation()
+
+        elif subcommand == 'DEL':
+            self.capabilities.difference_update(names)
+            self.__offered.difference_update(names)
+    def __end_negotiation(self):
+        self.__negotiating = False
+        self.__send('CAP END')
+    def on_away(self, message):
+        """ AWAY of away-notify, keeps away message of users we share a channel with."""
+
+        self.state.set_away(message.nick, message.trailing)
+    def on_batch(self, message):
+        """ BATCH, starts or ends a batch of messages.
+
+        Messages tagged with reference of a batch are kept until it ends,
+        then the handler of its type in BATCH_HANDLERS gets all of them.
+        A batch inside another one is handled with the outer one.
+        """
+
+        args = message.args
+        if not args:
+            return
+        reference = args[0]
+        if reference[:1] == '+':
+            outer = self.__batches.get(message.tags.get('batch'))
+            batch = Batch(reference[1:], args[1] if len(args) > 1 else '', args[2:], outer is not None)
+            if outer is not None:
+                outer.messages.append(batch)
+            self.__batches[batch.reference] = batch
+        elif reference[:1] == '-':
+            batch = self.__batches.pop(reference[1:], None)
+            if batch is not None and not batch.nested:
+                self.handle_batch(batch)
+    def handle_batch(self, batch):
+        """ sends batch which has ended to handler of its type."""
+
+        # batch types come from irc server, unknown ones share one series.
+        kind = batch.type.lower()
+        handler = BATCH_HANDLERS.get(kind)
+        if handler is None:
+            handler, kind = IrcClient.on_batch_messages, 'unknown'
+        command = 'batch '+kind
+        histogram = self.__handler_times.get(command) or self.__handler_time(command)
+        begin = time.time()
+        handler(self, batch)
+        histogram.observe(time.time() - begin)
+    def on_batch_messages(self, batch):
+        """ batch of a type we do not know, its messages are handled one by one."""
+
+        for message in batch.messages:
+            if isinstance(message, Batch):
+                self.handle_batch(message)
+            else:
+                self.__handle(message)
+    def on_netsplit(self, batch):
+        """ netsplit batch, QUITs of users behind servers which split.
+
+        All of them leave state together, and the split is printed and
+        logged as one line instead of a line for every user.
+        """
+
+        nicks = [message.nick for message in batch.messages
+                 if isinstance(message, Message) and message.command == 'QUIT']
+        for nick in nicks:
+            self.state.quit(nick)
+        text = '%s split, %d users quit: %s' %(' '.join(batch.params), len(nicks), ' '.join(nicks))
+        self.printConsole( text )
+        self.__log_message('server', 'NETSPLIT '+text)
+    def on_netjoin(self, batch):
+        """ netjoin batch, JOINs of users behind servers which are back."""
+
+        nicks = []
+        for message in batch.messages:
+            if isinstance(message, Message) and message.command == 'JOIN' and message.params:
+                self.state.join(message.params[0], message.nick, message.user, message.host)
+                nicks.append(message.nick)
+        text = '%s back, %d users joined again: %s' %(' '.join(batch.params), len(nicks), ' '.join(nicks))
+        self.printConsole( text )
+        self.__log_message('server', 'NETJOIN '+text)
+    def on_history(self, batch):
+        """ chathistory batch, messages of a channel or nick played back.
+
+        Messages are printed with their server time and logged with it, in
+        UTF-8 and one write to log writer. They do not go to the handlers of PRIVMSG
+        and NOTICE, old CTCP requests and DCC offers are not answered again.
+        Messages of nested batches are played back with the others, all of
+        them in order of server time.
+        """
+
+        messages = []
+        batches = [batch]
+        while batches:
+            for message in batches.pop().messages:
+                if isinstance(message, Batch):
+                    batches.append(message)
+                elif message.command in ('PRIVMSG', 'NOTICE') and len(message.args) > 1:
+                    messages.append((message.time or time.time(), message))
+        messages.sort(key=operator.itemgetter(0))
+
+        records = []
+        recode = self.charsets.recode
+        minute = date = None
+        for timestamp, message in messages:
+            if self.message_filter.ignored(message.prefix):
+                continue
+            channel = message.params[0]
+            if irc_lower(channel) == irc_lower(self.nickname):
+                channel = message.nick
+            text = '%s %s : %s' %(channel, message.nick, recode(channel, message.args[1]))
+
+            # only format the date when the minute changes.
+            if timestamp // 60 != minute:
+                minute = timestamp // 60
+                date = time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+            self.printConsole( '[%s] %s' %(date, text) )
+            records.append((timestamp, 'server', message.command+' '+text, self.host, channel, message.nick))
+        self.log_writer.write_many(records)
+    def __highlight(self, text, trailing):
+        """ returns text to print, marked if trailing has a highlight keyword."""
+
+        keyword = self.message_filter.highlight(trailing)
+        if keyword is None:
+            return text
+        self.__highlights.add()
+        return '*** %s' % text
+    def on_unknown(self, message):
+        """ we have command which we do not recognize and only print it out to console."""
+
+        self.printConsole( '%s : %s %s' %(message.prefix, message.command, ' '.join(message.args)) )
 
     def __process_ctcp_console_command(self, message):
         # retrieve command from message.
-        words = message.split(' ')
+        words = message.split()
+        if len(words) < 3:
+            self.printConsole( 'usage: /ctcp NICK COMMAND' )
+            return
         command = words[2].lower()
         if command == 'version':
             msg = "/privmsg %s %s" %(words[1],'\001VERSION\001' )
             self.message_queue.put(msg)
         else:
             self.printConsole( message )
-    def __process_ctcp_server_command(self, message):
-        command = message[1][2]
-        event = message[1][2][1:len(message[1][2])-1].split(' ')
+    def __process_ctcp_server_command(self, message, command):
+        event = command.strip('\001').split(' ')
+
+        # requests we answer or act on, only a few at once of every source,
+        # offers of files are counted apart from the rest.
+        source = message.host or message.nick
+        offer = len(event) > 1 and event[0].upper() == "DCC" and event[1].upper() in ("SEND", "TSEND")
+        if offer:
+            allowed = self.ctcp_policy.consider(source)
+        elif command == '\001VERSION\001' or event[0].upper() == "DCC":
+            allowed = self.ctcp_policy.answer(source)
+        else:
+            allowed = True
+        if not allowed:
+            self.__ctcp_dropped.add()
+            return
 
         if command == '\001VERSION\001':
-            msg = "/privmsg %s %s" %(message[0], 'VERSION Python-Irc-Client' + " "
+            msg = "/privmsg %s %s" %(message.nick, 'VERSION Python-Irc-Client' + " "
                     + platform.system() + " " + platform.release())
             self.message_queue.put(msg)
-        elif event[0].upper() == "DCC" and event[1].upper() == "SEND":
-            self.printConsole( event )
-            thread.start_new_thread(self.__recv_DCC, (event[2], int(event[3]), int(event[4]), int(event[5]), message[0]) )
+        elif offer:
+            self.__recv_DCC(message, event[1].upper() == "TSEND", command.strip('\001'))
+        elif len(event) > 1 and event[0].upper() == "DCC" and event[1].upper() in ("RESUME", "ACCEPT"):
+            self.__resume_DCC(message.nick, event[1].upper(), command.strip('\001'))
         else:
             self.printConsole( message )
 
-    def __recv_DCC(self, filename, ip, port, datasize, nick=""):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __search(self, rest):
+        """ handles /search console command.
+
+            /search [#channel] [channel:C] [nick:N] [network:H] [since:T] [until:T]
+                    [limit:N] words
+
+        T is a date YYYY-mm-dd or a time ago such as 30m, 12h or 7d. Words
+        are a full text query, e.g. deploy OR release.
+        """
+
+        store = self.log_writer.store
+        if store is None:
+            self.printConsole( 'no scrollback store' )
+            return
+
+        query = {'limit': 20}
+        words = []
         try:
-            s.connect((int_to_dqn(ip), port))
-        except socket.error as e:
-            msg = "/privmsg %s failed to connect to your host" %nick
-            self.message_queue.put(msg)
-        newFile = open(filename, 'wb')
-        while True:
-            da = s.recv(1024)
-            if not da :
-                break
-            newFile.write(da)
-            if newFile.tell() == datasize:
-                break
-        s.close()
-        if newFile.tell() < datasize:
-            msg = "/privmsg %s failed to recieve %s" %(nick, filename)
-            self.message_queue.put(msg)
-        else :
-            message = "Success Transfer File from %s : %s" %(nick, filename)
-            self.printConsole( message )
-        newFile.close()
+            for word in rest.split():
+                key, _, value = word.partition(':')
+                if word[0] in '#&':
+                    query['channel'] = word
+                elif key in ('channel', 'nick', 'network') and value:
+                    query[key] = value
+                elif key in ('since', 'until') and value:
+                    query[key] = parse_search_time(value)
+                elif key == 'limit' and value.isdigit():
+                    query['limit'] = int(value)
+                else:
+                    words.append(word)
 
-    def __recv_server(self):
-        """ retrieves message from irc server.
+            begin = time.time()
+            results = store.search(' '.join(words) or None, **query)
+        except (ValueError, sqlite3.Error) as e:
+            self.printConsole( 'invalid search %s : %s' %(rest, e) )
+            return
 
-        Runs in constant loop while connection to irc server is up.
-        In each iteration we retrieve response from irc server and add
-        it to buffer which contains end of last response.
-        We split buffer into list of message on '\r\n' and add all but last
-        element to message queue of client, we finish by setting
-        buffer to last element in list of messages.
-        If end of response is complete message last element is '' otherwise
-        last element is incomplete message.
+        for timestamp, network, channel, nick, source, text in reversed(results):
+            self.printConsole( '%s %s %s %s' %(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp)),
+                                               network, channel, text) )
+        self.printConsole( '%d messages found in %.1f ms' %(len(results), (time.time() - begin) * 1000) )
+    def __filter_command(self, command, rule):
+        """ handles /ignore, /unignore, /highlight and /unhighlight console commands.
+
+            /ignore [mask]          ignores nick!user@host mask, e.g. nick or
+                                    *!*@*.example.org, lists masks without one.
+            /unignore mask          stops ignoring mask.
+            /highlight [keyword]    highlights messages with keyword, lists
+                                    keywords without one.
+            /unhighlight keyword    stops highlighting keyword.
         """
 
-        # runs while connection to server is up.
-        while True:
+        message_filter = self.message_filter
+        if command == 'IGNORE' and rule:
+            message_filter.add_ignore(rule)
+        elif command == 'HIGHLIGHT' and rule:
+            message_filter.add_highlight(rule)
+        elif command == 'UNIGNORE' and not message_filter.remove_ignore(rule):
+            self.printConsole( 'not ignoring %s' % rule )
+        elif command == 'UNHIGHLIGHT' and not message_filter.remove_highlight(rule):
+            self.printConsole( 'not highlighting %s' % rule )
+        self.printConsole( 'ignoring: %s' % (', '.join(message_filter.ignores) or 'nobody') )
+        self.printConsole( 'highlighting: %s' % (', '.join(message_filter.highlights) or 'nothing') )
+    def __stats(self, rest):
+        """ handles /stats console command.
 
-            # retrieve response from irc server and add to buffer.
-            self.buffer += self.irc_sever.recv(4096)
+            /stats                       counters and handler times of client.
+            /stats profile start|stop    starts or stops sampling profiler.
+            /stats profile clear         throws away samples of profiler.
+            /stats profile               shows where profiler saw time go.
 
-            # if buffer is empty we know connection is down, and we stop the while loop.
-            if self.buffer == '':
-                print 'Connection down'
-                self.running = False
-                break
+        /stats with a query letter, e.g. /stats u, is sent to irc server.
+        """
 
-            # we process response from server.
+        words = rest.split()
+        if words:
+            action = words[1] if len(words) > 1 else ''
+            if action == 'start':
+                PROFILER.start()
+                self.printConsole( 'profiler started' )
+            elif action == 'stop':
+                PROFILER.stop()
+                self.printConsole( 'profiler stopped' )
+            elif action == 'clear':
+                PROFILER.clear()
             else:
+                for line in PROFILER.report():
+                    self.printConsole( line )
+            return
 
-                # split response into messages on '\r\n'.
-                messages = self.buffer.split('\r\n')
+        # byte rates since last /stats.
+        now = time.time()
+        then, received, sent = self.__last_stats
+        elapsed = max(now - then, 1e-6)
+        self.__last_stats = (now, self.__bytes_received.value, self.__bytes_sent.value)
+        self.printConsole( 'received %d bytes (%.1f kB/s), sent %d bytes (%.1f kB/s), dropped %d lines' %(
+            self.__bytes_received.value, (self.__bytes_received.value - received) / elapsed / 1024,
+            self.__bytes_sent.value, (self.__bytes_sent.value - sent) / elapsed / 1024,
+            self.__lines_dropped.value) )
+        self.printConsole( 'message queue %d (%s, %d dropped, %d spilled), send queue %d' %(
+            self.message_queue.depth, self.message_queue.policy, self.message_queue.dropped,
+            self.message_queue.spilled, self.send_queue.depth) )
+        pool = self.handler_pool
+        if pool is not None:
+            self.printConsole( 'handler pool: %d waiting, %d run, %d failed, %d timed out, %d expired' %(
+                pool.depth(), pool.completed, pool.failed, pool.timed_out, pool.expired) )
 
-                # add each but the last message to message queue of client.
-                for message in messages[:-1]:
-                    self.message_queue.put(message)
+        # handlers which took most time first.
+        self.printConsole( '%-16s %9s %9s %9s %9s %9s' %('command', 'count', 'p50 us', 'p99 us', 'max us', 'total ms') )
+        for command, histogram in sorted(self.__handler_times.items(), key=lambda item: -item[1].sum):
+            self.printConsole( '%-16s %9d %9.0f %9.0f %9.0f %9.1f' %(
+                command, histogram.count, histogram.percentile(50) * 1e6, histogram.percentile(99) * 1e6,
+                histogram.max * 1e6, histogram.sum * 1e3) )
+    def __process_dcc_console_command(self, rest):
+        """ handles /dcc console commands.
 
-                # set buffer to last message in response.
-                # is '' if last message was complete.
-                # is 1 or more chars otherwise.
-                self.buffer = messages[-1]
-    def __recv_console(self):
-        """ retrieves message from console.
+            /dcc                    show progress of DCC transfers.
+            /dcc send NICK PATH     offer file to nick.
+            /dcc limit KB           limit all transfers to KB kB/s, 0 for no limit.
+            /dcc allow|deny RULE    accept or reject offers of CIDR range or hostmask.
+            /dcc remove RULE        removes rule.
+            /dcc max N              run at most N transfers at once.
+            /dcc policy [accept|reject]
+                                    show rules, accept or reject offers of no rule.
+        """
 
-        Runs in a constant loop while client is running..
-        In each iteration we retrieve  response from console and add
-        it to message queue of client.
+        words = rest.split(' ', 2)
+
+        if not rest:
+            for transfer in self.transfers:
+                state = 'done' if transfer.finished else 'running'
+                if transfer.error is not None:
+                    state = transfer.error
+                self.printConsole( '%s [%s]' %(transfer.progress(), state) )
+
+        elif words[0].lower() == 'send' and len(words) == 3:
+            self.__send_DCC(words[1], os.path.expanduser(words[2]))
+
+        elif words[0].lower() == 'limit' and len(words) == 2 and words[1].isdigit():
+            DCC_BANDWIDTH.set_rate(int(words[1]) * 1024 or None)
+
+        elif words[0].lower() in ('allow', 'deny') and len(words) == 2:
+            self.ctcp_policy.add_rule(words[1], words[0].lower() == 'allow')
+
+        elif words[0].lower() == 'remove' and len(words) == 2:
+            if not self.ctcp_policy.remove_rule(words[1]):
+                self.printConsole( 'no DCC rule %s' % words[1] )
+
+        elif words[0].lower() == 'max' and len(words) == 2 and words[1].isdigit():
+            self.ctcp_policy.max_transfers = int(words[1])
+
+        elif words[0].lower() == 'policy':
+            policy = self.ctcp_policy
+            if len(words) > 1 and words[1].lower() in ('accept', 'reject'):
+                policy.accept_unlisted = words[1].lower() == 'accept'
+            rules = [('allow' if allow else 'deny', cidr) for cidr, allow in policy.cidrs.rules]
+            rules += [('allow', mask) for mask in policy.allowed.ignores]
+            rules += [('deny', mask) for mask in policy.denied.ignores]
+            for verdict, rule in rules:
+                self.printConsole( '%s %s' %(verdict, rule) )
+            self.printConsole( '%s offers of no rule, at most %d transfers, per second of a source %g CTCP requests and %g offers' %(
+                'accept' if policy.accept_unlisted else 'reject', policy.max_transfers,
+                policy.replies.rate, policy.offers.rate) )
+
+        else:
+            self.printConsole( '/dcc '+rest )
+    def __send_DCC(self, nick, path):
+        """ offers file to nick with DCC SEND."""
+
+        address = self.dcc_address or self.irc_sever.getsockname()[0]
+        try:
+            transfer = DccSend(nick, path, '', self.printConsole, self.__DCC_done)
+            offer = transfer.offer(address)
+        except (OSError, socket.error, ValueError, IndexError) as e:
+            self.printConsole( 'can not offer %s : %s' %(path, e) )
+            return
+
+        self.transfers.append(transfer)
+        self.__send('PRIVMSG %s :%s' %(nick, offer))
+        transfer.start()
+    def __resume_DCC(self, nick, command, message):
+        """ handles DCC RESUME and DCC ACCEPT.
+
+        RESUME filename port position comes from receiver of a file we offer,
+        we answer with ACCEPT and send file from position. ACCEPT answers
+        RESUME we sent for a file offered to us, we receive it from position.
         """
 
-        # runs while client is running.
-        while self.running:
+        words = split_ctcp(message)
+        try:
+            port, position = int(words[3]), int(words[4])
+        except (IndexError, ValueError):
+            self.printConsole( 'invalid DCC %s from %s : %s' %(command, nick, message) )
+            return
 
-            # retrieve message from console and add to message queue of client.
-            message = raw_input('> ')
-            self.message_queue.put(message)
-            time.sleep(0.5)
-    def __log_message(self, type, message):
-        """ log message to log file
+        if command == 'RESUME':
+            for transfer in self.transfers:
+                if isinstance(transfer, DccSend) and transfer.port == port \
+                        and transfer.nick.lower() == nick.lower() and transfer.resume(position):
+                    self.__send('PRIVMSG %s :\001DCC ACCEPT %s %d %d\001' %(nick, quote_ctcp(words[2]), port, position))
+                    return
+            self.printConsole( 'can not resume DCC for %s : %s' %(nick, message) )
 
-        Logs sent and retrieved messages to log file in the format
-            Date : source (server/client) : message.
+        else:
+            offer = self.__resumes.pop((nick.lower(), port), None)
+            if offer is None:
+                self.printConsole( 'unexpected DCC ACCEPT from %s : %s' %(nick, message) )
+                return
+            filename, ip, size, turbo, path, resume_position, sent = offer
+
+            # we only have the file up to where we asked to resume.
+            if position != resume_position:
+                self.__dcc_rejected.add()
+                self.printConsole( 'DCC ACCEPT from %s at %d, we asked for %d : %s' %(nick, position, resume_position, message) )
+                return
+            if not self.__DCC_slot():
+                self.__dcc_rejected.add()
+                self.printConsole( 'rejected DCC ACCEPT from %s : %s' %(nick, message) )
+                return
+            transfer = DccReceive(nick, filename, ip, port, size, self.download_directory,
+                                  turbo, self.printConsole, self.__DCC_done, path, position)
+            self.transfers.append(transfer)
+            self.printConsole( 'resuming %s from %s at %d' %(filename, nick, position) )
+            transfer.start()
+
+    def __recv_DCC(self, message, turbo, offer):
+        """ starts receiving file offered with DCC SEND or TSEND.
+
+        Offers ctcp policy rejects and offers while we run max_transfers
+        transfers are dropped.
 
         Args:
-            message: message we want to log.
+            message: PRIVMSG with offer.
+            turbo: True for TSEND, sender does not want acknowledgements.
+            offer: ctcp message, DCC SEND filename ip port [size].
         """
 
-        # timestamp
-        date = time.gmtime()
+        nick = message.nick
+        words = split_ctcp(offer)
+        try:
+            filename, ip, port = words[2], int(words[3]), int(words[4])
+            size = int(words[5]) if len(words) > 5 else 0
+        except (IndexError, ValueError):
+            self.printConsole( 'invalid DCC offer from %s : %s' %(nick, offer) )
+            return
 
-        # format log message for log file in the format
-        # Date : source (server/client) : message.
-        msg = '%s : %s : %s\n' %(time.strftime("%a %d %b %Y %X %z", date ),
-                                 type, message)
+        if not self.ctcp_policy.accept(message.prefix, message.host, ip) or not self.__DCC_slot():
+            self.__dcc_rejected.add()
+            self.printConsole( 'rejected DCC offer from %s : %s' %(nick, offer) )
+            return
 
-        # write log message to log file
-        self.log_file.write(msg)
-    def __parse_message(self, message):
-        """ split message into prefix and list of parameters.
+        # we have part of file already, ask sender to resume where it ended.
+        path = os.path.join(self.download_directory, safe_filename(filename))
+        if self.dcc_resume and size and os.path.isfile(path) and 0 < os.path.getsize(path) < size:
+            position = os.path.getsize(path)
 
-        We assume the message has the form :prefix list_of_parameters.
+            # forget resumes senders never accepted.
+            now = time.time()
+            for key, resume in self.__resumes.items():
+                if now - resume[-1] > self.RESUME_TIMEOUT:
+                    del self.__resumes[key]
+            self.__resumes[(nick.lower(), port)] = (filename, ip, size, turbo, path, position, now)
+            self.__send('PRIVMSG %s :\001DCC RESUME %s %d %d\001' %(nick, quote_ctcp(words[2]), port, position))
+            return
 
-        Args:
-            message: message we want to parse
+        transfer = DccReceive(nick, filename, ip, port, size, self.download_directory,
+                              turbo, self.printConsole, self.__DCC_done)
+        self.transfers.append(transfer)
+        self.printConsole( 'receiving %s from %s into %s' %(filename, nick, transfer.path) )
+        transfer.start()
+    def __DCC_slot(self):
+        """ True if we run fewer DCC transfers than ctcp policy allows."""
 
-        Returns:
-            A tuple of prefix who is string and parameter list who is tuple of strings.
+        running = sum(1 for transfer in self.transfers if not transfer.finished)
+        return running < self.ctcp_policy.max_transfers
+    def __DCC_done(self, transfer):
+        """ called from thread of transfer when it has ended."""
+
+        if transfer.error is not None:
+            msg = "/privmsg %s %s" %(transfer.nick, transfer.error)
+            self.post(msg)
+        elif isinstance(transfer, DccSend):
+            message = "Success Transfer File to %s : %s" %(transfer.nick, transfer.path)
+            self.printConsole( message )
+        else :
+            message = "Success Transfer File from %s : %s" %(transfer.nick, transfer.path)
+            self.printConsole( message )
+
+    def __recv_server(self):
+        """ retrieves message from irc server.
+
+        Called from the main loop when the irc server socket is readable.
+        The line buffer receives response from irc server and splits it into
+        complete messages, keeping the end of an incomplete message for the
+        next response. All messages of a response are added to message queue
+        of client, which handles PING, PONG and ERROR first.
+
+        We read up to MAX_READS responses, so waiting data moves from the
+        socket into message queue, where PINGs can skip the line, instead of
+        piling up in the socket while we handle messages.
         """
 
-        # validate message is not empty
-        if message:
+        for i in xrange(self.MAX_READS):
+
+            # retrieve complete messages from irc server.
+            received, dropped = self.lines.received, self.lines.dropped
+            try:
+                messages = self.lines.recv_from(self.irc_sever)
+            except socket.error as e:
+                if would_block(e):
+                    return
+                messages = None
+            self.__bytes_received.add(self.lines.received - received)
+            self.__lines_dropped.add(self.lines.dropped - dropped)
+
+            # connection is down, we stop when messages in queue are handled.
+            if messages is None:
+                self.__disconnected()
+                return
 
-            # retrieve prefix from message.
-            # first split gives us the list
-            #        ['', prefix + parameters ], (possible) trailer ].
-            # second split gives us prefix from the element prefix + parameters.
-            prefix = message.split(':')[1].split(' ')[0]
+            # add messages to message queue of client, PINGs skip the line.
+            if messages:
+                self.message_queue.put_lines(messages)
+                self.__queue_dropped.value = self.message_queue.dropped
+                self.__queue_spilled.value = self.message_queue.spilled
+    def __disconnected(self):
+        """ connection to irc server is down, close it.
 
-            # retrieve list of parameters from message.
-            parameters = message.split(':')[1].split(' ')[1:]
+        Unless we quit, a thread reconnects after backoff. Without backoff
+        client stops when it has handled messages left in queue.
+        """
 
-            # we have more than 1 ':' in message and then we know message contains trailer.
-            if message.count(':') > 1:
+        self.printConsole( 'Connection down' )
+        self.connected = False
+        self.irc_sever.close()
+        if self.backoff is not None and self.__quit_deadline is None and not self.__reconnecting:
+            self.__reconnecting = True
+            self.__dropped = time.time()
+            thread.start_new_thread(self.__reconnect, ())
+    def __reconnect(self):
+        """ connects to irc server again, runs in a thread of its own.
 
-                # add trailer to list of parameters.
-                parameters.append(''.join(message.split(':')[2:]))
+        Waits for backoff before every attempt. The new connection is taken
+        over by the engine thread, in process_messages.
+        """
 
+        while self.running and self.__quit_deadline is None:
+            delay = self.backoff.delay()
+            self.printConsole( 'reconnecting to %s:%d in %.1f s' %(self.host, self.port, delay) )
+            time.sleep(delay)
+            if not self.running or self.__quit_deadline is not None:
+                return
             try:
-                parameters.remove('')
-            except ValueError:
-                pass
+                self.__new_server = self.transport.connect(self.host, self.port)
+            except (socket.error, ssl.CertificateError) as e:
+                self.printConsole( 'failed to connect to %s:%d : %s' %(self.host, self.port, e) )
+                continue
+            if self.engine is not None:
+                self.engine.wake()
+            return
+    def __reconnected(self):
+        """ takes over connection of reconnect thread and registers again.
+
+        Channels we were in are joined again once irc server welcomes us.
+        """
 
-            return prefix, parameters
+        self.irc_sever, self.__new_server = self.__new_server, None
+        self.connected = True
+        self.__reconnecting = False
+        self.__welcomed = False
+        self.__outgoing = ''
+        self.lines = LineBuffer()
+        self.state = IrcState()
+        self.send_queue.refill()
+        self.__reconnects.add()
+        self.printConsole( 'Connection up again after %.2f s' %(time.time() - self.__dropped) )
+        self.register()
+        self.flush()
+    def __log_message(self, type, message, channel='', nick='', timestamp=None):
+        """ log message to log file
+
+        Logs sent and retrieved messages to log file in the format
+            Date : source (server/client) : message.
+        Formatting and writing is done by the log writer thread.
+
+        Args:
+            message: message we want to log.
+            channel: channel message is from, for scrollback store.
+            nick: nick message is from, for scrollback store.
+            timestamp: time of message, from server-time tag, defaults to now.
+        """
+
+        self.log_writer.write(type, message, self.host, channel, nick, timestamp)
 
     # http://stackoverflow.com/a/4653306
     def printConsole(self,msg):
-        sys.stdout.write('\r'+' '*(len(readline.get_line_buffer())+2)+'\r')
+        # renderer of engine writes output in frames, headless engines
+        # without renderer only log.
+        if self.engine is not None:
+            if self.engine.renderer is not None:
+                self.engine.renderer.write(self.host, msg)
+            return
+        buffer = readline.get_line_buffer() if readline is not None else ''
+        sys.stdout.write('\r'+' '*(len(buffer)+2)+'\r')
         print msg
-        sys.stdout.write('> ' + readline.get_line_buffer())
+        sys.stdout.write('> ' + buffer)
         sys.stdout.flush()
 
 
-    def part1(self):
-        """ runs part 1 assignment """
-
-        # register to irc server.
-        self.nick(client.nickname)
-        self.user(client.username, client.host, client.server, client.realname)
-
         # terminates program
         def send_quit():
-            self.message_queue.put('/quit')
+            self.post('/quit')
 
         timer = Timer(120, send_quit)
         timer.start()
         self.run()
 
 
+def parse_address(address, default_port=TcpTransport.DEFAULT_PORT):
+    """ split address of irc server in the form [nick@]host[:[+]port].
+
+    A port starting with '+' is a TLS port, '+' alone is the default one.
+
+    Returns:
+        Tuple of nick (None if missing), host, port and True for TLS.
+    """
+
+    nick = None
+    if '@' in address:
+        nick, address = address.split('@', 1)
+    host, _, port = address.rpartition(':')
+    tls = port.startswith('+')
+    if tls:
+        port = port[1:] or str(TlsTransport.DEFAULT_PORT)
+    if not host or not port.isdigit():
+        return nick, address, default_port, False
+    return nick, host, int(port), tls
+
+
+class IrcEngine(object):
+    """ runs irc clients for many irc servers on one event loop.
+
+    The engine blocks in select until one of the irc server connections or
+    its wakeup pipe is readable, then lets every client handle its waiting
+    messages. Each client keeps its own nick, port and channels, everything
+    runs on the thread calling run, except reading from console.
+
+    Console output of clients is written by renderer. Without console the
+    engine runs headless, nothing is read from console and output only
+    goes to renderer if there is one, e.g. a JsonLinesRenderer.
+
+    Console input goes to the active client, the first one by default.
+    The engine handles a few console commands itself,
+        /server            list clients, active one marked with *.
+        /server N          make client number N active.
+        /connect ADDRESS   connect to irc server [nick@]host[:[+]port],
+                           + for TLS, the new client becomes active once
+                           it is connected.
+
+    Attributes:
+        clients: list of running clients.
+        active: client which gets console input.
+        log_writer: LogWriter shared by clients created by the engine.
+        wakeup: pipe used to wake up the event loop when a message is queued
+            from another thread.
+        console_queue: queue for messages from console.
+        connected_queue: queue for clients, or errors, of connections made
+            by connect threads, taken over by the event loop.
+        connecting: number of connect threads still running.
+        console: read input from console.
+        verify: check certificates of TLS irc servers of /connect.
+        renderer: ConsoleRenderer writing console output, None for none.
+        running: boolean value for if engine should be running.
+    """
+
+    def __init__(self, clients=(), log_writer=None, console=True, renderer=None, verify=True):
+        self.clients = []
+        self.active = None
+        self.log_writer = log_writer
+        self.console = console
+        self.verify = verify
+        if renderer is None and console:
+            renderer = ConsoleRenderer()
+        self.renderer = renderer
+        self.wakeup = os.pipe()
+        self.console_queue = Queue.Queue()
+        self.connected_queue = Queue.Queue()
+        self.connecting = 0
+        self.running = True
+        for client in clients:
+            self.add(client)
+
+    def add(self, client):
+        """ add client to engine, it is run from next pass of event loop."""
+
+        client.engine = self
+        self.clients.append(client)
+        if self.active is None:
+            self.active = client
+        if self.renderer is not None:
+            self.renderer.show_network = len(self.clients) > 1
+        self.wake()
+
+    def connect(self, address):
+        """ connect new client to irc server at [nick@]host[:[+]port] and register it.
+
+        Connecting may take until timeout of transport, so it is done by a
+        thread of its own, the event loop keeps running other clients. The
+        new client is added, registered and made active by the event loop.
+        """
+
+        nick, host, port, tls = parse_address(address)
+        if self.log_writer is None:
+            self.log_writer = default_log_writer()
+        self.connecting += 1
+        thread.start_new_thread(self.__connect, (address, nick, host, port, tls))
+
+    def __connect(self, address, nick, host, port, tls):
+        """ connects client to irc server, runs in a thread of its own."""
+
+        try:
+            client = IrcClient(host, port, self.log_writer, nick or 'defaultNick',
+                               transport=TlsTransport(self.verify) if tls else None)
+        except (socket.error, ssl.CertificateError) as e:
+            self.connected_queue.put((address, e))
+        else:
+            self.connected_queue.put((address, client))
+        self.wake()
+
+    def __process_connected(self):
+        """ adds and registers clients of connect threads."""
+
+        while True:
+            try:
+                address, client = self.connected_queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            self.connecting -= 1
+            if not isinstance(client, IrcClient):
+                if self.active is not None:
+                    self.active.printConsole('failed to connect to %s : %s' %(address, client))
+                continue
+            self.add(client)
+            self.active = client
+            client.register()
+
+    def wake(self):
+        """ wake up event loop, safe to call from any thread."""
+
+        os.write(self.wakeup[1], 'x')
+
+    def start(self):
+        """ registers every client and runs engine, with console input
+        unless headless."""
+
+        # open new thread for receiving input from console.
+        if self.console:
+            thread.start_new_thread(self.__recv_console, ())
+
+        for client in self.clients:
+            client.register()
+
+        self.run()
+
+    def run(self):
+        """ event loop of the engine, runs while any client is running.
+
+        Blocks until an irc server connection or the wakeup pipe is readable,
+        so messages are handled as soon as they arrive. Clients with more
+        than MAX_BATCH waiting messages only get to handle MAX_BATCH of them
+        in each pass, so one busy irc server can not starve the others.
+        """
+
+        busy = False
+        while self.running and (self.clients or self.connecting):
+
+            # somebody still has messages in queue, or received data select
+            # can not see, only peek at sockets. otherwise sleep until flood
+            # control lets somebody send.
+            reading = [client for client in self.clients if client.connected]
+            buffered = [client for client in reading if client.buffered()]
+            timeout = 0 if busy or buffered else self.__send_delay()
+            writing = [client for client in self.clients if client.wants_write()]
+            readable, writable, _ = select.select(reading + [self.wakeup[0]],
+                                                  writing, [], timeout)
+            readable += [client for client in buffered if client not in readable]
+
+            # send rest of messages connections could not take before.
+            for client in writable:
+                self.__guard(client, client.flush)
+
+            # another thread queued a message, empty the pipe.
+            for ready in readable:
+                if ready is self.wakeup[0]:
+                    os.read(self.wakeup[0], 4096)
+                    self.__process_connected()
+                    self.__process_console()
+                else:
+                    self.__guard(ready, ready.receive)
+
+            # let each client handle its messages and send its replies.
+            busy = False
+            for client in self.clients:
+                if self.__guard(client, client.process_messages):
+                    busy = True
+                self.__guard(client, client.flush)
+
+            # forget clients who have quit or lost their connection.
+            if not all(client.running for client in self.clients):
+                self.clients = [client for client in self.clients if client.running]
+                if self.active not in self.clients:
+                    self.active = self.clients[0] if self.clients else None
+                if self.renderer is not None:
+                    self.renderer.show_network = len(self.clients) > 1
+
+        if self.log_writer is not None:
+            self.log_writer.close()
+        if self.renderer is not None:
+            self.renderer.close()
+
+    def __guard(self, client, action):
+        """ returns what action of client returns, None if it raised.
+
+        An error of one client, e.g. of its socket, is reported and drops its
+        connection, other clients keep running.
+        """
+
+        try:
+            return action()
+        except Exception:
+            client.report_error('%s failed, dropping connection to %s' %(action.__name__, client.host))
+            try:
+                client.drop()
+            except Exception:
+                client.running = False
+            return None
+    def __send_delay(self):
+        """ seconds until flood control lets a client send, None if nobody waits."""
+
+        delays = [delay for delay in [client.send_delay() for client in self.clients]
+                  if delay is not None]
+        return min(delays) if delays else None
+
+    def post(self, message):
+        """ add message from console to console queue and wake up event loop."""
+
+        self.console_queue.put(message)
+        self.wake()
+
+    def __process_console(self):
+        """ handle console commands of engine, pass the rest to active client."""
+
+        while True:
+            try:
+                message = self.console_queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            words = message.split()
+            command = words[0].lower() if words else ''
+
+            if command == '/server' and len(words) == 1:
+                for number, client in enumerate(self.clients):
+                    mark = '*' if client is self.active else ' '
+                    self.active.printConsole('%s %d %s:%d %s' %(mark, number, client.host, client.port, client.nickname))
+
+            elif command == '/server':
+                try:
+                    self.active = self.clients[int(words[1])]
+                except (ValueError, IndexError):
+                    self.active.printConsole('no such server %s' % words[1])
+
+            elif command == '/connect' and len(words) > 1:
+                self.connect(words[1])
+
+            elif self.active is not None:
+                self.active.post(message)
+
+    def __recv_console(self):
+        """ retrieves message from console.
+
+        Runs in a constant loop while engine is running..
+        In each iteration we retrieve  response from console and add
+        it to console queue of engine.
+        """
+
+        # runs while engine is running.
+        while self.running:
+
+            # retrieve message from console and add to console queue of engine.
+            # console is closed, keep running without it.
+            try:
+                message = raw_input('> ')
+            except EOFError:
+                return
+            self.post(message)
+
+
 
-client = IrcClient()
+# register handlers of the client, built once at import.
+for code in REPLY_NAMES:
+    register_handler(code, IrcClient.on_reply)
+register_handler('RPL_WELCOME', IrcClient.on_welcome)
+register_handler('ERR_NICKNAMEINUSE', IrcClient.on_nick_in_use)
+register_handler('RPL_NAMREPLY', IrcClient.on_names)
+register_handler('RPL_TOPIC', IrcClient.on_topic)
+register_handler('MODE', IrcClient.on_mode)
+register_handler('TOPIC', IrcClient.on_topic)
+register_handler('KICK', IrcClient.on_kick)
+register_handler('PING', IrcClient.on_ping)
+register_handler('QUIT', IrcClient.on_quit)
+register_handler('NICK', IrcClient.on_nick)
+register_handler('JOIN', IrcClient.on_join)
+register_handler('PART', IrcClient.on_part)
+register_handler('NOTICE', IrcClient.on_notice)
+register_handler('PRIVMSG', IrcClient.on_privmsg)
+register_handler('CAP', IrcClient.on_cap)
+register_handler('AWAY', IrcClient.on_away)
+register_handler('BATCH', IrcClient.on_batch)
+register_batch_handler('netsplit', IrcClient.on_netsplit)
+register_batch_handler('netjoin', IrcClient.on_netjoin)
+register_batch_handler('chathistory', IrcClient.on_history)
+register_batch_handler('draft/chathistory', IrcClient.on_history)
+del code
 
-# function for running part 1 of assignment
 
-# note
-# in function we are using time out function in separate thread.
-# who sends quit command after 2 min. but because this thread
-# is alive. main program does not terminate until after 2 min if user decides
-# to terminate sooner than 2 min.
+if __name__ == '__main__':
+    usage = ('usage: IrcClient.py [--metrics PREFIX] [--profile] [--headless | --json] [--insecure]\n'
+             '                    [--log PATH] [--fsync]\n'
+             '                    [nick@]host[:[+]port] [[nick@]host[:[+]port] ...]\n'
+             '       IrcClient.py --import irc.log [network]')
 
-#client.part1()
+    # import old irc.log into scrollback store.
+    if sys.argv[1:2] == ['--import']:
+        if len(sys.argv) not in (3, 4):
+            sys.exit(usage)
+        count = ScrollbackStore('scrollback.db').import_log(sys.argv[2], *sys.argv[3:4])
+        print 'imported %d messages' % count
+        sys.exit(0)
+
+    # --metrics PREFIX exports metrics to PREFIX.json and PREFIX.prom,
+    # --profile starts sampling profiler right away, --headless runs
+    # without console and only logs, --json runs without console and
+    # writes output as JSON lines, --insecure does not check certificates
+    # of TLS irc servers, --log PATH also logs to text log file PATH,
+    # --fsync syncs it to disk on every flush.
+    args = sys.argv[1:]
+    exporter = None
+    console, renderer = True, None
+    verify = True
+    log_path, fsync = None, False
+    while args[:1] and args[0].startswith('--'):
+        if args[0] not in ('--metrics', '--profile', '--headless', '--json', '--insecure',
+                           '--log', '--fsync') or args[1:] == []:
+            sys.exit(usage)
+        if args[0] == '--metrics':
+            exporter = MetricsExporter(METRICS, args[1] + '.json', args[1] + '.prom')
+            args = args[2:]
+            continue
+        if args[0] == '--log':
+            log_path = args[1]
+            args = args[2:]
+            continue
+        if args[0] == '--fsync':
+            fsync = True
+        elif args[0] == '--profile':
+            PROFILER.start()
+        elif args[0] == '--headless':
+            console = False
+        elif args[0] == '--insecure':
+            verify = False
+        else:
+            console, renderer = False, JsonLinesRenderer()
+        args = args[1:]
+
+    # irc servers are given as [nick@]host[:[+]port] on command line.
+    if not args:
+        sys.exit(usage)
+    log_writer = default_log_writer(log_path, fsync)
+    clients = []
+    for address in args:
+        nick, host, port, tls = parse_address(address)
+        try:
+            clients.append(IrcClient(host, port, log_writer, nick or 'defaultNick',
+                                     transport=TlsTransport(verify) if tls else None))
+        except (socket.error, ssl.CertificateError) as e:
+            log_writer.close()
+            sys.exit('failed to connect to %s : %s' %(address, e))
 
-client.start()
+    IrcEngine(clients, log_writer, console, renderer, verify).start()
+    if exporter is not None:
+        exporter.close()
 
@@ -0,0 +1,1122 @@
+""" Benchmarks for the irc client.
+
+Every benchmark runs against local sockets, no real irc network is needed.
+Run all benchmarks with
+
+    python benchmark.py
+
+or only some of them with
+
+    python benchmark.py dispatch
+"""
+
+import sys
+import os
+import re
+import socket
+import struct
+import tempfile
+import thread
+import time
+import random
+import Queue
+import itertools
+import multiprocessing
+import readline
+import subprocess
+
+import IrcClient
+import fakeircd
+
+
+def percentile(values, p):
+    """ returns the p-th percentile of a list of numbers."""
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class NullStream(object):
+    """ stdout replacement that throws away everything written to it."""
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def fake_server():
+    """ returns listening socket and its port on localhost."""
+
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    return listener, listener.getsockname()[1]
+
+
+def privmsg(i):
+    """ returns a timestamped privmsg line as sent by irc server."""
+
+    return ':nick%d!user@example.org PRIVMSG #bench :ts=%.6f\r\n' % (i, time.time())
+
+
+def report(line):
+    """ writes benchmark result to real stdout.
+
+    Benchmarks run with sys.stdout silenced so the client does not flood
+    the terminal.
+    """
+
+    sys.__stdout__.write(line + '\n')
+    sys.__stdout__.flush()
+
+
+TIMESTAMP = re.compile(r'ts=([0-9.]+)')
+
+
+class Recorder(object):
+    """ collects dispatch delays from timestamps embedded in messages."""
+
+    def __init__(self):
+        self.delays = []
+        self.done = Queue.Queue()
+        self.expected = 0
+
+    def __call__(self, msg):
+        match = TIMESTAMP.search(str(msg))
+        if match:
+            self.delays.append(time.time() - float(match.group(1)))
+            if len(self.delays) == self.expected:
+                self.done.put(True)
+
+    def expect(self, count):
+        self.delays = []
+        self.expected = count
+
+
+def legacy_loop(sock, handle, state):
+    """ replica of the original polling main loop, used as baseline.
+
+    A thread reads the socket into an unbounded queue and the main loop
+    checks the queue, handles at most one message and sleeps 50 ms.
+    """
+
+    queue = Queue.Queue()
+
+    def recv():
+        buf = ''
+        while True:
+            data = sock.recv(4096)
+            if data == '':
+                break
+            messages = (buf + data).split('\r\n')
+            for message in messages[:-1]:
+                queue.put(message)
+            buf = messages[-1]
+
+    thread.start_new_thread(recv, ())
+    while state['running']:
+        if not queue.empty():
+            handle(queue.get())
+        time.sleep(0.05)
+
+
+def run_dispatch(name, recorder, conn, count, burst):
+    """ measures per message delay and burst drain time for one loop."""
+
+    # single messages with some idle time in between.
+    recorder.expect(count)
+    for i in xrange(count):
+        conn.sendall(privmsg(i))
+        time.sleep(0.01)
+    recorder.done.get(timeout=60)
+    delays = recorder.delays
+
+    # burst of messages as in a NAMES or LIST dump.
+    recorder.expect(burst)
+    begin = time.time()
+    conn.sendall(''.join(privmsg(i) for i in xrange(burst)))
+    recorder.done.get(timeout=600)
+    drain = time.time() - begin
+
+    report('%-10s delay p50 %7.2f ms  p99 %7.2f ms  burst of %d drained in %8.3f s' % (
+        name, percentile(delays, 50) * 1000, percentile(delays, 99) * 1000,
+        burst, drain))
+
+
+def bench_dispatch(count=100, burst=2000):
+    """ per message dispatch delay and burst drain time, before and after."""
+
+    # legacy polling loop.
+    listener, port = fake_server()
+    sock = socket.create_connection(('127.0.0.1', port))
+    conn = listener.accept()[0]
+    recorder = Recorder()
+    state = {'running': True}
+    thread.start_new_thread(legacy_loop, (sock, recorder, state))
+    run_dispatch('polling', recorder, conn, count, burst)
+    state['running'] = False
+    conn.close()
+    listener.close()
+    time.sleep(0.1)
+
+    # event driven loop of the client.
+    listener, port = fake_server()
+    client = IrcClient.IrcClient('127.0.0.1', port, reconnect=False)
+    conn = listener.accept()[0]
+    recorder = Recorder()
+    client.printConsole = recorder
+    thread.start_new_thread(client.run, ())
+    run_dispatch('event', recorder, conn, count, burst)
+    client.running = False
+    client.post('')
+    conn.close()
+    listener.close()
+    time.sleep(0.1)
+
+
+def legacy_parse(message):
+    """ replica of the original parser, used as baseline."""
+
+    prefix = message.split(':')[1].split(' ')[0]
+    parameters = message.split(':')[1].split(' ')[1:]
+    if message.count(':') > 1:
+        parameters.append(''.join(message.split(':')[2:]))
+    try:
+        parameters.remove('')
+    except ValueError:
+        pass
+    return prefix, parameters
+
+
+def synthetic_corpus(count):
+    """ returns list of lines shaped like traffic in busy channels."""
+
+    lines = []
+    for i in xrange(count):
+        kind = i % 10
+        if kind < 6:
+            lines.append(':nick%d!~user%d@host-%d.example.org PRIVMSG #channel%d :message number %d with some words in it'
+                         % (i % 500, i % 500, i % 500, i % 20, i))
+        elif kind == 6:
+            lines.append(':nick%d!~user@2001:db8::%x PRIVMSG #channel :see http://example.org:8080/%d' % (i % 500, i, i))
+        elif kind == 7:
+            lines.append(':irc.example.org 353 me = #channel :' + ' '.join('@nick%d' % j for j in xrange(40)))
+        elif kind == 8:
+            lines.append(':nick%d!~user@host.example.org JOIN #channel%d' % (i % 500, i % 20))
+        else:
+            lines.append('PING :irc.example.org')
+    return lines
+
+
+def load_corpus():
+    """ returns recorded corpus from file named by IRC_CORPUS or synthetic corpus.
+
+    A recorded corpus is a file with one raw irc line per line, as logged
+    by a raw socket capture.
+    """
+
+    path = os.environ.get('IRC_CORPUS')
+    if path:
+        return [line.rstrip('\r\n') for line in open(path, 'rb') if line.strip()]
+    return synthetic_corpus(200000)
+
+
+def bench_parse(rounds=3):
+    """ lines parsed per second, original parser and parse_message."""
+
+    corpus = load_corpus()
+    for name, parse in (('legacy', legacy_parse), ('single-pass', IrcClient.parse_message)):
+        best = None
+        for i in xrange(rounds):
+            begin = time.time()
+            for line in corpus:
+                parse(line)
+            elapsed = time.time() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        report('%-12s %10.0f lines/s' % (name, len(corpus) / best))
+
+
+def feed(sock, blob, total):
+    """ writes blob to socket until total bytes are sent, then closes it."""
+
+    sent = 0
+    while sent < total:
+        sock.sendall(blob)
+        sent += len(blob)
+    sock.close()
+
+
+def legacy_framing(sock):
+    """ replica of the original receive path, returns number of lines."""
+
+    count = 0
+    buf = ''
+    while True:
+        data = sock.recv(4096)
+        if data == '':
+            return count
+        messages = (buf + data).split('\r\n')
+        count += len(messages) - 1
+        buf = messages[-1]
+
+
+def line_buffer_framing(sock):
+    """ receive path of the client, returns number of lines."""
+
+    count = 0
+    lines = IrcClient.LineBuffer()
+    while True:
+        batch = lines.recv_from(sock)
+        if batch is None:
+            return count
+        count += len(batch)
+
+
+def bench_framing(megabytes=64, rounds=3):
+    """ receive framing throughput in MB/s and lines/s over a socketpair.
+
+    Data is written by a process of its own, a writer thread would compete
+    with framing for the interpreter lock. Best of rounds is reported.
+    """
+
+    blob = ''.join(line + '\r\n' for line in synthetic_corpus(2000))
+    total = megabytes * 1024 * 1024
+    for name, framing in (('legacy', legacy_framing), ('line-buffer', line_buffer_framing)):
+        best = None
+        for i in xrange(rounds):
+            reader, writer = socket.socketpair()
+            writer_process = multiprocessing.Process(target=feed, args=(writer, blob, total))
+            writer_process.start()
+            writer.close()
+            begin = time.time()
+            count = framing(reader)
+            elapsed = time.time() - begin
+            reader.close()
+            writer_process.join()
+            best = elapsed if best is None else min(best, elapsed)
+        report('%-12s %8.1f MB/s %10.0f lines/s' % (
+            name, total / best / 1024 / 1024, count / best))
+
+
+def bench_log(count=200000):
+    """ cost of logging a message on the dispatch thread, before and after."""
+
+    # original logging, format and write on the calling thread.
+    log_file = open('legacy.log', 'a')
+    begin = time.time()
+    for i in xrange(count):
+        date = time.gmtime()
+        log_file.write('%s : %s : %s\n' %(time.strftime("%a %d %b %Y %X %z", date),
+                                          'server', 'PRIVMSG #channel nick : message %d' % i))
+    elapsed = time.time() - begin
+    log_file.close()
+    report('%-12s %6.2f us per message on dispatch thread' % ('legacy', elapsed / count * 1e6))
+
+    # log writer thread.
+    writer = IrcClient.LogWriter('writer.log')
+    begin = time.time()
+    for i in xrange(count):
+        writer.write('server', 'PRIVMSG #channel nick : message %d' % i)
+    elapsed = time.time() - begin
+    writer.close()
+    total = time.time() - begin
+    report('%-12s %6.2f us per message on dispatch thread, %.0f messages/s written' % (
+        'log-writer', elapsed / count * 1e6, count / total))
+
+
+def rss_kb():
+    """ resident set size of this process in kB."""
+
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+    return 0
+
+
+def flood_server(listener, connections, messages):
+    """ fake irc servers, accepts connections and floods each with messages."""
+
+    conns = [listener.accept()[0] for i in xrange(connections)]
+    chunk = ''.join(':nick%d!user@example.org PRIVMSG #bench :message %d\r\n' % (i % 50, i)
+                    for i in xrange(100))
+    for i in xrange(messages // 100):
+        for conn in conns:
+            conn.sendall(chunk)
+    for conn in conns:
+        conn.close()
+
+
+def bench_engine(messages=2000):
+    """ memory and cpu per connection with 1, 10 and 100 connections."""
+
+    for connections in (1, 10, 100):
+        listener, port = fake_server()
+        listener.listen(connections)
+        server = multiprocessing.Process(target=flood_server,
+                                         args=(listener, connections, messages))
+        server.start()
+
+        before = rss_kb()
+        log_writer = IrcClient.LogWriter('engine.log')
+        engine = IrcClient.IrcEngine(log_writer=log_writer)
+        for i in xrange(connections):
+            engine.add(IrcClient.IrcClient('127.0.0.1', port, log_writer, reconnect=False))
+        memory = rss_kb() - before
+
+        times = os.times()
+        begin = time.time()
+        engine.run()
+        elapsed = time.time() - begin
+        cpu = sum(os.times()[:2]) - sum(times[:2])
+
+        server.join()
+        listener.close()
+        report('%3d connections  %6.1f kB/connection  cpu %6.1f ms/connection  %6.2f us/message  wall %5.2f s' % (
+            connections, float(memory) / connections, cpu * 1000 / connections,
+            cpu * 1e6 / (connections * messages), elapsed))
+
+
+def dcc_sender(listener, size, turbo):
+    """ stand-in for a DCC sender, sends size bytes to first connection.
+
+    Acknowledgements of a standard DCC receiver are read while sending,
+    the connection is closed when receiver has acknowledged everything.
+    """
+
+    conn = listener.accept()[0]
+    chunk = 'x' * (1024 * 1024)
+    acks = []
+
+    def read_acks():
+        data = ''
+        while True:
+            more = conn.recv(65536)
+            if not more:
+                break
+            data += more
+            complete = len(data) // 4 * 4
+            if complete and struct.unpack('!I', data[complete - 4:complete])[0] == size & 0xffffffff:
+                break
+        acks.append(len(data) // 4)
+
+    if not turbo:
+        thread.start_new_thread(read_acks, ())
+    sent = 0
+    while sent < size:
+        part = chunk[:size - sent]
+        conn.sendall(part)
+        sent += len(part)
+    if not turbo:
+        while not acks:
+            time.sleep(0.001)
+    conn.close()
+
+
+def legacy_dcc(port, size):
+    """ replica of the original DCC receive loop."""
+
+    s = socket.create_connection(('127.0.0.1', port))
+    new_file = open('legacy.bin', 'wb')
+    while True:
+        da = s.recv(1024)
+        if not da:
+            break
+        new_file.write(da)
+        if new_file.tell() == size:
+            break
+    s.close()
+    new_file.close()
+
+
+def bench_dcc(megabytes=256):
+    """ DCC receive throughput in MB/s against a local sender."""
+
+    size = megabytes * 1024 * 1024
+    ip = IrcClient.dqn_to_int('127.0.0.1')
+    runs = [('legacy', None), ('standard', False), ('turbo', True)]
+    for name, turbo in runs:
+        listener, port = fake_server()
+        thread.start_new_thread(dcc_sender, (listener, size, bool(turbo)))
+        begin = time.time()
+        if turbo is None:
+            legacy_dcc(port, size)
+        else:
+            transfer = IrcClient.DccReceive('bench', 'bench.bin', ip, port, size,
+                                            'downloads', turbo)
+            transfer.run()
+            assert transfer.error is None, transfer.error
+        elapsed = time.time() - begin
+        listener.close()
+        report('%-10s %8.1f MB/s' % (name, megabytes / elapsed))
+
+    # client to client, DccSend serving a standard DccReceive.
+    source = open('send.bin', 'wb')
+    source.truncate(size)
+    source.close()
+    sender = IrcClient.DccSend('bench', 'send.bin', '127.0.0.1')
+    sender.start()
+    begin = time.time()
+    transfer = IrcClient.DccReceive('bench', 'received.bin', ip, sender.port, size, 'downloads')
+    transfer.run()
+    elapsed = time.time() - begin
+    assert transfer.error is None, transfer.error
+    while not sender.finished:
+        time.sleep(0.01)
+    report('%-10s %8.1f MB/s' % ('send', megabytes / elapsed))
+
+
+def bench_state(users=50000, per_line=30):
+    """ memory and speed of replaying a NAMES burst of a large channel."""
+
+    lines = []
+    for first in xrange(0, users, per_line):
+        names = ' '.join('%snick%d' % ('@' if i % 50 == 0 else '', i)
+                         for i in xrange(first, min(first + per_line, users)))
+        lines.append(':irc.example.org 353 me = #huge :' + names)
+
+    # second channel shares a tenth of the users.
+    for first in xrange(0, users, per_line * 10):
+        names = ' '.join('Nick%d' % i for i in xrange(first, min(first + per_line, users)))
+        lines.append(':irc.example.org 353 me = #small :' + names)
+
+    before = rss_kb()
+    state = IrcClient.IrcState()
+    begin = time.time()
+    for line in lines:
+        message = IrcClient.parse_message(line)
+        state.names(message.params[-1], message.trailing)
+    elapsed = time.time() - begin
+    memory = rss_kb() - before
+    report('NAMES burst of %d users: %.3f s, %.0f lines/s, %.0f kB (%.0f bytes/user)' % (
+        users, elapsed, len(lines) / elapsed, memory, memory * 1024.0 / users))
+
+    count = 100000
+    begin = time.time()
+    for i in xrange(count):
+        state.is_member('#HUGE', 'NICK%d' % (i % users))
+    elapsed = time.time() - begin
+    report('is_member      %.2f us per lookup' % (elapsed / count * 1e6))
+
+    begin = time.time()
+    for i in xrange(count):
+        state.common_channels('nick%d' % (i % users), 'nick0')
+    elapsed = time.time() - begin
+    report('common_channels %.2f us per lookup' % (elapsed / count * 1e6))
+
+
+WORDS = ('the deploy release build server client channel network message log search '
+         'query index segment compress python socket thread queue error timeout ping '
+         'pong join part nick topic mode kick ban invite notice privmsg version').split()
+
+
+def synthetic_log(count, days=30):
+    """ yields records of a synthetic log spread over the last days."""
+
+    end = time.time() - 86400
+    start = end - days * 86400
+    step = (end - start) / count
+    for i in xrange(count):
+        network = 'irc%d.example.org' % (i % 5)
+        channel = '#channel%d' % (i % 50)
+        nick = 'nick%d' % (i * 7 % 5000)
+        text = ' '.join(WORDS[(i * k) % len(WORDS)] for k in (3, 5, 7, 11, 13))
+        if i % 100000 == 0:
+            text += ' needle%d' % (i // 100000)
+        yield (start + i * step, 'server', 'PRIVMSG %s %s : %s' % (channel, nick, text),
+               network, channel, nick)
+
+
+def bench_scrollback(count=None):
+    """ append and query speed of scrollback store on a synthetic log.
+
+    Number of lines is taken from IRC_BENCH_LINES, 10M by default.
+    """
+
+    count = count or int(os.environ.get('IRC_BENCH_LINES', 10000000))
+    store = IrcClient.ScrollbackStore('bench.db')
+
+    begin = time.time()
+    batch = []
+    for record in synthetic_log(count):
+        batch.append(record)
+        if len(batch) == 50000:
+            store.append(batch)
+            batch = []
+    store.append(batch)
+    elapsed = time.time() - begin
+    report('appended %d lines in %.1f s, %.0f lines/s' % (count, elapsed, count / elapsed))
+
+    begin = time.time()
+    segments = store.close_segments()
+    report('closed %d segments in %.1f s, database is %.1f MB' % (
+        segments, time.time() - begin, os.path.getsize('bench.db') / 1024.0 / 1024))
+
+    now = time.time()
+    queries = [
+        ('rare keyword', dict(words='needle7')),
+        ('keyword in channel', dict(words='deploy', channel='#channel7', limit=50)),
+        ('keyword in time range', dict(words='release', since=now - 5 * 86400, until=now - 4 * 86400, limit=50)),
+        ('channel last day', dict(network='irc2.example.org', channel='#channel7', since=now - 2 * 86400, limit=100)),
+        ('nick', dict(nick='nick42', limit=50)),
+    ]
+    for name, query in queries:
+        times = []
+        for i in xrange(5):
+            begin = time.time()
+            results = store.search(**query)
+            times.append(time.time() - begin)
+        report('%-22s %8.2f ms  %d results' % (name, percentile(times, 50) * 1000, len(results)))
+
+
+def load_server(ports, results, name, rate):
+    """ fake irc server process playing one load scenario to one client."""
+
+    server = fakeircd.FakeIrcServer()
+    ports.put(server.port)
+    server.accept()
+
+    sender = None
+    pings = 0
+    chunk = 100
+    if name == 'storm':
+        lines = fakeircd.privmsg_storm(200000)
+    elif name == 'paced storm':
+        lines = fakeircd.privmsg_storm(100000)
+    elif name == 'names':
+        lines = itertools.chain(*[fakeircd.names_burst(server.nick, '#names%d' % i, 5000)
+                                  for i in xrange(20)])
+    elif name == 'ping under load':
+        lines = fakeircd.with_pings(fakeircd.privmsg_storm(200000), 1000)
+        pings = 200
+    elif name == 'chat':
+        lines = fakeircd.with_pings(fakeircd.privmsg_storm(250), 5)
+        pings = 50
+        chunk = 1
+    else:
+        sender = fakeircd.DccSender(1024 * 1024)
+        lines = fakeircd.dcc_offers(server.nick, 20, sender.port, sender.size)
+
+    # last message tells client when everything before it was handled.
+    server.play(itertools.chain(lines, fakeircd.privmsg_storm(1)), rate, chunk)
+
+    # wait for PONGs and DCC transfers before we hang up.
+    deadline = time.time() + 60
+    while time.time() < deadline and not server.closed:
+        if len(server.rtts) < pings:
+            time.sleep(0.01)
+        elif sender is not None and sender.served < 20:
+            time.sleep(0.01)
+        else:
+            break
+    results.put((server.sent, server.rtts))
+    server.close()
+
+
+class LoadRecorder(Recorder):
+    """ collects handling delays and time of last message of a client."""
+
+    def __init__(self):
+        Recorder.__init__(self)
+        self.last = None
+
+    def __call__(self, msg):
+        Recorder.__call__(self, msg)
+        self.last = time.time()
+
+
+def bench_load():
+    """ end to end load of one client against the fake irc server.
+
+    Every scenario is played by a fake irc server in a process of its own,
+    so cpu time and memory are the client's alone.
+    """
+
+    scenarios = [
+        ('storm', None, 'spill'),
+        ('storm', None, 'drop-oldest'),
+        ('storm', None, 'coalesce'),
+        ('paced storm', 20000, 'spill'),
+        ('names', None, 'spill'),
+        ('ping under load', None, 'spill'),
+        ('dcc', None, 'spill'),
+    ]
+    for name, rate, policy in scenarios:
+        ports, results = multiprocessing.Queue(), multiprocessing.Queue()
+        server = multiprocessing.Process(target=load_server, args=(ports, results, name, rate))
+        server.start()
+
+        before = rss_kb()
+        recorder = LoadRecorder()
+        client = IrcClient.IrcClient('127.0.0.1', ports.get(), nickname='bench',
+                                     message_queue=IrcClient.MessageQueue(20000, policy),
+                                     reconnect=False, ctcp_policy=IrcClient.CtcpPolicy(max_transfers=20))
+        client.printConsole = recorder
+        client.download_directory = 'load-downloads'
+        client.register()
+
+        times = os.times()
+        begin = time.time()
+        IrcClient.IrcEngine([client], client.log_writer).run()
+        elapsed = (recorder.last or time.time()) - begin
+        cpu = sum(os.times()[:2]) - sum(times[:2])
+
+        sent, rtts = results.get()
+        server.join()
+        deadline = time.time() + 10
+        while not all(transfer.finished for transfer in client.transfers) and time.time() < deadline:
+            time.sleep(0.01)
+        line = '%-28s %8.0f msgs/s  delay p50 %7.2f ms  p99 %7.2f ms  cpu %5.2f s  rss %+7d kB' % (
+            '%s (%s)' % (name, policy), sent / elapsed, percentile(recorder.delays, 50) * 1000,
+            percentile(recorder.delays, 99) * 1000, cpu, rss_kb() - before)
+        if rtts:
+            line += '  PING p50 %.2f ms  p99 %.2f ms' % (
+                percentile(rtts, 50) * 1000, percentile(rtts, 99) * 1000)
+        if client.message_queue.dropped or client.message_queue.spilled:
+            line += '  %d dropped  %d spilled' % (client.message_queue.dropped, client.message_queue.spilled)
+        if name == 'dcc':
+            done = [transfer for transfer in client.transfers if transfer.finished and transfer.error is None]
+            line += '  %d transfers %.1f MB/s' % (
+                len(done), sum(transfer.received for transfer in done) / elapsed / 1024 / 1024)
+        report(line)
+
+
+def bench_handlers(delay=0.02):
+    """ PING round trip while a slow PRIVMSG handler is active.
+
+    Chat at 100 messages per second with a PING after every fifth message,
+    once with the handlers of the client only, once with a handler taking
+    delay seconds run inline on the engine thread and once on the handler
+    pool of the client.
+    """
+
+    def slow(client, message):
+        time.sleep(delay)
+
+    def slow_inline(client, message):
+        IrcClient.IrcClient.on_privmsg(client, message)
+        slow(client, message)
+
+    for name in ('no slow handler', 'inline', 'background'):
+        if name == 'inline':
+            IrcClient.register_handler('PRIVMSG', slow_inline)
+        elif name == 'background':
+            IrcClient.register_background_handler('PRIVMSG', slow)
+
+        ports, results = multiprocessing.Queue(), multiprocessing.Queue()
+        server = multiprocessing.Process(target=load_server, args=(ports, results, 'chat', 100))
+        server.start()
+        client = IrcClient.IrcClient('127.0.0.1', ports.get(), nickname='bench', reconnect=False)
+        client.register()
+        IrcClient.IrcEngine([client], client.log_writer).run()
+        sent, rtts = results.get()
+        server.join()
+
+        IrcClient.register_handler('PRIVMSG', IrcClient.IrcClient.on_privmsg)
+        IrcClient.BACKGROUND_HANDLERS.pop('PRIVMSG', None)
+        if client.handler_pool is not None:
+            client.handler_pool.close()
+        report('%-16s PING p50 %7.2f ms  p99 %7.2f ms  max %7.2f ms' % (
+            name, percentile(rtts, 50) * 1000, percentile(rtts, 99) * 1000, max(rtts) * 1000))
+
+
+def legacy_print(msg):
+    """ replica of the original printConsole, one redraw per message."""
+
+    sys.stdout.write('\r' + ' ' * (len(readline.get_line_buffer()) + 2) + '\r')
+    print msg
+    sys.stdout.write('> ' + readline.get_line_buffer())
+    sys.stdout.flush()
+
+
+def bench_console(count=100000):
+    """ console output of count messages piped to another process.
+
+    Reports time the engine thread spends writing output and time until
+    the last message is written.
+    """
+
+    devnull = open(os.devnull, 'w')
+    runs = [('legacy', None), ('renderer', IrcClient.ConsoleRenderer),
+            ('json lines', IrcClient.JsonLinesRenderer)]
+    for name, renderer_class in runs:
+        reader = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=devnull)
+        sys.stdout = reader.stdin
+        try:
+            begin = time.time()
+            if renderer_class is None:
+                for i in xrange(count):
+                    legacy_print('#bench nick%d : message %d' % (i % 50, i))
+                calls = time.time() - begin
+            else:
+                # every line is written, so runs compare.
+                renderer = renderer_class()
+                renderer.max_lines = None
+                for i in xrange(count):
+                    renderer.write('irc.example.org', '#bench nick%d : message %d' % (i % 50, i))
+                calls = time.time() - begin
+                renderer.close()
+            drained = time.time() - begin
+        finally:
+            sys.stdout = NullStream()
+            reader.stdin.close()
+            reader.wait()
+        report('%-12s %6.2f us/message on engine thread  all written in %6.2f s' % (
+            name, calls * 1e6 / count, drained))
+
+
+def filter_rules(count):
+    """ returns ignore masks and highlight keywords, count of each."""
+
+    masks = []
+    for i in xrange(count):
+        kind = i % 4
+        if kind == 0:
+            masks.append('spam%d' % i)
+        elif kind == 1:
+            masks.append('*!*@host%d.example.org' % i)
+        elif kind == 2:
+            masks.append('*!*@*.net%d.example.com' % i)
+        else:
+            masks.append('bot%d*!*@*' % i)
+    keywords = ['%s%d' % (WORDS[i % len(WORDS)], i) for i in xrange(count)]
+    return masks, keywords
+
+
+class NaiveFilter(object):
+    """ one regular expression per rule, tried one after another."""
+
+    def __init__(self, masks, keywords):
+        self.masks = [re.compile(IrcClient.mask_pattern(IrcClient.normalize_mask(mask)) + '\\Z')
+                      for mask in masks]
+        self.keywords = [re.compile('(?<!\\w)%s(?!\\w)' % re.escape(keyword), re.I)
+                         for keyword in keywords]
+
+    def ignored(self, prefix):
+        prefix = IrcClient.irc_lower(prefix)
+        return any(mask.match(prefix) for mask in self.masks)
+
+    def highlight(self, text):
+        for keyword in self.keywords:
+            found = keyword.search(text)
+            if found:
+                return found.group(0)
+        return None
+
+
+def bench_filter(count=20000):
+    """ cost per message of ignore and highlight rules, compiled vs naive."""
+
+    messages = [(':nick%d!user@host%d.users.example.org' % (i, i),
+                 ' '.join(WORDS[(i * 7 + j) % len(WORDS)] for j in xrange(12)))
+                for i in xrange(count)]
+    for rules in (10, 100, 1000, 10000):
+        masks, keywords = filter_rules(rules)
+        filters = [('compiled', IrcClient.MessageFilter(masks, keywords), count)]
+        filters.append(('naive', NaiveFilter(masks, keywords), max(count * 10 / rules, 50)))
+        for name, message_filter, total in filters:
+            begin = time.time()
+            message_filter.ignored('warm!up@host')
+            built = time.time() - begin
+            begin = time.time()
+            for prefix, text in itertools.islice(itertools.cycle(messages), total):
+                if not message_filter.ignored(prefix[1:]):
+                    message_filter.highlight(text)
+            elapsed = time.time() - begin
+            report('%5d rules %-8s %9.2f us/message  built in %7.1f ms' % (
+                rules, name, elapsed / total * 1e6, built * 1000))
+
+
+def make_certificate():
+    """ returns path of a self signed certificate with its key for 127.0.0.1."""
+
+    with open(os.devnull, 'w') as null:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                               '-days', '1', '-subj', '/CN=127.0.0.1',
+                               '-addext', 'subjectAltName=IP:127.0.0.1',
+                               '-keyout', 'bench.key', '-out', 'bench.crt'],
+                              stdout=null, stderr=null)
+    with open('bench.pem', 'w') as pem:
+        pem.write(open('bench.crt').read() + open('bench.key').read())
+    return os.path.abspath('bench.pem')
+
+
+def wait_until(condition, timeout=10.0):
+    """ polls condition until it is true or timeout seconds have passed."""
+
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.0005)
+
+
+def bench_reconnect(drops=20, channels=100):
+    """ time from a dropped connection until all channels are joined again.
+
+    The fake irc server drops the client, which reconnects, registers and
+    joins its channels again. Measured from drop until the server has seen
+    the JOINs of every channel, over plain tcp and over TLS with a checked
+    certificate, without backoff and with the default backoff.
+    """
+
+    certfile = make_certificate()
+    names = ['#channel%d' % i for i in xrange(channels)]
+    for name, tls, base in (('tcp', False, 0.0), ('tls', True, 0.0),
+                            ('tcp backoff', False, 0.5), ('tls backoff', True, 0.5)):
+        server = fakeircd.FakeIrcServer(certfile=certfile if tls else None)
+        thread.start_new_thread(server.accept, ())
+        transport = IrcClient.TlsTransport(cafile=certfile) if tls else IrcClient.TcpTransport()
+        client = IrcClient.IrcClient('127.0.0.1', server.port, nickname='bench',
+                                     channels=names, transport=transport)
+        client.printConsole = lambda msg: None
+        client.backoff = IrcClient.Backoff(base)
+        client.register()
+        thread.start_new_thread(IrcClient.IrcEngine([client], client.log_writer, console=False).run, ())
+        wait_until(lambda: len(server.channels) == channels)
+
+        times = []
+        for i in xrange(drops):
+            begin = time.time()
+            server.drop()
+            server.accept()
+            wait_until(lambda: len(server.channels) == channels)
+            times.append(time.time() - begin)
+
+        client.post('/quit')
+        wait_until(lambda: not client.running)
+        server.close()
+        report('%-12s rejoin %d channels p50 %7.2f ms  p99 %7.2f ms' % (
+            name, channels, percentile(times, 50) * 1000, percentile(times, 99) * 1000))
+
+
+def bench_batch(users=20000, messages=20000):
+    """ cost of a netsplit and of history playback, as IRCv3 batches and line by line.
+
+    Output goes through the console renderer, to a null stream, and log
+    writer of the client, as it does when the client runs. Log writer has
+    no scrollback store, its thread would compete for the interpreter.
+    """
+
+    listener, port = fake_server()
+    client = IrcClient.IrcClient('127.0.0.1', port, IrcClient.LogWriter(None),
+                                 nickname='me', reconnect=False)
+    conn = listener.accept()[0]
+    renderer = IrcClient.ConsoleRenderer(NullStream(), prompt=False)
+    IrcClient.IrcEngine([client], client.log_writer, console=False, renderer=renderer)
+
+    # count lines written to console.
+    written = [0]
+    write = renderer.write
+
+    def count(network, text):
+        written[0] += 1
+        write(network, text)
+    renderer.write = count
+
+    def handle(lines):
+        client.message_queue.put_lines(list(lines))
+        while client.process_messages():
+            pass
+
+    scenarios = [('netsplit', users, lambda batch: fakeircd.netsplit('#split', users, batch)),
+                 ('history', messages, lambda batch: fakeircd.history('#history', messages, batch))]
+    for name, count, scenario in scenarios:
+        for batch in (False, True):
+            client.state = IrcClient.IrcState()
+            handle(fakeircd.names_burst('me', '#split', users))
+            lines = list(scenario(batch))
+            written[0] = 0
+            begin = time.time()
+            handle(lines)
+            elapsed = time.time() - begin
+            report('%-8s %-13s %6.2f us/message  %6d lines written' % (
+                name, 'batch' if batch else 'line by line', elapsed / count * 1e6, written[0]))
+    renderer.close()
+    client.log_writer.close()
+    conn.close()
+    listener.close()
+
+
+def mixed_corpus(count):
+    """ returns lines of synthetic corpus, some messages UTF-8 and one in ten Latin-1."""
+
+    lines = synthetic_corpus(count)
+    for i in xrange(0, count, 10):
+        lines[i] += ' caf\xe9 na\xefve'
+    for i in xrange(5, count, 10):
+        lines[i] += ' caf\xc3\xa9 \xe2\x9c\x93'
+    return lines
+
+
+def eager_decode(line):
+    """ decodes line to unicode before parsing, as a unicode client does."""
+
+    try:
+        return IrcClient.parse_message(line.decode('utf-8'))
+    except UnicodeDecodeError:
+        return IrcClient.parse_message(line.decode('latin-1'))
+
+
+def bench_decode(count=200000, rounds=5):
+    """ cpu time per line and memory per kept message, eager unicode vs lazy bytes.
+
+    Eager decodes every line to unicode and then parses it. Lazy parses
+    bytes and recodes only the text of PRIVMSG, as the client does to show
+    and log it. Memory is that of raw line and text of messages kept, as
+    state and queues keep them.
+    """
+
+    lines = mixed_corpus(count)
+    charsets = IrcClient.Charsets()
+    charsets.set_charset('#channel3', 'cp1252')
+
+    def lazy_decode(line):
+        message = IrcClient.parse_message(line)
+        if message.command == 'PRIVMSG':
+            charsets.recode(message.params[0], message.trailing)
+        return message
+
+    for name, decode in (('eager', eager_decode), ('lazy', lazy_decode)):
+        best = None
+        for i in xrange(rounds):
+            begin = time.clock()
+            messages = [decode(line) for line in lines]
+            elapsed = time.clock() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        size = sum(sys.getsizeof(message.raw) + sys.getsizeof(message.trailing) for message in messages)
+        report('%-6s %6.2f us/line  %6.0f bytes/message' % (name, best / count * 1e6, float(size) / count))
+
+
+class NaiveCidrs(object):
+    """ CIDR ranges scanned one by one, narrowest matching range decides, as baseline."""
+
+    def __init__(self, rules):
+        self.ranges = [IrcClient.parse_cidr(cidr) + (allow,) for cidr, allow in rules]
+
+    def lookup(self, address):
+        if isinstance(address, (int, long)):
+            family = socket.AF_INET
+        else:
+            family, address = IrcClient.ip_to_int(address)
+        found = None
+        for range_family, start, end, allow in self.ranges:
+            if range_family == family and start <= address <= end \
+                    and (found is None or end - start <= found[0]):
+                found = (end - start, allow)
+        return found and found[1]
+
+
+def bench_policy(lookups=20000, offers=400):
+    """ cost of CIDR lookups and of a CTCP and DCC flood, with and without limits.
+
+    Lookups are of DCC offer addresses, IPv4 as integer, and one in four
+    IPv6 sender addresses. Rate limiting is timed for floods from up to
+    ten times as many sources as the policy keeps buckets of. In the flood
+    every sender offers a file, to a server which never sends it, and asks
+    for VERSION a few times.
+    """
+
+    random_ipv4 = lambda: random.getrandbits(32)
+    addresses = [random_ipv4() if i % 4 else '2001:db8::%x' % random.getrandbits(16)
+                 for i in xrange(lookups)]
+    for count in (10, 100, 1000, 10000):
+        rules = [('%s/%d' % (IrcClient.int_to_dqn(random_ipv4()), random.randint(8, 32)), i % 2 == 0)
+                 for i in xrange(count)]
+        rules.append(('2001:db8::/48', False))
+        for name, index, total in (('index', IrcClient.CidrIndex(rules), lookups),
+                                   ('naive', NaiveCidrs(rules), max(lookups * 10 / count, 200))):
+            begin = time.time()
+            index.lookup('127.0.0.1')
+            built = time.time() - begin
+            begin = time.time()
+            for address in itertools.islice(itertools.cycle(addresses), total):
+                index.lookup(address)
+            elapsed = time.time() - begin
+            report('%5d ranges %-6s %9.2f us/lookup  built in %7.1f ms' % (
+                count, name, elapsed / total * 1e6, built * 1000))
+
+    limit = IrcClient.CtcpPolicy().replies.max_sources
+    for sources in (limit / 4, limit * 2, limit * 10):
+        policy = IrcClient.CtcpPolicy()
+        hosts = ['host%d.example.org' % i for i in xrange(sources)]
+        begin = time.time()
+        for round in xrange(3):
+            for host in hosts:
+                policy.answer(host)
+        elapsed = time.time() - begin
+        report('%5d sources %9.2f us/request  %d buckets kept' % (
+            sources, elapsed / sources / 3 * 1e6, len(policy.replies)))
+
+    sink = socket.socket()
+    sink.bind(('127.0.0.1', 0))
+    sink.listen(offers)
+    ip = IrcClient.dqn_to_int('127.0.0.1')
+    lines = []
+    for i in xrange(offers):
+        lines.append(':nick%d!user@host%d.example.org PRIVMSG bench :\001DCC SEND file%d %d %d 1000\001' % (
+            i, i, i, ip, sink.getsockname()[1]))
+        lines.extend([':nick%d!user@host%d.example.org PRIVMSG bench :\001VERSION\001' % (i, i)] * 5)
+    policies = (('no limits', IrcClient.CtcpPolicy(max_transfers=offers, rate=1e9, burst=1e9)),
+                ('policy', IrcClient.CtcpPolicy()))
+    for name, policy in policies:
+        listener, port = fake_server()
+        client = IrcClient.IrcClient('127.0.0.1', port, IrcClient.LogWriter(None), nickname='bench',
+                                     reconnect=False, ctcp_policy=policy)
+        client.printConsole = lambda msg: None
+        client.download_directory = tempfile.mkdtemp()
+        conn = listener.accept()[0]
+        begin = time.time()
+        client.message_queue.put_lines(lines)
+        for i in xrange(len(lines) * 2):
+            if not client.process_messages() or not client.message_queue.depth:
+                break
+        elapsed = time.time() - begin
+        report('%-10s %7.2f us/message  %4d transfers started  %5d replies queued' % (
+            name, elapsed / len(lines) * 1e6, len(client.transfers), client.send_queue.depth))
+        client.log_writer.close()
+        conn.close()
+        listener.close()
+    sink.close()
+
+
+BENCHMARKS = [
+    ('dispatch', bench_dispatch),
+    ('parse', bench_parse),
+    ('framing', bench_framing),
+    ('log', bench_log),
+    ('engine', bench_engine),
+    ('dcc', bench_dcc),
+    ('state', bench_state),
+    ('scrollback', bench_scrollback),
+    ('load', bench_load),
+    ('handlers', bench_handlers),
+    ('console', bench_console),
+    ('filter', bench_filter),
+    ('reconnect', bench_reconnect),
+    ('batch', bench_batch),
+    ('decode', bench_decode),
+    ('policy', bench_policy),
+]
+
+
+def main(names):
+    # benchmarks write scrollback.db, certificates and downloads to working
+    # directory, keep them out of the tree.
+    os.chdir(tempfile.mkdtemp(prefix='irc-bench-'))
+
+    for name, bench in BENCHMARKS:
+        if names and name not in names:
+            continue
+        report('== %s' % name)
+        sys.stdout = NullStream()
+        try:
+            bench()
+        finally:
+            sys.stdout = sys.__stdout__
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,468 @@
+""" Local stand-in for an irc server.
+
+Lets the client run against localhost instead of a real irc network. The
+server welcomes one client and plays scenarios to it: recorded traffic,
+PRIVMSG storms, NAMES bursts, PINGs and DCC offers, as fast as possible
+or at a given rate. Run it with
+
+    python fakeircd.py [--port 6667] [--rate N] [--tls CERTFILE] scenario [scenario ...]
+
+and connect the client with python IrcClient.py 127.0.0.1:6667, or with
+--tls and a certificate with key in CERTFILE, python IrcClient.py
+--insecure 127.0.0.1:+6667. With --caps the server speaks IRCv3 and
+offers CAPABILITIES. Scenarios are storm[:count], names[:users],
+ping[:count], dcc[:count], netsplit[:users], history[:count] and
+replay:path. The benchmark runner in benchmark.py uses it too.
+"""
+
+import sys
+import socket
+import ssl
+import thread
+import time
+
+import IrcClient
+
+
+SERVER_NAME = 'fake.example.org'
+
+# IRCv3 capabilities offered with --caps.
+CAPABILITIES = ('multi-prefix', 'extended-join', 'away-notify', 'server-time',
+                'batch', 'message-tags', 'draft/chathistory', 'sasl')
+
+
+def privmsg_storm(count, channel='#bench', nicks=50):
+    """ yields count PRIVMSG lines to channel from nicks nick names.
+
+    Every line carries the time it was made in its text as ts=seconds,
+    receivers use it to measure how long handling took.
+    """
+
+    for i in xrange(count):
+        yield ':nick%d!user@example.org PRIVMSG %s :ts=%.6f message %d' % (
+            i % nicks, channel, time.time(), i)
+
+
+def names_burst(nick, channel, users, per_line=30):
+    """ yields our JOIN of channel and NAMES reply with users members."""
+
+    yield ':%s!user@example.org JOIN %s' % (nick, channel)
+    for first in xrange(0, users, per_line):
+        names = ' '.join(('@' if i % 50 == 0 else '') + 'user%d' % i
+                         for i in xrange(first, min(users, first + per_line)))
+        yield ':%s 353 %s = %s :%s' % (SERVER_NAME, nick, channel, names)
+    yield ':%s 366 %s %s :End of /NAMES list.' % (SERVER_NAME, nick, channel)
+
+
+def server_time(seconds):
+    """ server-time tag value of seconds since epoch."""
+
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + '.%03dZ' % (seconds % 1 * 1000)
+
+
+def netsplit(channel, users, batch=True):
+    """ yields QUITs of users of names_burst split off with their server.
+
+    With batch the QUITs are one netsplit BATCH, as IRCv3 servers send
+    them to clients with the batch capability, otherwise one by one.
+    """
+
+    servers = 'hub.example.org leaf.example.org'
+    if batch:
+        yield ':%s BATCH +split netsplit %s' % (SERVER_NAME, servers)
+    tag = '@batch=split ' if batch else ''
+    for i in xrange(users):
+        yield '%s:user%d!user@example.org QUIT :%s' % (tag, i, servers)
+    if batch:
+        yield ':%s BATCH -split' % SERVER_NAME
+
+
+def history(channel, count, batch=True):
+    """ yields count messages of channel played back with server time.
+
+    With batch they are one chathistory BATCH, otherwise plain PRIVMSGs.
+    """
+
+    begin = time.time() - count
+    if batch:
+        yield ':%s BATCH +history chathistory %s' % (SERVER_NAME, channel)
+    for i in xrange(count):
+        tags = 'time=%s' % server_time(begin + i)
+        if batch:
+            tags += ';batch=history'
+        yield '@%s :nick%d!user@example.org PRIVMSG %s :old message %d' % (tags, i % 50, channel, i)
+    if batch:
+        yield ':%s BATCH -history' % SERVER_NAME
+
+
+def pings(count, interval=0.01):
+    """ yields count PINGs, interval seconds apart.
+
+    The token of every PING is the time it was made as rtt=seconds, the
+    server measures round trip time from the PONG that echoes it.
+    """
+
+    for i in xrange(count):
+        yield 'PING :rtt=%.6f' % time.time()
+        time.sleep(interval)
+
+
+def with_pings(lines, every=1000):
+    """ yields lines with a PING inserted after every every lines."""
+
+    for i, line in enumerate(lines):
+        yield line
+        if i % every == every - 1:
+            yield 'PING :rtt=%.6f' % time.time()
+
+
+def dcc_offers(nick, count, port, size, turbo=False):
+    """ yields count DCC offers to nick of files served on port.
+
+    Every offer comes from a sender of its own, clients limit how many
+    offers they take of one host.
+    """
+
+    command = 'TSEND' if turbo else 'SEND'
+    for i in xrange(count):
+        yield ':sender%d!user@host%d.example.org PRIVMSG %s :\001DCC %s offer%d.bin %d %d %d\001' % (
+            i, i, nick, command, i, IrcClient.dqn_to_int('127.0.0.1'), port, size)
+
+
+def replay(path, speed=None):
+    """ yields lines of recorded traffic.
+
+    Every line of the recording is a message as the irc server sent it,
+    optionally preceded by the time it was received in seconds. With speed
+    given, lines are yielded with their recorded spacing divided by speed,
+    otherwise as fast as they are asked for.
+
+    Args:
+        path: file of recorded traffic.
+        speed: how many times faster than recorded to replay.
+    """
+
+    begin = start = None
+    for line in open(path):
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+
+        # lines without time are replayed right away.
+        stamp, _, rest = line.partition(' ')
+        try:
+            stamp = float(stamp)
+        except ValueError:
+            yield line
+            continue
+
+        # wait until line is due.
+        if speed:
+            if begin is None:
+                begin, start = stamp, time.time()
+            delay = start + (stamp - begin) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        yield rest
+
+
+class DccSender(object):
+    """ serves a file of size null bytes to every DCC connection.
+
+    Attributes:
+        port: port DCC receivers connect to.
+        size: size of file served.
+        served: number of transfers finished.
+    """
+
+    def __init__(self, size):
+        """ Opens listening socket on localhost.
+
+        Args:
+            size: size of file served.
+        """
+
+        self.size = size
+        self.served = 0
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        thread.start_new_thread(self.__accept, ())
+
+    def __accept(self):
+        """ serves every connection in a thread of its own."""
+
+        while True:
+            try:
+                conn = self.listener.accept()[0]
+            except socket.error:
+                return
+            thread.start_new_thread(self.__serve, (conn,))
+
+    def __serve(self, conn):
+        """ sends file, then waits for receiver to close or acknowledge all of it."""
+
+        chunk = '\0' * 65536
+        sent = 0
+        try:
+            while sent < self.size:
+                sent += conn.send(chunk[:self.size - sent])
+            conn.shutdown(socket.SHUT_WR)
+            while conn.recv(65536):
+                pass
+        except socket.error:
+            pass
+        conn.close()
+        self.served += 1
+
+    def close(self):
+        """ stops accepting DCC connections."""
+
+        self.listener.close()
+
+
+class FakeIrcServer(object):
+    """ irc server on localhost for one client.
+
+    The server welcomes the client, answers its PINGs, echoes its JOINs and
+    plays scenarios to it. Scenarios are iterables of lines, see
+    privmsg_storm, names_burst, pings, with_pings, dcc_offers and replay.
+    The connection can be dropped and the client accepted again, to see
+    how it reconnects.
+
+    Attributes:
+        port: port the server listens on.
+        certfile: certificate and key of TLS connections, None for plain tcp.
+        capabilities: IRCv3 capabilities offered in CAP LS, none for a
+            server which does not know CAP.
+        refused: capabilities offered, but refused with CAP NAK when the
+            client asks for them.
+        enabled: capabilities the client asked for and got.
+        nick: nick name the client registered with.
+        channels: channels the client joined on current connection.
+        rtts: round trip times of PINGs the client has answered, in seconds.
+        received: lines received from the client.
+        sent: lines sent to the client.
+    """
+
+    def __init__(self, port=0, certfile=None, capabilities=(), refused=()):
+        """ Opens listening socket on localhost.
+
+        Args:
+            port: port to listen on, 0 for any free port.
+            certfile: certificate and key to speak TLS with, None for
+                plain tcp.
+            capabilities: IRCv3 capabilities to offer.
+            refused: capabilities to offer, but refuse.
+        """
+
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', port))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.certfile = certfile
+        self.capabilities = capabilities
+        self.refused = refused
+        self.enabled = set()
+        self.conn = None
+        self.nick = None
+        self.channels = set()
+        self.rtts = []
+        self.received = 0
+        self.sent = 0
+        self.closed = False
+
+    def accept(self):
+        """ waits for client, its registration and welcomes it.
+
+        A client which starts capability negotiation is welcomed when it
+        ends it, with CAP END.
+        """
+
+        conn = self.listener.accept()[0]
+        if self.certfile is not None:
+            conn = ssl.wrap_socket(conn, server_side=True, certfile=self.certfile)
+        self.conn = conn
+        self.nick = None
+        self.channels = set()
+        self.enabled = set()
+        self.closed = False
+        lines = IrcClient.LineBuffer()
+        negotiating = False
+        while self.nick is None or negotiating:
+            for line in lines.recv_from(self.conn) or ():
+                message = IrcClient.parse_message(line)
+                args = message.args
+                if message.command == 'NICK' and args:
+                    self.nick = args[0]
+                elif message.command == 'CAP' and args and self.capabilities:
+                    negotiating = self.__negotiate(args)
+        self.send([':%s 001 %s :Welcome to the fake irc network %s' % (SERVER_NAME, self.nick, self.nick),
+                   ':%s 376 %s :End of /MOTD command.' % (SERVER_NAME, self.nick)])
+        thread.start_new_thread(self.__recv, (conn, lines))
+
+    def __negotiate(self, args):
+        """ answers CAP command of client, returns False when client ends negotiation."""
+
+        subcommand = args[0].upper()
+        if subcommand == 'LS':
+            self.send(['CAP * LS :%s' % ' '.join(self.capabilities)])
+        elif subcommand == 'REQ':
+            wanted = args[-1].split()
+            reply = 'ACK' if all(name in self.capabilities and name not in self.refused
+                                 for name in wanted) else 'NAK'
+            if reply == 'ACK':
+                self.enabled.update(wanted)
+            self.send(['CAP * %s :%s' % (reply, args[-1])])
+        elif subcommand == 'END':
+            return False
+        return True
+
+    def __recv(self, conn, lines):
+        """ reads lines from client, answers PINGs, times PONGs and echoes JOINs."""
+
+        while True:
+            try:
+                received = lines.recv_from(conn)
+            except socket.error:
+                received = None
+            if received is None:
+                if conn is self.conn:
+                    self.closed = True
+                return
+            for line in received:
+                self.received += 1
+                message = IrcClient.parse_message(line)
+                args = message.args
+                if message.command == 'PONG' and args and args[-1].startswith('rtt='):
+                    self.rtts.append(time.time() - float(args[-1][4:]))
+                elif message.command == 'PING':
+                    self.send(['PONG %s :%s' % (SERVER_NAME, args[-1] if args else '')])
+                elif message.command == 'JOIN' and args:
+                    channels = args[0].split(',')
+                    self.send([':%s!user@example.org JOIN %s' % (self.nick, channel)
+                               for channel in channels])
+                    self.channels.update(channels)
+
+    def send(self, lines):
+        """ sends lines to client in one send."""
+
+        self.conn.sendall(''.join(line + '\r\n' for line in lines))
+        self.sent += len(lines)
+
+    def play(self, lines, rate=None, chunk=100):
+        """ sends lines to client.
+
+        Args:
+            lines: iterable of lines to send.
+            rate: lines per second, None for as fast as client takes them.
+            chunk: how many lines to send at most in one send.
+        """
+
+        begin = time.time()
+        sent = 0
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) < chunk:
+                continue
+            self.send(batch)
+            sent += len(batch)
+            batch = []
+
+            # hold back until we are on schedule.
+            if rate:
+                delay = begin + float(sent) / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        if batch:
+            self.send(batch)
+
+    def drop(self):
+        """ closes connection to client, the client may connect again."""
+
+        if self.conn is not None:
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.conn.close()
+
+    def close(self):
+        """ closes connection to client and listening socket."""
+
+        self.drop()
+        self.listener.close()
+
+
+def scenario(server, name, rate=None):
+    """ plays scenario given on command line, name[:argument].
+
+    Returns:
+        DccSender serving DCC offers, None for other scenarios.
+    """
+
+    name, _, argument = name.partition(':')
+    if name == 'replay':
+        server.play(replay(argument, rate), None)
+        return None
+    count = int(argument) if argument else None
+    if name == 'storm':
+        server.play(privmsg_storm(count or 100000), rate)
+    elif name == 'names':
+        server.play(names_burst(server.nick, '#names', count or 10000), rate)
+    elif name == 'ping':
+        server.play(pings(count or 100), None, 1)
+    elif name == 'netsplit':
+        server.play(names_burst(server.nick, '#split', count or 10000), rate)
+        server.play(netsplit('#split', count or 10000, 'batch' in server.enabled), rate)
+    elif name == 'history':
+        server.play(history('#history', count or 1000, 'batch' in server.enabled), rate)
+    elif name == 'dcc':
+        sender = DccSender(1024 * 1024)
+        server.play(dcc_offers(server.nick, count or 10, sender.port, sender.size), rate)
+        return sender
+    else:
+        raise ValueError('unknown scenario %s' % name)
+    return None
+
+
+def main(args):
+    port, rate, certfile, capabilities = 6667, None, None, ()
+    while args and args[0] in ('--port', '--rate', '--tls', '--caps'):
+        if args[0] == '--caps':
+            capabilities = CAPABILITIES
+            args = args[1:]
+            continue
+        if args[0] == '--port':
+            port = int(args[1])
+        elif args[0] == '--rate':
+            rate = float(args[1])
+        else:
+            certfile = args[1]
+        args = args[2:]
+
+    server = FakeIrcServer(port, certfile, capabilities)
+    print 'listening on 127.0.0.1:%d' % server.port
+    server.accept()
+    print '%s registered' % server.nick
+    for name in args:
+        begin = time.time()
+        scenario(server, name, rate)
+        print '%s sent in %.2f s' % (name, time.time() - begin)
+
+    # keep connection open until client quits.
+    while not server.closed:
+        time.sleep(0.1)
+    if server.rtts:
+        rtts = sorted(server.rtts)
+        print 'PING round trip median %.2f ms, max %.2f ms' % (
+            rtts[len(rtts) // 2] * 1000, rtts[-1] * 1000)
+    server.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
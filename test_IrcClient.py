@@ -0,0 +1,393 @@
+""" Tests for the irc client, run with
+
+    python -m unittest test_IrcClient
+"""
+
+import os
+import select
+import shutil
+import socket
+import tempfile
+import thread
+import time
+import unittest
+
+import IrcClient
+import fakeircd
+
+
+class ClientTest(unittest.TestCase):
+    """ client connected to a listening socket standing in for irc server."""
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.client = IrcClient.IrcClient('127.0.0.1', self.listener.getsockname()[1],
+                                          IrcClient.LogWriter(None), nickname='me',
+                                          metrics=IrcClient.Metrics(), reconnect=False)
+        self.conn = self.listener.accept()[0]
+        self.output = []
+        self.client.printConsole = self.output.append
+
+    def tearDown(self):
+        self.client.log_writer.close()
+        self.conn.close()
+        self.listener.close()
+
+    def handle(self, *lines):
+        """ handles lines as if they came from irc server."""
+
+        self.client.message_queue.put_lines(list(lines))
+        for i in xrange(len(lines)):
+            self.client.process_messages()
+
+    def receive(self, *lines):
+        """ sends lines from irc server over its connection and handles them."""
+
+        self.conn.sendall(''.join(line + '\r\n' for line in lines))
+        deadline = time.time() + 5
+        while self.client.message_queue.depth < len(lines) and time.time() < deadline:
+            self.client.receive()
+        for i in xrange(len(lines)):
+            self.client.process_messages()
+
+
+class HandlerTest(ClientTest):
+
+    def test_privmsg_without_trailing(self):
+        self.handle(':a!b@c PRIVMSG #chan hello')
+        self.assertEqual(self.output, ['#chan a : hello'])
+
+    def test_part_with_trailing_channel(self):
+        self.handle(':me!b@c JOIN #chan', ':a!b@c JOIN #chan', ':a!b@c PART :#chan')
+        self.assertEqual(self.output[-1], 'a just left #chan')
+        self.assertEqual(self.client.state.channel('#chan').members.keys(), ['me'])
+
+    def test_server_can_not_offer_files(self):
+        self.receive('/dcc send attacker /etc/passwd', '/privmsg attacker hi')
+        self.assertEqual(self.client.send_queue.depth, 0)
+        self.assertEqual(self.client.transfers, [])
+
+    def test_server_can_not_change_dcc_policy(self):
+        policy = self.client.ctcp_policy
+        rules, limit = list(policy.cidrs.rules), policy.max_transfers
+        self.receive('/dcc allow 0.0.0.0/0', '/dcc max 1000', '/dcc policy reject')
+        self.assertEqual(policy.cidrs.rules, rules)
+        self.assertEqual(policy.max_transfers, limit)
+        self.assertTrue(policy.accept_unlisted)
+
+    def test_console_runs_commands(self):
+        self.client.post('/privmsg alice hi')
+        self.client.post('/dcc allow 10.0.0.0/8')
+        self.client.process_messages()
+        self.assertEqual(self.client.send_queue.depth, 1)
+        self.assertIn(('10.0.0.0/8', True), self.client.ctcp_policy.cidrs.rules)
+
+    def test_ctcp_without_command(self):
+        self.client.post('/ctcp alice')
+        self.client.process_messages()
+        self.assertEqual(self.output, ['usage: /ctcp NICK COMMAND'])
+
+    def test_accept_at_other_position_than_resume(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'file.bin'), 'wb') as partial:
+                partial.write('x' * 100)
+            self.client.download_directory = directory
+            self.handle(':peer!u@h PRIVMSG me :\001DCC SEND file.bin 2130706433 5000 1000\001')
+            self.assertIn('DCC RESUME file.bin 5000 100', self.client.send_queue.pop()[0])
+            self.handle(':peer!u@h PRIVMSG me :\001DCC ACCEPT file.bin 5000 50\001',
+                        ':peer!u@h PRIVMSG me :\001DCC ACCEPT file.bin 5000 100\001')
+            self.assertEqual(self.client.transfers, [])
+            self.assertIn('unexpected DCC ACCEPT', self.output[-1])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_profiler_sees_handler(self):
+        def busy_handler(client, message):
+            end = time.time() + 0.3
+            while time.time() < end:
+                pass
+        IrcClient.register_handler('BUSY', busy_handler)
+        profiler = IrcClient.SamplingProfiler()
+        try:
+            profiler.start()
+            self.handle(':server BUSY')
+            profiler.stop()
+        finally:
+            IrcClient.SERVER_HANDLERS.pop('BUSY', None)
+        self.assertEqual(profiler.handlers.most_common(1)[0][0], 'busy_handler')
+
+    def test_unknown_batch_types_share_metric(self):
+        self.client.capabilities.add('batch')
+        for kind in ('example.org/one', 'example.org/two'):
+            self.handle('BATCH +ref %s' % kind, '@batch=ref :a!b@c PRIVMSG #chan :hi', 'BATCH -ref')
+        commands = set(dict(labels)['command'] for name, labels in self.client.metrics.histograms
+                       if name == 'irc_handler_seconds')
+        self.assertIn('batch unknown', commands)
+        self.assertFalse([command for command in commands if 'example.org' in command])
+
+
+class CapTest(unittest.TestCase):
+    """ client registering with fakeircd.py speaking IRCv3."""
+
+    def connect(self, refused=()):
+        """ connects client to fake irc server and waits until it is welcomed."""
+
+        self.server = fakeircd.FakeIrcServer(capabilities=fakeircd.CAPABILITIES, refused=refused)
+        thread.start_new_thread(self.server.accept, ())
+        self.client = IrcClient.IrcClient('127.0.0.1', self.server.port, IrcClient.LogWriter(None),
+                                          nickname='me', metrics=IrcClient.Metrics(), reconnect=False)
+        self.output = []
+        self.client.printConsole = self.output.append
+        self.client.register()
+        self.assertTrue(self.pump(lambda: any('Welcome' in line for line in self.output)))
+
+    def tearDown(self):
+        self.client.log_writer.close()
+        self.server.close()
+
+    def pump(self, done):
+        """ runs client until done returns True, False after 5 s."""
+
+        deadline = time.time() + 5
+        while not done() and time.time() < deadline:
+            self.client.flush()
+            select.select([self.client], [], [], 0.01)
+            self.client.receive()
+            self.client.process_messages()
+        return done()
+
+    def send(self, *lines):
+        """ sends lines from fake irc server and waits until client handled them."""
+
+        received = self.client.lines.received
+        self.server.send(list(lines))
+        self.pump(lambda: self.client.lines.received - received >= sum(len(line) + 2 for line in lines)
+                  and not self.client.message_queue.depth)
+
+    def test_negotiation(self):
+        self.connect()
+        wanted = set(fakeircd.CAPABILITIES) - set(['sasl'])
+        self.assertEqual(self.client.capabilities, wanted)
+        self.assertEqual(self.server.enabled, wanted)
+
+    def test_refused_capabilities(self):
+        self.connect(refused=('batch',))
+        self.assertEqual(self.client.capabilities, set())
+        self.assertEqual(self.server.enabled, set())
+
+    def test_escaped_tags(self):
+        tags = []
+        IrcClient.register_handler('TAGGED', lambda client, message: tags.append((message.tags, message.time)))
+        try:
+            self.connect()
+            self.send(r'@time=2024-05-01T12:30:00.250Z;example.org/note=a\sb\:c\\d\ne;flag :server TAGGED')
+        finally:
+            IrcClient.SERVER_HANDLERS.pop('TAGGED', None)
+        self.assertEqual(tags, [({'time': '2024-05-01T12:30:00.250Z', 'example.org/note': 'a b;c\\d\ne',
+                                  'flag': ''}, 1714566600.25)])
+
+    def test_nested_history(self):
+        self.connect()
+        self.send(':%s BATCH +outer example.org/playback' % fakeircd.SERVER_NAME,
+                  '@batch=outer :%s BATCH +history chathistory #chan' % fakeircd.SERVER_NAME,
+                  '@batch=history;time=%s :b!u@h PRIVMSG #chan :second' % fakeircd.server_time(1714566660),
+                  '@batch=history;time=%s :a!u@h PRIVMSG #chan :first' % fakeircd.server_time(1714566600),
+                  ':%s BATCH -history' % fakeircd.SERVER_NAME,
+                  '@batch=outer;time=%s :c!u@h PRIVMSG #chan :third' % fakeircd.server_time(1714566720))
+        self.assertFalse([line for line in self.output if 'first' in line or 'second' in line])
+        self.send(':%s BATCH -outer' % fakeircd.SERVER_NAME)
+        shown = [line.split(' : ')[-1] for line in self.output if '#chan' in line]
+        self.assertEqual(shown, ['first', 'second', 'third'])
+
+
+class EngineTest(unittest.TestCase):
+    """ two clients on one engine, errors of one do not stop the other."""
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(2)
+        self.clients, self.conns = [], []
+        for i in xrange(2):
+            client = IrcClient.IrcClient('127.0.0.1', self.listener.getsockname()[1],
+                                         IrcClient.LogWriter(None), nickname='me%d' % i,
+                                         reconnect=False)
+            client.printConsole = lambda text: None
+            self.clients.append(client)
+            self.conns.append(self.listener.accept()[0])
+            self.conns[-1].settimeout(5)
+        self.engine = IrcClient.IrcEngine(self.clients, IrcClient.LogWriter(None), console=False)
+        thread.start_new_thread(self.engine.run, ())
+
+    def tearDown(self):
+        self.engine.running = False
+        self.engine.wake()
+        for client, conn in zip(self.clients, self.conns):
+            client.log_writer.close()
+            conn.close()
+        self.listener.close()
+
+    def ping(self, conn):
+        """ True if client answers PING on conn."""
+
+        conn.sendall('PING :alive\r\n')
+        deadline = time.time() + 5
+        received = ''
+        while 'PONG :alive' not in received and time.time() < deadline:
+            received += conn.recv(4096)
+        return 'PONG :alive' in received
+
+    def test_failing_handler(self):
+        def fail(client, message):
+            raise ValueError('broken handler')
+        IrcClient.register_handler('FAIL', fail)
+        try:
+            self.conns[0].sendall(':server FAIL\r\n')
+            self.assertTrue(self.ping(self.conns[0]))
+            self.assertTrue(self.ping(self.conns[1]))
+        finally:
+            IrcClient.SERVER_HANDLERS.pop('FAIL', None)
+
+    def test_connect_does_not_block(self):
+        # accepts tcp connections, but never answers TLS handshake.
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(1)
+        try:
+            self.engine.post('/connect 127.0.0.1:+%d' % silent.getsockname()[1])
+            self.assertTrue(self.ping(self.conns[0]))
+            self.assertTrue(self.ping(self.conns[1]))
+            self.assertEqual(self.engine.connecting, 1)
+        finally:
+            silent.close()
+
+    def test_connect(self):
+        self.engine.post('/connect new@127.0.0.1:%d' % self.listener.getsockname()[1])
+        conn = self.listener.accept()[0]
+        try:
+            conn.settimeout(5)
+            self.assertIn('NICK new', conn.recv(4096))
+            self.assertEqual(self.engine.active.nickname, 'new')
+            self.assertEqual(len(self.engine.clients), 3)
+        finally:
+            conn.close()
+
+    def test_failing_connection(self):
+        def fail():
+            raise socket.error('broken socket')
+        self.clients[0].receive = fail
+        self.conns[0].sendall('PING :alive\r\n')
+        self.assertTrue(self.ping(self.conns[1]))
+        self.assertFalse(self.clients[0].connected)
+
+
+class HandlerPoolTest(unittest.TestCase):
+
+    def test_failing_handler_reported_with_traceback(self):
+        reports = []
+        pool = IrcClient.HandlerPool(report=reports.append)
+        def fail(number):
+            if number % 2:
+                raise ValueError('broken handler')
+        try:
+            for number in xrange(1000):
+                pool.submit(number, fail, number)
+            deadline = time.time() + 10
+            while pool.completed < 1000 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            pool.close()
+        self.assertEqual((pool.completed, pool.failed), (1000, 500))
+        self.assertIn('Traceback', reports[0])
+        self.assertIn('ValueError: broken handler', reports[0])
+
+
+class DccTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.done = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def wait_done(self, timeout=10):
+        deadline = time.time() + timeout
+        while not self.done and time.time() < deadline:
+            time.sleep(0.01)
+        return self.done[0]
+
+    def test_send_to_receiver_without_acknowledgements(self):
+        path = os.path.join(self.directory, 'file.bin')
+        with open(path, 'wb') as source:
+            source.write('x' * 300000)
+        transfer = IrcClient.DccSend('peer', path, '127.0.0.1', done=self.done.append)
+        transfer.start()
+        conn = socket.create_connection(('127.0.0.1', transfer.port))
+        received = 0
+        while received < 300000:
+            data = conn.recv(65536)
+            if not data:
+                break
+            received += len(data)
+        conn.close()
+        begin = time.time()
+        self.assertIsNone(self.wait_done().error)
+        self.assertEqual(received, 300000)
+        self.assertLess(time.time() - begin, 5)
+
+    def test_receive_from_silent_sender(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        transfer = IrcClient.DccReceive('peer', 'file.bin', IrcClient.dqn_to_int('127.0.0.1'),
+                                        listener.getsockname()[1], 1000, self.directory,
+                                        done=self.done.append)
+        transfer.RECEIVE_TIMEOUT = 0.2
+        transfer.start()
+        conn = listener.accept()[0]
+        try:
+            self.assertIn('nothing received', self.wait_done().error)
+            self.assertTrue(transfer.finished)
+        finally:
+            conn.close()
+            listener.close()
+
+
+class LogImportTest(unittest.TestCase):
+    """ lines of irc.log as written by this client and by older ones."""
+
+    def test_channel_message_of_old_client(self):
+        record = IrcClient.parse_log_line('Mon 06 May 2024 10:00:00 +0000 : server : PRIVMSG #py alice!al@host : hi\n')
+        self.assertEqual(record[1:], ('server', 'PRIVMSG #py alice!al@host : hi', '#py', 'alice'))
+
+    def test_private_message_of_old_client(self):
+        record = IrcClient.parse_log_line('Mon 06 May 2024 10:00:00 +0000 : server : PRIVMSG alice!al@host : hi\n')
+        self.assertEqual(record[3:], ('alice', 'alice'))
+
+    def test_join_of_old_client(self):
+        record = IrcClient.parse_log_line('Mon 06 May 2024 10:00:00 +0000 : server : JOIN bob!b@h just joined #py\n')
+        self.assertEqual(record[3:], ('#py', 'bob'))
+
+    def test_kick(self):
+        record = IrcClient.parse_log_line('Mon 06 May 2024 10:00:00 +0000 : server : KICK bob was kicked from #py by op : spam\n')
+        self.assertEqual(record[3:], ('#py', 'bob'))
+
+    def test_search_imported_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'irc.log')
+            with open(path, 'w') as log:
+                log.write('Mon 06 May 2024 10:00:00 +0000 : server : PRIVMSG #py alice!al@host : hi\n')
+            store = IrcClient.ScrollbackStore(os.path.join(directory, 'scrollback.db'))
+            self.assertEqual(store.import_log(path, 'net'), 1)
+            self.assertEqual(len(store.search(nick='alice')), 1)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()